@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""Maintain & query local catalog of raw and standardized data files
+
+    Usage examples:
+
+        # add/refresh records of all files in the archive
+        python archive_catalog.py update
+
+        # ... or just some directories, skipping checksums
+        python archive_catalog.py update --nomd5 path/to/dir1 path/to/dir2
+
+        # which files hold CFNT stats30 data for April 2013?
+        python archive_catalog.py find -s CFNT -t stats30 2013-04-01 2013-04-30
+
+    Only files which are new or have changed since last recorded are read
+    during an update, so refreshing the catalog is quick once it is built.
+
+@author: Patrick O'Keeffe <pokeeffe@wsu.edu>
+"""
+
+import os
+import sys
+
+from argparse import ArgumentParser
+
+from definitions.catalog import Catalog
+from definitions.paths import RAW_ASCII, RAW_STDFMT, TELEMETRY
+from definitions.sites import site_list
+from version import version as __version__
+
+
+def default_dirs():
+    """Return list of archive directories which exist on this machine"""
+    dirs = []
+    for site in site_list:
+        for mask in [RAW_ASCII, RAW_STDFMT, TELEMETRY]:
+            der = mask % {'site' : site.code}
+            if os.path.isdir(der):
+                dirs.append(der)
+    return dirs
+
+
+def update(dirs, checksum=True):
+    """Add/refresh catalog records for all files in `dirs` (recursively) and
+    drop records of files which have been removed from them"""
+    cat = Catalog()
+    paths = []
+    for der in dirs:
+        for root, _, files in os.walk(der):
+            paths.extend([os.path.join(root, f) for f in sorted(files)])
+        # files no longer on disk
+        paths.extend([rec['path'] for rec in cat.find(under=der)
+                      if not os.path.isfile(rec['path'])])
+    def progress(path, updated):
+        if updated:
+            sys.stdout.write('   %s\n' % path)
+    print 'Examining %d files...' % len(paths)
+    num = cat.update(paths, checksum=checksum, callback=progress)
+    print 'Updated %d records.' % num
+
+
+def find(site=None, table=None, start=None, end=None, kind=None):
+    """Print records of files matching criteria (see `Catalog.find`)"""
+    cat = Catalog()
+    for rec in cat.find(site=site, table=table, start=start, end=end,
+                        kind=kind):
+        print '{first_ts:.19} {last_ts:.19} {nrows:>9} {path}'.format(
+            **dict((k, '' if v is None else v) for k, v in rec.iteritems()))
+
+
+if __name__ == '__main__':
+    p = ArgumentParser(description='Local catalog of data files')
+    p.add_argument('--version', action='version', version=__version__)
+    sub = p.add_subparsers(dest='command')
+
+    up = sub.add_parser('update', help='add/refresh records of files')
+    up.add_argument('dirs', nargs='*',
+                    help=('directories to examine; default: raw, standard '
+                          'format and telemetry directories of all sites'))
+    up.add_argument('--nomd5', action='store_true',
+                    help='do not compute checksums of new or changed files')
+
+    fi = sub.add_parser('find', help='list files matching criteria')
+    fi.add_argument('start', nargs='?', help='YYYY-MM-DD[ HH:MM:SS]')
+    fi.add_argument('end', nargs='?', help='YYYY-MM-DD[ HH:MM:SS]')
+    fi.add_argument('-s', '--site', help='4-char site code')
+    fi.add_argument('-t', '--table', help='current table name')
+    fi.add_argument('-k', '--kind', choices=['raw', 'standard'])
+
+    args = p.parse_args()
+    if args.command == 'update':
+        update(args.dirs or default_dirs(), checksum=not args.nomd5)
+    else:
+        find(site=args.site, table=args.table, start=args.start, end=args.end,
+             kind=args.kind)
@@ -0,0 +1,470 @@
+# -*- coding: utf-8 -*-
+"""Benchmark stages of the standardization pipeline on synthetic data
+
+    A corpus of synthetic TOA5 files, one for each current and historical
+    table name (see `definitions.synthetic`), is put through each stage of
+    `standardize_toa5` in turn and the time taken by each stage is compared
+    to a baseline stored from an earlier run, so a slowdown caused by code
+    changes or a new version of pandas shows up before the nightly rebuild
+    does. Stages are:
+
+        read         `_safe_open_toa5`, rows read from raw file
+        standardize  `_standardize_df`, rows of raw data
+        prep         `_prep_df`, rows of standardized tables, baled
+        merge        `_merge_with_existing`, rows of bales merged into copy
+                     with second half missing
+        write        `_safe_write_csv`, rows of bales written
+        split        `split_toa5.iter_parts` & `write_part`, raw lines split
+                     into parts (not recorded in the archive catalog)
+
+    Rates are rows/s of each stage and MB/s of raw input data handled; each
+    file is processed `repeat` times and the best time taken.
+
+        python benchmark_standardize.py --scale 0.1 --save
+        ... change code ...
+        python benchmark_standardize.py --scale 0.1
+
+    Exit status is 1 if any stage is slower than the baseline by more than
+    the tolerance.
+
+    With `--check-jobs N`, no timing is done; instead the corpus is
+    standardized one file at a time and then by each faster route (a pool
+    of N processes, with and without baling, and in-memory combined batches
+    as used for telemetry), and the output files of each are compared byte
+    for byte with those of the serial run. Exit status is 1 if any differ.
+
+        python benchmark_standardize.py --check-jobs 4
+
+    With `--check-chunks N`, the corpus is standardized one file at a time,
+    reading whole files and then in blocks of N rows, each in a fresh
+    process; output files are compared as above and the peak resident
+    memory of each run is reported (where the `resource` module is
+    available, not Windows).
+
+        python benchmark_standardize.py --check-chunks 5000
+
+@author: Patrick O'Keeffe <pokeeffe@wsu.edu>
+"""
+
+import filecmp
+import json
+import os
+import os.path as osp
+import platform
+import sys
+
+from argparse import ArgumentParser
+from datetime import datetime
+from glob import glob
+from multiprocessing import Pool
+from shutil import rmtree
+from tempfile import mkdtemp
+from timeit import default_timer as timer
+
+import numpy as np
+import pandas as pd
+
+from definitions.fileio import RowIndex
+from definitions.paths import BENCHMARK_BASELINE
+from definitions.profiling import _maxrss
+from definitions.synthetic import write_corpus
+from definitions.tables import table_baleinfo
+from split_toa5 import iter_parts, write_part
+from standardize_toa5 import (_safe_open_toa5, _standardize_df, _prep_df,
+                              _merge_with_existing, _safe_write_csv,
+                              standardize_toa5, standardize_files,
+                              standardize_combined)
+from version import version as __version__
+
+
+STAGES = ['read', 'standardize', 'prep', 'merge', 'write', 'split']
+DEFAULT_SCALE = 0.1 # of a day of tsdata, month of stats30, ...
+DEFAULT_REPEAT = 3
+DEFAULT_TOLERANCE = 0.15 # fractional slowdown tolerated
+SPLIT_LINES = 10000 # data lines per part in split stage
+CHECK_LATER_START = '2013-05-16 02:00' # of files overlapping corpus; see
+                                       # `check_consistency`
+
+
+def _best(repeat, func, *args):
+    """Return (result, shortest time) of `repeat` calls of func(*args)"""
+    best = None
+    for i in range(repeat):
+        started = timer()
+        result = func(*args)
+        secs = timer() - started
+        if best is None or secs < best:
+            best = secs
+    return result, best
+
+
+def _quietly(func, *args, **kwargs):
+    """Call func with standard output discarded"""
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, mode='w')
+    try:
+        return func(*args, **kwargs)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def _split(fname):
+    """Split file into parts as `split_toa5` does, but without recording
+    them in the archive catalog, then remove them"""
+    parts = []
+    for outname, hdr, data, nrows in iter_parts(fname, max_lines=SPLIT_LINES):
+        write_part(outname, hdr, data, nrows, catalog=False)
+        parts.append(outname)
+    for part in parts:
+        os.remove(part)
+    return len(parts)
+
+
+def _write(bale, fname, freq):
+    """Write bale to file, then remove it & its row index"""
+    _safe_write_csv(bale, fname, freq=freq)
+    for each in [fname, RowIndex.sidecar(fname)]:
+        if osp.isfile(each):
+            os.remove(each)
+
+
+def benchmark_file(fname, table, workdir, repeat=DEFAULT_REPEAT):
+    """Time each stage of standardizing TOA5 file of given (raw) table
+
+    Returns
+    -------
+    dict of stage name to list of [seconds, rows, bytes of raw input]
+    """
+    nbytes = osp.getsize(fname)
+    times = dict((stage, [0.0, 0, 0]) for stage in STAGES)
+    def add(stage, secs, nrows):
+        times[stage][0] += secs
+        times[stage][1] += nrows
+        times[stage][2] = nbytes
+
+    rawdf, secs = _best(repeat, _safe_open_toa5, fname)
+    add('read', secs, len(rawdf))
+    stdfs, secs = _best(repeat, _standardize_df, rawdf, table)
+    add('standardize', secs, len(rawdf))
+    for tbl, stdf in stdfs.iteritems():
+        bales, secs = _best(repeat, _prep_df, stdf, tbl, True)
+        add('prep', secs, len(stdf))
+        for bale in bales:
+            if not len(bale):
+                continue
+            if len(bale) >= 3: # fewer can't be merged; see `infer_freq`
+                existing = bale.copy()
+                existing.iloc[len(bale)//2:] = np.nan
+                bale, secs = _best(repeat, _merge_with_existing, bale,
+                                   existing, tbl)
+                add('merge', secs, len(bale))
+            out, secs = _best(repeat, _write, bale,
+                              osp.join(workdir, 'bale.dat'),
+                              table_baleinfo[tbl][3])
+            add('write', secs, len(bale))
+    with open(fname, mode='rb') as f:
+        nlines = sum(1 for line in f) - 4
+    parts, secs = _best(repeat, _split, fname)
+    add('split', secs, nlines)
+    return times
+
+
+def benchmark(flist, repeat=DEFAULT_REPEAT, verbose=False):
+    """Time each stage of standardizing files of list of (file name, table)
+
+    Returns
+    -------
+    dict of stage name to dict of total 'secs', 'rows' and 'bytes' handled
+    """
+    totals = dict((stage, dict(secs=0.0, rows=0, bytes=0))
+                  for stage in STAGES)
+    workdir = mkdtemp(prefix='reacch_bench_')
+    try:
+        for fname, table in flist:
+            if verbose:
+                print '  %s ...' % osp.basename(fname)
+            for stage, (secs, nrows, nbytes) in benchmark_file(
+                    fname, table, workdir, repeat).iteritems():
+                totals[stage]['secs'] += secs
+                totals[stage]['rows'] += nrows
+                totals[stage]['bytes'] += nbytes
+    finally:
+        rmtree(workdir, ignore_errors=True)
+    return totals
+
+
+def _outputs(dest):
+    """Return sorted list of standardized data files in directory"""
+    return sorted(osp.basename(f) for f in glob(osp.join(dest, '*.dat')))
+
+
+def check_consistency(flist, jobs):
+    """Standardize files serially and by each faster route, into temporary
+    directories, and compare output
+
+    Routes are `standardize_files` with a pool of `jobs` processes, baled
+    and not, and `standardize_combined` (not baled, as for telemetry).
+
+    Returns
+    -------
+    list of (route, output file) of output files which differ from those of
+    the serial run or are missing from either
+    """
+    routes = [
+        ('serial', True, lambda d: [standardize_toa5(f, d) for f in flist]),
+        ('jobs', True, lambda d: standardize_files(flist, d, jobs=jobs)),
+        ('serial', False, lambda d: [standardize_toa5(f, d, baled=False)
+                                     for f in flist]),
+        ('jobs', False, lambda d: standardize_files(flist, d, baled=False,
+                                                    jobs=jobs)),
+        ('combined', False, lambda d: standardize_combined(flist, d,
+                                                           baled=False)),
+    ]
+    workdir = mkdtemp(prefix='reacch_check_')
+    differ = []
+    try:
+        serial = {}
+        for name, baled, func in routes:
+            dest = osp.join(workdir, '%s_%s' % (name, baled))
+            os.makedirs(dest)
+            _quietly(func, dest)
+            if name == 'serial':
+                serial[baled] = dest
+                continue
+            expect = _outputs(serial[baled])
+            got = _outputs(dest)
+            label = name if baled else name + ' (not baled)'
+            differ.extend((label, f) for f in sorted(set(expect) ^ set(got)))
+            same, mismatch, errors = filecmp.cmpfiles(
+                serial[baled], dest, sorted(set(expect) & set(got)),
+                shallow=False)
+            differ.extend((label, f) for f in mismatch + errors)
+    finally:
+        rmtree(workdir, ignore_errors=True)
+    return differ
+
+
+def _standardize_each(flist, dest, baled, chunksize):
+    """Standardize files one at a time; return peak resident memory of
+    process in MB, or None if unknown"""
+    _quietly(lambda: [standardize_toa5(f, dest, baled=baled,
+                                       chunksize=chunksize) for f in flist])
+    maxrss = _maxrss()
+    if maxrss is None:
+        return None
+    return maxrss / (1024.**2 if sys.platform == 'darwin' else 1024.)
+
+
+def check_chunks(flist, chunksize):
+    """Standardize files reading whole files and in blocks of `chunksize`
+    rows, baled and not, each run in a fresh process, and compare output
+
+    Returns
+    -------
+    2-tuple of list of (route, output file) as `check_consistency`, and list
+    of (route, peak resident memory in MB or None) of each run
+    """
+    workdir = mkdtemp(prefix='reacch_check_')
+    differ = []
+    peaks = []
+    try:
+        for baled in [True, False]:
+            dests = []
+            for size in [None, chunksize]:
+                label = ('--chunksize %d' % size) if size else 'whole files'
+                if not baled:
+                    label += ' (not baled)'
+                dest = osp.join(workdir, '%s_%s' % (size, baled))
+                os.makedirs(dest)
+                pool = Pool(1) # fresh process, so peaks are of this run only
+                try:
+                    peaks.append((label, pool.apply(
+                        _standardize_each, (flist, dest, baled, size))))
+                finally:
+                    pool.close()
+                    pool.join()
+                dests.append(dest)
+            expect, got = _outputs(dests[0]), _outputs(dests[1])
+            differ.extend((label, f) for f in sorted(set(expect) ^ set(got)))
+            same, mismatch, errors = filecmp.cmpfiles(
+                dests[0], dests[1], sorted(set(expect) & set(got)),
+                shallow=False)
+            differ.extend((label, f) for f in mismatch + errors)
+    finally:
+        rmtree(workdir, ignore_errors=True)
+    return differ, peaks
+
+
+def _rates(totals):
+    """Return (rows/s, MB/s) of stage totals"""
+    secs = max(totals['secs'], 1e-9)
+    return totals['rows']/secs, totals['bytes']/1024./1024./secs
+
+
+def environment():
+    """Return dict describing versions of software being benchmarked"""
+    return dict(version=__version__, python=platform.python_version(),
+                pandas=pd.__version__, numpy=np.__version__,
+                machine=platform.node(),
+                date=datetime.now().isoformat().split('.')[0])
+
+
+def load_baseline(fname=BENCHMARK_BASELINE):
+    """Return stored benchmark results or None if there are none"""
+    if not osp.isfile(fname):
+        return None
+    with open(fname, mode='r') as f:
+        return json.load(f)
+
+
+def save_baseline(results, fname=BENCHMARK_BASELINE):
+    """Store benchmark results (see `run`) as baseline"""
+    der = osp.dirname(fname)
+    if der and not osp.isdir(der):
+        os.makedirs(der)
+    with open(fname+'~0', mode='w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    if osp.isfile(fname):
+        os.remove(fname)
+    os.rename(fname+'~0', fname)
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Print rates of each stage & change from baseline; return list of
+    stages slower than baseline by more than `tolerance` (a fraction)"""
+    print '%-12s %12s %9s %9s %12s %8s' % ('stage', 'rows/s', 'MB/s', 'secs',
+                                           'baseline', 'change')
+    slower = []
+    for stage in STAGES:
+        totals = results['stages'][stage]
+        rows_s, mb_s = _rates(totals)
+        line = '%-12s %12.0f %9.2f %9.3f' % (stage, rows_s, mb_s,
+                                             totals['secs'])
+        if baseline and stage in baseline['stages']:
+            base = _rates(baseline['stages'][stage])[0]
+            change = rows_s/base - 1 if base else 0.
+            line += ' %12.0f %+7.1f%%' % (base, change*100)
+            if change < -tolerance:
+                slower.append(stage)
+                line += '  SLOWER'
+        print line
+    return slower
+
+
+def run(dest=None, scale=DEFAULT_SCALE, repeat=DEFAULT_REPEAT,
+        verbose=False):
+    """Benchmark pipeline on synthetic corpus in directory `dest`, written
+    there first if it holds no TOA5 files (default: temporary directory)
+
+    Returns
+    -------
+    dict of 'stages' (see `benchmark`), 'scale', 'repeat' and 'environment'
+    """
+    tempdir = None
+    if dest is None:
+        dest = tempdir = mkdtemp(prefix='reacch_corpus_')
+    try:
+        flist = sorted(glob(osp.join(dest, '*.dat')))
+        if flist:
+            # table name is after site code: '<site>_<table>.dat'
+            flist = [(f, osp.splitext(osp.basename(f))[0].split('_', 1)[1])
+                     for f in flist]
+        else:
+            if verbose:
+                print 'Writing synthetic corpus (scale %g) to %s' % (scale,
+                                                                     dest)
+            flist = [(f, t) for f, t, n in write_corpus(dest, scale=scale)]
+        if verbose:
+            print 'Benchmarking %d files' % len(flist)
+        stages = benchmark(flist, repeat=repeat, verbose=verbose)
+    finally:
+        if tempdir:
+            rmtree(tempdir, ignore_errors=True)
+    return dict(stages=stages, scale=scale, repeat=repeat,
+                environment=environment())
+
+
+if __name__ == '__main__':
+    p = ArgumentParser(description=('Benchmark stages of standardizing TOA5 '
+                                    'files on synthetic data and compare to '
+                                    'stored baseline'))
+    p.add_argument('--version', action='version', version=__version__)
+    p.add_argument('--scale', type=float, default=DEFAULT_SCALE,
+                   help=('size of synthetic files as fraction of a day of '
+                         'tsdata, month of stats30, etc. (default: %g)'
+                         % DEFAULT_SCALE))
+    p.add_argument('--corpus', metavar='DIR',
+                   help=('directory of synthetic corpus, written if empty '
+                         'and kept (default: temporary)'))
+    p.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                   help=('times to process each file, taking best time '
+                         '(default: %d)' % DEFAULT_REPEAT))
+    p.add_argument('--baseline', default=BENCHMARK_BASELINE,
+                   help='baseline file (default: %s)' % BENCHMARK_BASELINE)
+    p.add_argument('--save', action='store_true',
+                   help='store results as new baseline')
+    p.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                   help=('flag stages slower than baseline by more than this '
+                         'fraction (default: %g)' % DEFAULT_TOLERANCE))
+    p.add_argument('--check-jobs', metavar='N', type=int,
+                   help=('instead of benchmarking, check that output using '
+                         'N processes, and of combined batches, is identical '
+                         'to output of serial run'))
+    p.add_argument('--check-chunks', metavar='N', type=int,
+                   help=('instead of benchmarking, check that output reading '
+                         'files in blocks of N rows is identical to output '
+                         'reading whole files, and report peak memory use'))
+    p.add_argument('-v', '--verbose', action='store_true',
+                   help='verbose output')
+    args = p.parse_args()
+
+    if args.check_jobs or args.check_chunks:
+        tempdir = None
+        corpus = args.corpus
+        if corpus is None:
+            corpus = tempdir = mkdtemp(prefix='reacch_corpus_')
+        try:
+            flist = sorted(glob(osp.join(corpus, '*.dat')))
+            if not flist:
+                flist = [f for f, t, n in write_corpus(corpus,
+                                                       scale=args.scale)]
+                write_corpus(osp.join(corpus, 'later'), scale=args.scale,
+                             start=CHECK_LATER_START, seed=100)
+            # second set of files overlaps first, so output files are merged
+            # from several sources, as with real data; in reverse order, so
+            # historical tables lacking some columns come first
+            flist += sorted(glob(osp.join(corpus, 'later', '*.dat')),
+                            reverse=True)
+            if args.check_jobs:
+                differ = check_consistency(flist, args.check_jobs)
+                against = 'serial run'
+            else:
+                differ, peaks = check_chunks(flist, args.check_chunks)
+                against = 'reading whole files'
+                for route, peak in peaks:
+                    print '%-32s peak RSS %s' % (route, 'unknown' if peak
+                                                 is None else '%.0f MB' % peak)
+        finally:
+            if tempdir:
+                rmtree(tempdir, ignore_errors=True)
+        for route, fname in differ:
+            print '%-20s %s' % (route, fname)
+        print '%d output files differ from %s' % (len(differ), against)
+        sys.exit(1 if differ else 0)
+
+    results = run(args.corpus, scale=args.scale, repeat=args.repeat,
+                  verbose=args.verbose)
+    baseline = None if args.save else load_baseline(args.baseline)
+    if baseline is not None:
+        env = baseline['environment']
+        print ('Baseline of %s: version %s, pandas %s, numpy %s, scale %g'
+               % (env['date'], env['version'], env['pandas'], env['numpy'],
+                  baseline['scale']))
+        if baseline['scale'] != results['scale']:
+            print ' * baseline is of a corpus of different scale'
+    slower = compare(results, baseline, args.tolerance)
+    if args.save:
+        save_baseline(results, args.baseline)
+        print 'Saved baseline to', args.baseline
+    sys.exit(1 if slower else 0)
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""Local catalog of raw and standardized data files
+
+    Keeps a record of each data file in the archive (site, table, time span,
+    row counts, size, modification time and checksum) in an SQLite database
+    stored on the local machine, so questions like "which bales cover CFNT
+    stats30 in spring 2013" can be answered without touching the network
+    share:
+
+        >>> from definitions.catalog import Catalog
+        >>> cat = Catalog()
+        >>> for row in cat.find(site='CFNT', table='stats30',
+        ...                     start='2013-03-01', end='2013-05-31'):
+        ...     print row['path']
+
+    The catalog is updated as files are written by `standardize_toa5`,
+    `split_toa5` and `process_new_telemetry_data`; existing trees can be
+    added (or refreshed) with `Catalog.update`.
+
+    Note that raw files recorded by `standardize_toa5` have row counts and
+    time spans of the data as standardized, i.e. without duplicate records
+    or any outside the study period; `describe_file` counts all rows.
+
+@author: Patrick O'Keeffe <pokeeffe@wsu.edu>
+"""
+
+import os
+import sqlite3
+
+from datetime import datetime as dt
+
+from pandas import read_csv
+
+from fileio import get_toa5_header, HashingReader
+from paths import CATALOG
+from tables import current_names, ColumnNotFoundError
+
+
+RAW = 'raw' # TOA5 files, as from the datalogger
+STANDARD = 'standard' # output of standardize_toa5
+
+_schema = """\
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,  -- absolute, normalized path
+    kind TEXT,              -- RAW or STANDARD
+    site TEXT,              -- 4-char site code
+    table_name TEXT,        -- current table name(s), comma-separated
+    raw_table TEXT,         -- table name in TOA5 header (raw files only)
+    first_ts TEXT,          -- 'YYYY-MM-DD HH:MM:SS.ffffff'
+    last_ts TEXT,
+    nrows INTEGER,          -- number of data rows
+    nvalid INTEGER,         -- rows with at least one non-NAN value
+    size INTEGER,           -- bytes
+    mtime REAL,
+    md5 TEXT,
+    updated TEXT            -- when this record was last written
+);
+CREATE INDEX IF NOT EXISTS files_site_table ON files (site, table_name);
+"""
+
+_columns = ['path', 'kind', 'site', 'table_name', 'raw_table', 'first_ts',
+            'last_ts', 'nrows', 'nvalid', 'size', 'mtime', 'md5', 'updated']
+
+
+def _normpath(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+def _like(text):
+    """Return text escaped for use in LIKE pattern with ESCAPE '\\', so
+    '_' and '%' (as in most table names) match only themselves"""
+    for char in '\\%_':
+        text = text.replace(char, '\\'+char)
+    return text
+
+
+def _tstamp(ts):
+    """Return timestamp-like object as sortable string or None"""
+    if ts is None:
+        return None
+    return ts.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+class Catalog(object):
+    """Catalog of data files, backed by SQLite database
+
+    Parameters
+    ----------
+    dbfile : str
+        path to database file, created if necessary. Default: `CATALOG`
+    """
+    def __init__(self, dbfile=CATALOG):
+        der = os.path.dirname(dbfile)
+        if der and not os.path.isdir(der):
+            try:
+                os.makedirs(der)
+            except OSError:
+                if not os.path.isdir(der):
+                    raise
+        self.dbfile = dbfile
+        self.conn = sqlite3.connect(dbfile, timeout=60)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(_schema)
+
+    def close(self):
+        self.conn.close()
+
+    def record(self, path, kind, **fields):
+        """Add or replace record for file at `path`
+
+        File size and modification time are read from disk. Other fields
+        (see `_columns`) are given as keyword arguments; any omitted are
+        stored as NULL, meaning unknown. Timestamps may be given as
+        datetime-like objects or strings.
+        """
+        st = os.stat(path)
+        row = dict.fromkeys(_columns)
+        row.update(fields)
+        for key in ['first_ts', 'last_ts']:
+            if row[key] is not None and not isinstance(row[key], basestring):
+                row[key] = _tstamp(row[key])
+        if isinstance(row['table_name'], (list, tuple, set)):
+            row['table_name'] = ','.join(sorted(row['table_name']))
+        if kind == STANDARD and row['site'] is None:
+            row['site'], tables, _ = _parse_std_name(path)
+            row['table_name'] = row['table_name'] or tables.pop()
+        row.update(path=_normpath(path), kind=kind, size=st.st_size,
+                   mtime=st.st_mtime, updated=str(dt.now()))
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO files (%s) VALUES (%s)'
+                              % (', '.join(_columns), ', '.join('?'*len(_columns))),
+                              [row[c] for c in _columns])
+
+    def record_df(self, path, kind, df, **fields):
+        """Add or replace record for file just written from DataFrame `df`
+
+        Time span and row counts are taken from `df` instead of the file.
+        """
+        if len(df):
+            fields.setdefault('first_ts', df.index[0])
+            fields.setdefault('last_ts', df.index[-1])
+        fields.setdefault('nrows', len(df))
+        fields.setdefault('nvalid', count_valid(df))
+        self.record(path, kind, **fields)
+
+    def record_append(self, path, df, prior=None, md5=None):
+        """Update record for file to which rows of `df` were just appended
+
+        If `prior` (the file's record from before the append, and current
+        at that time) is given, counts are updated; otherwise they are left
+        unknown. Checksum is unknown unless `md5` (of the whole file) is
+        given."""
+        fields = dict(last_ts=df.index[-1] if len(df) else None, md5=md5)
+        if prior is not None:
+            fields.update(site=prior['site'], table_name=prior['table_name'],
+                          first_ts=prior['first_ts'])
+            if len(df) == 0:
+                fields['last_ts'] = prior['last_ts']
+                fields['md5'] = md5 or prior['md5'] # file is unchanged
+            if prior['nrows'] is not None:
+                fields['nrows'] = prior['nrows'] + len(df)
+            if prior['nvalid'] is not None:
+                fields['nvalid'] = prior['nvalid'] + count_valid(df)
+        self.record(path, STANDARD, **fields)
+
+    def get(self, path):
+        """Return record for file at `path` as dict, or None"""
+        cur = self.conn.execute('SELECT * FROM files WHERE path = ?',
+                                (_normpath(path),))
+        row = cur.fetchone()
+        return dict(row) if row else None
+
+    def is_current(self, path, fields=()):
+        """Return truth of whether record for `path` matches file on disk
+        (by size & modification time) and has values for all `fields`"""
+        rec = self.get(path)
+        if rec is None:
+            return False
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        if (rec['size'], rec['mtime']) != (st.st_size, st.st_mtime):
+            return False
+        return None not in [rec[c] for c in fields]
+
+    def remove(self, path):
+        """Remove record of file at `path`, if any"""
+        with self.conn:
+            self.conn.execute('DELETE FROM files WHERE path = ?',
+                              (_normpath(path),))
+
+    def find(self, site=None, table=None, start=None, end=None, kind=None,
+             under=None):
+        """Return records of files matching all given criteria
+
+        Parameters
+        ----------
+        site : str
+            4-char site code
+        table : str
+            current table name
+        start, end : str or datetime-like
+            only files with data overlapping this period (inclusive);
+            strings should be of form 'YYYY-MM-DD[ HH:MM:SS]'
+        kind : str
+            RAW or STANDARD
+        under : str
+            only files within this directory
+
+        Returns
+        -------
+        list of dicts, ordered by first timestamp
+        """
+        where, params = [], []
+        if site is not None:
+            where.append('site = ?')
+            params.append(site)
+        if table is not None:
+            where.append("(',' || table_name || ',') LIKE ? ESCAPE '\\'")
+            params.append('%%,%s,%%' % _like(table))
+        if start is not None:
+            if not isinstance(start, basestring):
+                start = _tstamp(start)
+            where.append('last_ts >= ?')
+            params.append(start)
+        if end is not None:
+            if not isinstance(end, basestring):
+                end = _tstamp(end)
+            elif len(end) <= 10:
+                end = end + ' 23:59:59.999999' # include whole day
+            where.append('first_ts <= ?')
+            params.append(end)
+        if kind is not None:
+            where.append('kind = ?')
+            params.append(kind)
+        if under is not None:
+            where.append("path LIKE ? ESCAPE '\\'")
+            params.append(os.path.join(_like(_normpath(under)), '%'))
+        sql = 'SELECT * FROM files'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY first_ts, path'
+        return [dict(row) for row in self.conn.execute(sql, params)]
+
+    def update(self, paths, checksum=True, callback=None):
+        """Add or refresh records of files which have changed
+
+        Files whose record is missing, out of date or incomplete are read in
+        full (see `describe_file`); others are skipped without being opened.
+        Records of listed files which no longer exist are removed.
+
+        Parameters
+        ----------
+        paths : list of str
+            files to examine
+        checksum : bool
+            if False, files are not hashed and md5 is not required for a
+            record to be complete; the md5 of a record is kept if the file
+            is unchanged
+        callback : callable
+            called with (path, updated) for each file examined, where
+            `updated` is True if a record was added or refreshed
+
+        Returns
+        -------
+        number of records added or refreshed
+        """
+        needed = ['first_ts', 'last_ts', 'nrows', 'nvalid']
+        if checksum:
+            needed.append('md5')
+        num = 0
+        for path in paths:
+            if not os.path.isfile(path):
+                self.remove(path)
+                continue
+            updated = False
+            if not self.is_current(path, fields=needed):
+                info = describe_file(path, checksum=checksum)
+                if info is not None:
+                    if info['md5'] is None and self.is_current(path):
+                        info['md5'] = self.get(path)['md5']
+                    kind = info.pop('kind')
+                    self.record(path, kind, **info)
+                    updated = True
+                    num += 1
+            if callback:
+                callback(path, updated)
+        return num
+
+
+def describe_file(path, chunksize=100000, checksum=True):
+    """Read data file in full and return dict of catalog fields
+
+    Works for both raw (TOA5) and standard format files, which are told
+    apart by the header. Returns None if file is neither. If `checksum` is
+    False, the file is not hashed and md5 is None.
+    """
+    hdr = get_toa5_header(path)
+    if hdr is not None:
+        kind = RAW
+        site = hdr.site_code
+        raw_table = hdr.table_name
+        tables = set()
+        for col in hdr.columns:
+            try:
+                tbl = current_names(raw_table, col)[0]
+            except ColumnNotFoundError:
+                continue
+            if tbl:
+                tables.add(tbl)
+        opts = dict(header=1, skiprows=[2,3],
+                    na_values=['NAN', 7999, -7999, 65535, 2147483647,
+                               -2147483648])
+    else:
+        with open(path, mode='rb') as f:
+            if not f.readline().startswith('TIMESTAMP,'):
+                return None
+        kind = STANDARD
+        site, tables, raw_table = _parse_std_name(path)
+        opts = dict(header=0, na_values=['NAN'])
+
+    first, last, nrows, nvalid = None, None, 0, 0
+    with open(path, mode='rb') as f:
+        reader = HashingReader(f) if checksum else f
+        for df in read_csv(reader, index_col=0, parse_dates=True,
+                           keep_default_na=False, dtype=str,
+                           chunksize=chunksize, **opts):
+            if not len(df):
+                continue
+            lo, hi = df.index.min(), df.index.max()
+            first = lo if first is None else min(first, lo)
+            last = hi if last is None else max(last, hi)
+            nrows += len(df)
+            nvalid += count_valid(df)
+        md5 = reader.hexdigest() if checksum else None
+    return dict(kind=kind, site=site, table_name=sorted(tables),
+                raw_table=raw_table, first_ts=first, last_ts=last,
+                nrows=nrows, nvalid=nvalid, md5=md5)
+
+
+def _parse_std_name(path):
+    """Return (site, set of table names, None) from standard file name
+
+    Standard format file names look like SITE_table[_YYYY-MM-DD[_0000]].dat
+    (see `standardize_toa5._make_out_fname`)"""
+    name = os.path.splitext(os.path.basename(path))[0]
+    site, _, rest = name.partition('_')
+    parts = rest.split('_')
+    while parts and (parts[-1] == '0000' or
+                     (len(parts[-1]) == 10 and parts[-1][4] == '-')):
+        parts.pop()
+    return site, set(['_'.join(parts)]), None
+
+
+def count_valid(df):
+    """Return number of rows with at least one non-null value, ignoring
+    RECORD column (which is present even in otherwise empty rows)"""
+    cols = [c for c in df.columns if c != 'RECORD']
+    if not cols:
+        return 0
+    return int(df[cols].notnull().any(axis=1).sum())
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""Parallel md5 checksums of files, with a persistent cache
+
+    Files are hashed by a pool of threads; both file reads and `hashlib`
+    release the GIL, so several files are hashed at once at close to disk
+    speed. Checksums are remembered in a cache keyed by path, size and
+    modification time (see `HashCache`) so unchanged files need not be read
+    again.
+
+        >>> from definitions.checksums import hash_files, HashCache
+        >>> for path, md5, nbytes, cached, err in hash_files(flist,
+        ...                                                  cache=HashCache()):
+        ...     print md5, path
+
+@author: Patrick O'Keeffe <pokeeffe@wsu.edu>
+"""
+
+import hashlib
+import os
+import sqlite3
+
+from multiprocessing.pool import ThreadPool
+
+from fileio import FileLock
+from paths import HASH_CACHE
+
+
+BLOCKSIZE = 2**20 # bytes read at a time
+DEFAULT_JOBS = 4 # hashing threads
+MANIFEST = 'md5sums' # name of per-directory checksum file
+
+
+def md5_file(path, blocksize=BLOCKSIZE):
+    """Return (md5 hex digest, bytes read) of file at `path`"""
+    md5 = hashlib.md5()
+    nbytes = 0
+    with open(path, mode='rb') as f:
+        block = f.read(blocksize)
+        while block:
+            md5.update(block)
+            nbytes += len(block)
+            block = f.read(blocksize)
+    return md5.hexdigest(), nbytes
+
+
+def _normpath(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+class HashCache(object):
+    """Persistent record of md5 checksums by (path, size, mtime)
+
+    A checksum is only returned by `get` if the file's size and modification
+    time are unchanged since it was computed. Backed by an SQLite database
+    in the local cache directory; not for use from more than one thread.
+
+    Parameters
+    ----------
+    dbfile : str
+        path to database file, created if necessary. Default: `HASH_CACHE`
+    """
+    def __init__(self, dbfile=HASH_CACHE):
+        der = os.path.dirname(dbfile)
+        if der and not os.path.isdir(der):
+            try:
+                os.makedirs(der)
+            except OSError:
+                if not os.path.isdir(der):
+                    raise
+        self.conn = sqlite3.connect(dbfile, timeout=60)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS md5 (path TEXT PRIMARY '
+                          'KEY, size INTEGER, mtime REAL, md5 TEXT)')
+        self._pending = 0
+
+    def get(self, path, st=None):
+        """Return cached md5 of file or None if unknown or file has changed;
+        `st` is result of `os.stat(path)`, if already available"""
+        st = st or os.stat(path)
+        row = self.conn.execute('SELECT size, mtime, md5 FROM md5 WHERE '
+                                'path = ?', (_normpath(path),)).fetchone()
+        if row is None or (row[0], row[1]) != (st.st_size, st.st_mtime):
+            return None
+        return row[2]
+
+    def put(self, path, md5, st=None):
+        """Remember md5 of file; `st` should be result of `os.stat(path)`
+        taken *before* file was read, so changes made during reading are
+        caught next time"""
+        st = st or os.stat(path)
+        self.conn.execute('INSERT OR REPLACE INTO md5 VALUES (?, ?, ?, ?)',
+                          (_normpath(path), st.st_size, st.st_mtime, md5))
+        self._pending += 1
+        if self._pending >= 1000:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self._pending = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+
+def _hash_task(task):
+    path, blocksize = task
+    try:
+        md5, nbytes = md5_file(path, blocksize)
+    except (IOError, OSError) as err:
+        return path, None, 0, str(err)
+    return path, md5, nbytes, None
+
+
+def hash_files(paths, jobs=DEFAULT_JOBS, cache=None, blocksize=BLOCKSIZE):
+    """Generate md5 checksums of files, using a pool of threads
+
+    Parameters
+    ----------
+    paths : list of str
+        files to hash
+    jobs : int
+        number of threads reading & hashing files at once
+    cache : HashCache or None
+        if given, checksums of unchanged files are taken from it and new
+        checksums are added to it
+    blocksize : int
+        bytes read at a time
+
+    Yields
+    ------
+    5-tuple of path, md5 hex digest (None on error), bytes read, whether
+    checksum came from cache and error message (or None), in order of
+    completion. Checksums from cache are yielded first.
+    """
+    pending = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError as err:
+            yield path, None, 0, False, str(err)
+            continue
+        md5 = cache.get(path, st) if cache is not None else None
+        if md5 is not None:
+            yield path, md5, 0, True, None
+        else:
+            pending[path] = st
+    if not pending:
+        return
+
+    tasks = [(path, blocksize) for path in paths if path in pending]
+    pool = ThreadPool(processes=max(1, min(jobs, len(tasks))))
+    try:
+        for path, md5, nbytes, err in pool.imap_unordered(_hash_task, tasks):
+            if md5 is not None and cache is not None:
+                cache.put(path, md5, pending[path])
+            yield path, md5, nbytes, False, err
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        if cache is not None:
+            cache.commit()
+
+
+def read_md5sums(md5file):
+    """Return list of (md5, relative path) entries of md5sums file"""
+    entries = []
+    with open(md5file, mode='rb') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if not line.strip():
+                continue
+            # "<md5>  <name>" or, binary mode of md5sum utility, "<md5> *<name>"
+            entries.append((line[:32].lower(), line[34:]))
+    return entries
+
+
+def update_manifest(fname, md5):
+    """Set (or, if `md5` is None, remove) entry for file in the md5sums
+    manifest of its directory
+
+    The manifest is re-written to a temporary file which then replaces it,
+    while holding a `FileLock`, so concurrent writers of files in the same
+    directory don't lose each other's entries and readers never see a
+    partial manifest. Entries are kept in order of name.
+    """
+    der, name = os.path.split(os.path.abspath(fname))
+    manifest = os.path.join(der, MANIFEST)
+    with FileLock(manifest):
+        entries = {}
+        if os.path.isfile(manifest):
+            entries = dict((n, h) for h, n in read_md5sums(manifest))
+        if md5 is None:
+            if entries.pop(name, None) is None:
+                return
+        else:
+            entries[name] = md5
+        tempname = manifest + '~0'
+        with open(tempname, mode='w') as f:
+            for n in sorted(entries):
+                f.write(entries[n] + '  ' + n + '\n')
+        try:
+            os.rename(tempname, manifest)
+        except OSError: # Windows won't rename over existing file
+            os.remove(manifest)
+            os.rename(tempname, manifest)
+
+
+def _splitname(name):
+    """Return (directory, base name) of md5sums entry, either separator"""
+    name = name.replace('\\', '/')
+    der, _, base = name.rpartition('/')
+    return der, base
+
+
+def dir_digests(entries):
+    """Return Merkle-style digests of each directory of md5sums entries
+
+    The digest of a directory is the md5 of lines "<md5>  <name>" for each
+    file and "<digest>  <name>/" for each subdirectory within it, in order
+    of name, so it changes if any file beneath it is added, removed,
+    renamed or altered. Directories without any files beneath are ignored.
+
+    Parameters
+    ----------
+    entries : list of (md5, relative path) pairs
+        e.g. from `read_md5sums`; either path separator may be used
+
+    Returns
+    -------
+    dict of directory (relative, '/'-separated; '' for base directory) to
+    digest
+    """
+    children = {'' : {}}
+    for md5, name in entries:
+        der, base = _splitname(name)
+        children.setdefault(der, {})[base] = md5
+        while der: # make sure every ancestor lists this directory
+            parent, base = _splitname(der)
+            known = parent in children
+            children.setdefault(parent, {})[base + '/'] = None
+            if known:
+                break
+            der = parent
+
+    digests = {}
+    def digest(der):
+        lines = []
+        for name in sorted(children[der]):
+            md5 = children[der][name]
+            if md5 is None:
+                md5 = digest(der + '/' + name[:-1] if der else name[:-1])
+            lines.append(md5 + '  ' + name + '\n')
+        digests[der] = hashlib.md5(''.join(lines)).hexdigest()
+        return digests[der]
+    digest('')
+    return digests
+
+
+def write_dir_digests(fname, digests):
+    """Write directory digests as lines of "<digest>  <dir>/" ("./" for base
+    directory), in order of directory"""
+    with open(fname, mode='w') as f:
+        for der in sorted(digests):
+            f.write(digests[der] + '  ' + (der or '.') + '/\n')
+
+
+def read_dir_digests(fname):
+    """Return dict of directory to digest from file of `write_dir_digests`"""
+    digests = {}
+    for md5, name in read_md5sums(fname):
+        name = name.rstrip('/')
+        digests['' if name == '.' else name] = md5
+    return digests
+
+
+def compare_trees(entries_a, entries_b, digests_a=None, digests_b=None):
+    """Compare two copies of a tree by md5sums entries, top-down
+
+    Only directories whose digests differ are descended into; stored
+    digests (see `read_dir_digests`) may be given to save computing them.
+
+    Returns
+    -------
+    list of (status, relative path) of files which differ, where status is
+    'differs', 'only in A' or 'only in B'
+    """
+    def index(entries):
+        files = {}
+        for md5, name in entries:
+            der, base = _splitname(name)
+            files.setdefault(der, {})[base] = md5
+        return files
+    digests_a = digests_a or dir_digests(entries_a)
+    digests_b = digests_b or dir_digests(entries_b)
+    files_a, files_b = index(entries_a), index(entries_b)
+    subdirs = {}
+    for der in set(digests_a) | set(digests_b):
+        if der:
+            parent, base = _splitname(der)
+            subdirs.setdefault(parent, set()).add(der)
+
+    found = []
+    def join(der, name):
+        return der + '/' + name if der else name
+    todo = ['']
+    while todo:
+        der = todo.pop()
+        if digests_a.get(der) == digests_b.get(der):
+            continue
+        if der not in digests_a or der not in digests_b:
+            # whole subtree is on one side only
+            status, entries = (('only in A', entries_a) if der in digests_a
+                               else ('only in B', entries_b))
+            found.extend((status, name) for name in sorted(
+                name.replace('\\', '/') for md5, name in entries)
+                if name.startswith(der + '/'))
+            continue
+        a, b = files_a.get(der, {}), files_b.get(der, {})
+        for name in sorted(set(a) | set(b)):
+            if name not in b:
+                found.append(('only in A', join(der, name)))
+            elif name not in a:
+                found.append(('only in B', join(der, name)))
+            elif a[name] != b[name]:
+                found.append(('differs', join(der, name)))
+        todo.extend(sorted(subdirs.get(der, ()), reverse=True))
+    return found
@@ -6,19 +6,167 @@
 @author: Patrick O'Keeffe <pokeeffe@wsu.edu>
 """
 
+import atexit
+import csv
+import errno
+import hashlib
 import os
+import socket
+import threading
+import time
+import cPickle as pickle
 
-from pandas import read_csv
+import numpy as np
+
+from pandas import read_csv, to_datetime, to_numeric, Timestamp
+from pandas.tseries.offsets import Day
 from warnings import warn
 
+from paths import LOCAL_CACHE
 from sites import sn2code
 
 
 MAX_RAW_FILE_SIZE = 200 * 1024 * 1024  #split raw data files > this, bytes
+STUDY_START = '2011-08-18' # REACCH study duration; data outside is discarded
+STUDY_END = '2016-12-31' # (inclusive)
+LOCK_TIMEOUT = 600 # seconds to wait for a `FileLock` by default
+LOCK_STALE_AGE = 3600 # seconds after which a lock file is taken as abandoned
+                      # if not refreshed by its owner; see `FileLock`
 
 
 class HeaderMismatchError(Exception): pass
 
+class LockTimeoutError(Exception): pass
+
+
+class TOA5Header(object):
+    """Parsed header of Campbell Scientific long-header (TOA5) data file
+
+    All four header lines are parsed at once; use `get_toa5_header` to
+    obtain instances, which avoids re-reading files unnecessarily.
+
+    Attributes
+    ----------
+    station_name, logger_model, serial_num, os_version, program_name,
+    program_sig, table_name : str
+        fields of the first header line, in order
+    columns, units, process_types : list of str
+        second, third and fourth header lines (column names, units and
+        processing types such as "Smp", "Avg", ...)
+    data_start : int
+        byte offset of first data line in file
+    """
+    def __init__(self, lines, data_start):
+        info, columns, units, process_types = lines
+        if not info or info[0] != 'TOA5':
+            raise ValueError('Not a TOA5 file')
+        self.table_name = info[-1] # always last item
+        info = info[1:] + ['']*(8-len(info)) # tolerate short first line
+        (self.station_name, self.logger_model, self.serial_num,
+            self.os_version, self.program_name, self.program_sig) = info[:6]
+        self.columns = columns
+        self.units = units
+        self.process_types = process_types
+        self.data_start = data_start
+
+    @property
+    def site_code(self):
+        """four character site code or None if logger is not recognized"""
+        return sn2code.get(self.serial_num)
+
+    @property
+    def fingerprint(self):
+        """tuple of table name and column names; identical for all files
+        produced by same version of logger program"""
+        return (self.table_name, tuple(self.columns))
+
+    @classmethod
+    def read(cls, toa5_file):
+        """Parse header from file; raises ValueError if not a TOA5 file"""
+        with open(toa5_file, mode='rb') as f:
+            raw = [f.readline() for i in range(4)]
+            data_start = f.tell()
+        lines = [row for row in csv.reader(raw)]
+        if len(lines) != 4:
+            raise ValueError('Incomplete TOA5 header')
+        return cls(lines, data_start)
+
+
+_header_index = None # see `get_toa5_header`
+_header_index_file = os.path.join(LOCAL_CACHE, 'toa5_headers.pkl')
+_header_index_dirty = 0
+
+
+def get_toa5_header(toa5_file):
+    """Return parsed header of TOA5 file, or None if not a valid TOA5 file
+
+    Headers are remembered in a persistent index, keyed by absolute path
+    and validated against file size and modification time, so a file's
+    header is only read from disk once unless the file changes. The index
+    is stored in `LOCAL_CACHE` and saved periodically & upon exit; see
+    `save_header_index`.
+
+    Parameters
+    ----------
+    toa5_file : str
+        path to source data file in CSI long-header (TOA5) format
+
+    Returns
+    -------
+    TOA5Header or None
+    """
+    global _header_index, _header_index_dirty
+    if _header_index is None:
+        _header_index = _load_header_index()
+    path = os.path.normcase(os.path.abspath(toa5_file))
+    st = os.stat(toa5_file)
+    try:
+        size, mtime, hdr = _header_index[path]
+        if (size, mtime) == (st.st_size, st.st_mtime):
+            return hdr
+    except KeyError:
+        pass
+    try:
+        hdr = TOA5Header.read(toa5_file)
+    except (ValueError, csv.Error):
+        hdr = None
+    _header_index[path] = (st.st_size, st.st_mtime, hdr)
+    _header_index_dirty += 1
+    if _header_index_dirty >= 250:
+        save_header_index()
+    return hdr
+
+
+def _load_header_index():
+    """Return header index from disk or empty dict if unavailable"""
+    try:
+        with open(_header_index_file, mode='rb') as f:
+            return pickle.load(f)
+    except Exception:
+        return {}
+
+
+@atexit.register
+def save_header_index():
+    """Write header index to disk, combined with any saved by others"""
+    global _header_index_dirty
+    if not _header_index_dirty:
+        return
+    index = _load_header_index()
+    index.update(_header_index)
+    tempname = '%s~%d' % (_header_index_file, os.getpid())
+    try:
+        if not os.path.isdir(LOCAL_CACHE):
+            os.makedirs(LOCAL_CACHE)
+        with open(tempname, mode='wb') as f:
+            pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+        if os.path.isfile(_header_index_file):
+            os.remove(_header_index_file)
+        os.rename(tempname, _header_index_file)
+    except (IOError, OSError):
+        return
+    _header_index_dirty = 0
+
 
 def get_table_name(toa5_file):
     """Return name of table given rel. or abs. file path to TOA5 file
@@ -35,14 +183,8 @@ def get_table_name(toa5_file):
     -------
     str : name of data table or None if not a valid table file
     """
-    with open(toa5_file, mode='r') as f:
-        l = f.readline().strip().split(',')
-    try:
-        assert l[0] == '"TOA5"' # 1st item, 1st row must be "TOA5"
-        tblname = l[-1].strip('"') #last item, first row
-    except:
-        tblname = None
-    return tblname
+    hdr = get_toa5_header(toa5_file)
+    return hdr.table_name if hdr else None
 
 
 def get_site_code(toa5_file):
@@ -60,14 +202,61 @@ def get_site_code(toa5_file):
     -------
     str : four character site code or None if not a valid table file
     """
-    with open(toa5_file, mode='r') as f:
-        l = f.readline().strip()
-    sn = l.split(',')[3].strip('"') #fourth item, first row
-    try:
-        sitecode = sn2code[sn]
-    except KeyError:
-        sitecode = None
-    return sitecode
+    hdr = get_toa5_header(toa5_file)
+    return hdr.site_code if hdr else None
+
+
+def get_toa5_span(toa5_file, header=None, blocksize=4096):
+    """Return first and last timestamps of TOA5 file, from its ends only
+
+    Reads the first data line and seeks to the end of the file for the last
+    one, so the cost does not depend on the size of the file. Since records
+    may be out of order, these are not necessarily the earliest and latest.
+
+    Parameters
+    ----------
+    toa5_file : str
+        path to source data file in CSI long-header (TOA5) format
+    header : TOA5Header
+        parsed header of file, if already available
+    blocksize : int
+        bytes read from end of file at a time
+
+    Returns
+    -------
+    3-tuple of first & last timestamps (`pandas.Timestamp` or None if not
+    found) and average length of the two lines, in bytes (e.g. to estimate
+    number of lines)
+    """
+    header = header or get_toa5_header(toa5_file)
+    if header is None:
+        return None, None, 0
+    with open(toa5_file, mode='rb') as f:
+        f.seek(header.data_start)
+        first = f.readline()
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        last = None
+        readsize = blocksize
+        while last is None:
+            pos = max(header.data_start, size-readsize)
+            f.seek(pos)
+            lines = f.read(size-pos).rstrip('\r\n').split('\n')
+            if pos > header.data_start:
+                lines = lines[1:] # first likely partial
+            if lines:
+                last = lines[-1] + '\n'
+            elif pos == header.data_start:
+                break
+            readsize *= 2
+    def parse(line):
+        try:
+            return Timestamp(line.split(',', 1)[0].strip().strip('"'))
+        except (ValueError, TypeError):
+            return None
+    if not first.strip():
+        return None, None, 0
+    return parse(first), parse(last), (len(first) + len(last)) // 2
 
 
 def open_toa5(fname):
@@ -102,23 +291,605 @@ def open_toa5(fname):
                   na_values=['"NAN"'],
                   keep_default_na=False)
 
-    if len(df.index.get_duplicates()):
+    df, stats = tidy_toa5(df)
+    if stats['duplicates']:
         warn('open_toa5 removed duplicate indices (%s)' % fname)
-        df = df.groupby(level=0).last()
-
-    if not df.index.is_monotonic:
+    if stats['reordered']:
         warn('open_toa5 sorted non-monotonic timestamps (%s)' % fname)
-        df.sort_index(inplace=True)
-
-    if len(df[:'20110818']) or len(df['20161231':]):
+    if stats['trimmed']:
         warn(('open_toa5 detected and removed data from outside duration of '
              'the REACCH field study (before Aug 18, 2011 or after Dec 31, '
              '2016) (%s)') % fname)
-        df = df['20110818':'20161231']
+    return df
+
+
+def tidy_toa5(df):
+    """Remove duplicate records, sort & clip data to REACCH study duration
 
+    Works on the int64 timestamp array: data which is already sorted, free
+    of duplicates and within the study duration (the usual case) is
+    returned as is after a single pass, without copying. Otherwise, the
+    rows to keep are found by one stable sort and taken at once. Of records
+    with the same timestamp, the last written is kept: the one with the
+    highest RECORD number or, if RECORD is missing for any duplicates,
+    the last in the file.
+
+    Returns
+    -------
+    2-tuple of the tidied DataFrame (index named 'TIMESTAMP') and dict of
+    numbers of rows: 'duplicates' removed, 'reordered' (timestamps found
+    earlier than the one before them) and 'trimmed' from outside the study
+    duration
+    """
+    stats = dict(duplicates=0, reordered=0, trimmed=0)
+    ts = df.index.asi8
+    if ts is None: # index not parsed as timestamps
+        ts = to_datetime(df.index).asi8
+    take = None
+    if len(ts) > 1:
+        steps = np.diff(ts)
+        if not (steps > 0).all():
+            stats['reordered'] = int((steps < 0).sum())
+            take = np.argsort(ts, kind='mergesort') # stable: ties in file order
+            ts = ts[take]
+            last = np.ones(len(ts), dtype=bool)
+            last[:-1] = ts[1:] != ts[:-1]
+            if not last.all():
+                if 'RECORD' in df.columns:
+                    # within runs of duplicates only, order by RECORD number
+                    inrun = np.flatnonzero(~last | np.r_[False, ~last[:-1]])
+                    rec = to_numeric(df['RECORD'].values[take[inrun]],
+                                     errors='coerce')
+                    if not np.isnan(rec).any():
+                        take[inrun] = take[inrun[np.lexsort((rec, ts[inrun]))]]
+                stats['duplicates'] = int(len(ts) - last.sum())
+                take, ts = take[last], ts[last]
+
+    start = Timestamp(STUDY_START).value
+    end = (Timestamp(STUDY_END) + Day()).value
+    if len(ts) and (ts[0] < start or ts[-1] >= end):
+        lo, hi = np.searchsorted(ts, [start, end])
+        stats['trimmed'] = int(len(ts) - (hi - lo))
+        take = np.arange(len(ts)) if take is None else take
+        take = take[lo:hi]
+
+    if take is not None:
+        df = df.take(take)
     df.index.name = 'TIMESTAMP'
-    return df
+    return df, stats
 
 
+class HashingReader(object):
+    """Read-only file wrapper which computes md5 checksum of data as read
 
+    Lets a file be hashed in the same pass in which it is parsed, instead of
+    being read a second time. Pass instance wherever a file object is
+    accepted (e.g. ``pandas.read_csv``), then call `hexdigest`.
 
+    Parameters
+    ----------
+    fileobj : file
+        source file object, opened in binary mode
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.name = getattr(fileobj, 'name', None)
+        self.nbytes = 0
+        self._md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self._md5.update(data)
+        self.nbytes += len(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self.fileobj.readline(size)
+        self._md5.update(data)
+        self.nbytes += len(data)
+        return data
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def hexdigest(self):
+        """Return md5 of entire file; any unread remainder is read first"""
+        while self.read(2**20):
+            pass
+        return self._md5.hexdigest()
+
+    def close(self):
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class HashingWriter(object):
+    """Write-only file wrapper which computes md5 checksum of data as written
+
+    Lets a file be hashed as it is written, instead of being read back. The
+    file is written in binary mode with newlines translated as text mode
+    would, so output is the same as writing to the path directly and the
+    checksum is of the bytes on disk.
+
+    Parameters
+    ----------
+    fname : str
+        file to write
+    append : bool
+        if true, data is added to end of existing file. Existing contents
+        are not read, so the checksum of the whole file is unknown and
+        `hexdigest` returns None, unless the file was empty or absent
+    """
+    def __init__(self, fname, append=False):
+        self.name = fname
+        self._md5 = hashlib.md5()
+        self._whole = not (append and os.path.isfile(fname) and
+                           os.path.getsize(fname))
+        self.fileobj = open(fname, mode='ab' if append else 'wb')
+
+    def write(self, data):
+        if os.linesep != '\n':
+            data = data.replace('\n', os.linesep)
+        self._md5.update(data)
+        self.fileobj.write(data)
+
+    def hexdigest(self):
+        """Return md5 of entire file as written so far, or None if unknown
+        (appended to existing contents)"""
+        return self._md5.hexdigest() if self._whole else None
+
+    def close(self):
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class RangeReader(object):
+    """Read-only file wrapper limited to a byte range of the file
+
+    Parameters
+    ----------
+    fileobj : file
+        source file object, opened in binary mode
+    start, stop : int
+        byte offsets of first byte and one past last byte to read
+    """
+    def __init__(self, fileobj, start, stop):
+        self.fileobj = fileobj
+        self.name = getattr(fileobj, 'name', None)
+        self.fileobj.seek(start)
+        self._left = max(stop - start, 0)
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._left:
+            size = self._left
+        data = self.fileobj.read(size)
+        self._left -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self._left:
+            size = self._left
+        data = self.fileobj.readline(size)
+        self._left -= len(data)
+        return data
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ChainReader(object):
+    """Read-only file-like object over strings and/or buffers, which are
+    read one after the other without first being joined (copied) together
+
+    Parameters
+    ----------
+    parts : str or buffer
+        data to read, in order
+    name : str, optional
+        name to report as `name` attribute, e.g. in messages
+    """
+    def __init__(self, *parts, **kwargs):
+        self.name = kwargs.get('name')
+        self._parts = [p for p in parts if len(p)]
+        self._pos = 0 # within first part
+
+    def read(self, size=-1):
+        out = []
+        while self._parts and size != 0:
+            part = self._parts[0]
+            left = len(part) - self._pos
+            n = left if size is None or size < 0 else min(size, left)
+            out.append(part[self._pos:self._pos+n])
+            self._advance(n)
+            if size is not None and size > 0:
+                size -= n
+        return ''.join(out)
+
+    def readline(self, size=-1):
+        out = []
+        while self._parts and size != 0:
+            part = self._parts[0]
+            n = len(part) - self._pos
+            if size is not None and size >= 0:
+                n = min(size, n)
+            chunk = part[self._pos:self._pos+min(n, 2**16)]
+            nl = chunk.find('\n')
+            if nl >= 0:
+                chunk = chunk[:nl+1]
+            out.append(chunk)
+            self._advance(len(chunk))
+            if nl >= 0:
+                break
+            if size is not None and size > 0:
+                size -= len(chunk)
+        return ''.join(out)
+
+    def _advance(self, n):
+        self._pos += n
+        if self._pos >= len(self._parts[0]):
+            self._parts.pop(0)
+            self._pos = 0
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        self._parts = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+ROW_INDEX_STEP = 1000 # data lines between entries of row index
+
+
+class RowIndex(object):
+    """Byte offsets of every `step`-th data line of standard format file
+
+    Kept in a small sidecar file (data file name plus '.idx') so readers can
+    seek straight to a period of interest instead of parsing the whole file.
+    Use `build` to index a file, `extend` after appending lines to it and
+    `load` to read a saved index, which returns None unless the index still
+    matches the data file.
+
+    Attributes
+    ----------
+    path : str
+        data file
+    step : int
+        data lines between index entries
+    size : int
+        bytes of data file indexed (always the end of a line)
+    nrows : int
+        data lines in indexed part of file
+    stamps, offsets : list
+        timestamp (as written) & byte offset of data lines 0, step, 2*step...
+    """
+    magic = 'ROWINDEX 1'
+
+    def __init__(self, path, step=ROW_INDEX_STEP):
+        self.path = path
+        self.step = step
+        self.size = 0
+        self.nrows = 0
+        self.stamps = []
+        self.offsets = []
+        self._parsed = None
+
+    @staticmethod
+    def sidecar(path):
+        """Return name of index file for data file `path`"""
+        return path + '.idx'
+
+    @classmethod
+    def build(cls, path, step=ROW_INDEX_STEP):
+        """Return new index of data file at `path`"""
+        index = cls(path, step)
+        with open(path, mode='rb') as f:
+            index.size = len(f.readline()) # skip column headers
+        index.extend()
+        return index
+
+    def extend(self, blocksize=2**22):
+        """Index data lines added to end of file since last indexed"""
+        new = []
+        with open(self.path, mode='rb') as f:
+            f.seek(self.size)
+            base = start = self.size
+            row = self.nrows
+            while True:
+                block = f.read(blocksize)
+                if not block:
+                    break
+                ends = np.flatnonzero(np.frombuffer(block, np.uint8) == 10)
+                if len(ends):
+                    ends += base
+                    starts = np.concatenate([[start], ends[:-1]+1])
+                    first = -row % self.step
+                    new.extend(starts[first::self.step].tolist())
+                    row += len(ends)
+                    start = int(ends[-1]) + 1
+                base += len(block)
+            # trailing partial line, if any, is left unindexed
+            for offset in new:
+                f.seek(offset)
+                self.stamps.append(f.read(32).split(',', 1)[0])
+        self.offsets.extend(new)
+        self.size, self.nrows = start, row
+        self._parsed = None
+
+    def save(self):
+        """Write index to sidecar file, replacing any existing one"""
+        fname = self.sidecar(self.path)
+        tempname = fname + '~0'
+        with open(tempname, mode='wb') as f:
+            f.write('%s\n%d,%d,%d\n' % (self.magic, self.step, self.nrows,
+                                        self.size))
+            for stamp, offset in zip(self.stamps, self.offsets):
+                f.write('%s,%d\n' % (stamp, offset))
+        if os.path.isfile(fname):
+            os.remove(fname)
+        os.rename(tempname, fname)
+
+    @classmethod
+    def load(cls, path):
+        """Return saved index of data file at `path` or None if there is no
+        index or it no longer matches the file"""
+        try:
+            with open(cls.sidecar(path), mode='rb') as f:
+                if f.readline().rstrip() != cls.magic:
+                    return None
+                step, nrows, size = [int(x) for x in f.readline().split(',')]
+                index = cls(path, step)
+                index.nrows, index.size = nrows, size
+                for line in f:
+                    stamp, offset = line.rstrip().rsplit(',', 1)
+                    index.stamps.append(stamp)
+                    index.offsets.append(int(offset))
+        except (IOError, ValueError):
+            return None
+        if not index.is_valid():
+            return None
+        return index
+
+    def is_valid(self):
+        """Return truth of whether index matches data file, going by size and
+        the timestamps at first and last offsets"""
+        try:
+            if os.path.getsize(self.path) != self.size:
+                return False
+            with open(self.path, mode='rb') as f:
+                for i in set([0, len(self.offsets)-1]) - set([-1]):
+                    f.seek(self.offsets[i])
+                    if f.read(len(self.stamps[i])+1) != self.stamps[i]+',':
+                        return False
+        except (IOError, OSError):
+            return False
+        return True
+
+    def span(self, start, end):
+        """Return (begin, stop) byte range of data lines which includes all
+        those with timestamps between `start` and `end` (inclusive); may
+        include lines outside the period, up to `step` at either end"""
+        if not self.offsets:
+            return self.size, self.size
+        if self._parsed is None:
+            self._parsed = to_datetime(self.stamps).values
+        start, end = to_datetime([start, end]).values
+        lo = np.searchsorted(self._parsed, start, 'right') - 1
+        hi = np.searchsorted(self._parsed, end, 'right')
+        begin = self.offsets[max(lo, 0)]
+        stop = self.offsets[hi] if hi < len(self.offsets) else self.size
+        return begin, stop
+
+
+def move_row_index(src, dst):
+    """Move row index of data file `src` to go with `dst` (the same file,
+    renamed), removing any index of the file previously at `dst`"""
+    old, new = RowIndex.sidecar(src), RowIndex.sidecar(dst)
+    if os.path.isfile(new):
+        os.remove(new)
+    if os.path.isfile(old):
+        os.rename(old, new)
+
+
+class FileLock(object):
+    """Advisory lock on a file path, for use by cooperating processes
+
+    The lock is held by exclusively creating a lock file alongside the
+    target (same name plus ``.lock``) and released by deleting it; this
+    works on local and network (SMB) drives alike. Use as context manager:
+
+        >>> with FileLock(outpath):
+        ...     # read-modify-write outpath
+
+    The lock file holds "<pid>@<host>" of its owner, which refreshes its
+    modification time every quarter of `stale` seconds while the lock is
+    held. A lock file left behind by a process which was killed or crashed
+    is broken (deleted) when found: if made on this host by a process which
+    is no longer running (on POSIX systems, where this is the only test for
+    such locks) or else if not refreshed for `stale` seconds.
+
+    Parameters
+    ----------
+    path : str
+        path of file to be protected; need not exist yet, but its parent
+        directory is created if necessary
+    timeout : float or None
+        seconds to wait for lock before raising LockTimeoutError or None
+        to wait indefinitely. Default: `LOCK_TIMEOUT`
+    delay : float
+        seconds to wait between attempts to acquire lock. Default: 0.05
+    stale : float or None
+        age of lock file, in seconds, beyond which it is broken or None to
+        never break locks by age (nor refresh them). Default:
+        `LOCK_STALE_AGE`
+    """
+    def __init__(self, path, timeout=LOCK_TIMEOUT, delay=0.05,
+                 stale=LOCK_STALE_AGE):
+        self.path = path
+        self.lockname = path + '.lock'
+        self.timeout = timeout
+        self.delay = delay
+        self.stale = stale
+        self._fd = None
+        self._beat = None # thread refreshing lock file; see `_heartbeat`
+        self._stop = None # set to end it
+
+    def acquire(self):
+        der = os.path.dirname(self.lockname)
+        if der:
+            try:
+                os.makedirs(der)
+            except OSError:
+                if not os.path.isdir(der):
+                    raise
+        start = time.time()
+        while True:
+            try:
+                self._fd = os.open(self.lockname,
+                                   os.O_CREAT | os.O_EXCL | os.O_RDWR)
+                os.write(self._fd, '%d@%s' % (os.getpid(),
+                                              socket.gethostname()))
+                if self.stale is not None:
+                    self._stop = threading.Event()
+                    self._beat = threading.Thread(target=self._heartbeat,
+                                                  args=(self._stop,))
+                    self._beat.daemon = True
+                    self._beat.start()
+                return
+            except OSError as err:
+                if err.errno not in (errno.EEXIST, errno.EACCES):
+                    raise
+            if self._break_stale():
+                continue
+            if self.timeout is not None and time.time()-start > self.timeout:
+                raise LockTimeoutError(
+                    'Could not lock %s within %g seconds: lock file %s is '
+                    'held by %s' % (self.path, self.timeout, self.lockname,
+                                    self._owner() or 'unknown process'))
+            time.sleep(self.delay)
+
+    def _owner(self, fname=None):
+        """Return contents of lock file ("<pid>@<host>"), or None if it
+        can't be read"""
+        try:
+            with open(fname or self.lockname, mode='rb') as f:
+                return f.read(256)
+        except (IOError, OSError):
+            return None
+
+    def _abandoned(self, fname):
+        """Return (owner, age in seconds) of lock file if abandoned by its
+        owner (see class docs), else None"""
+        try:
+            age = time.time() - os.path.getmtime(fname)
+        except OSError:
+            return None # released meanwhile
+        owner = self._owner(fname) or ''
+        pid, _, host = owner.partition('@')
+        if host == socket.gethostname() and pid.isdigit() and (
+                os.name == 'posix'):
+            return None if _pid_running(int(pid)) else (owner, age)
+        if self.stale is not None and age > self.stale:
+            return owner, age
+        return None
+
+    def _break_stale(self):
+        """Delete existing lock file if abandoned by its owner (see class
+        docs); return truth of whether it was deleted"""
+        if self._abandoned(self.lockname) is None:
+            return False
+        # moved aside first, so only one of several waiters takes it, then
+        # checked again: another waiter may have broken the stale lock and
+        # made a fresh one since it was checked
+        broken = '%s~%d' % (self.lockname, os.getpid())
+        try:
+            os.rename(self.lockname, broken)
+        except OSError:
+            return False
+        found = self._abandoned(broken)
+        if found is None:
+            self._restore(broken)
+            return False
+        try:
+            os.remove(broken)
+        except OSError:
+            pass
+        warn('Broke stale lock on %s (held by %s, %d seconds old)'
+             % (self.path, found[0] or 'unknown process', found[1]))
+        return True
+
+    def _restore(self, broken):
+        """Put back lock file moved aside by `_break_stale`, without
+        replacing a lock file made meanwhile"""
+        try:
+            if hasattr(os, 'link'): # POSIX rename would replace it
+                os.link(broken, self.lockname)
+                os.remove(broken)
+            else:
+                os.rename(broken, self.lockname)
+        except OSError:
+            warn('Could not restore lock file %s (held by %s), moved aside '
+                 'as %s' % (self.lockname, self._owner(broken), broken))
+
+    def _heartbeat(self, stop):
+        """Refresh modification time of lock file until `stop` is set, so
+        it isn't taken as abandoned while held"""
+        while not stop.wait(self.stale / 4.):
+            try:
+                os.utime(self.lockname, None)
+            except OSError:
+                pass
+
+    def release(self):
+        if self._fd is None:
+            return
+        if self._beat is not None:
+            self._stop.set()
+            self._beat.join()
+            self._beat = self._stop = None
+        os.close(self._fd)
+        self._fd = None
+        os.remove(self.lockname)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def _pid_running(pid):
+    """Return truth of whether process of this host is running; always true
+    where this can't be told cheaply (Windows)"""
+    if os.name != 'posix':
+        return True # os.kill would terminate it
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno != errno.ESRCH
+    return True
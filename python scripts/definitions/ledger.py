@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""Ledger of raw data files already merged into standard format files
+
+    Each raw file standardized in full is recorded under its md5 checksum,
+    the fingerprint of its TOA5 header (see `fileio.TOA5Header`), the
+    version of the alias & table definitions in use (`definitions_version`)
+    and the output settings (destination path & baling), together with the
+    output files its data was merged into. A later run with the same
+    settings can then skip any file whose contents and definitions are
+    unchanged, provided its output files are still those it was merged
+    into; a run which was interrupted picks up where it stopped, since files
+    are recorded one by one as they are finished.
+
+    Output files are told apart from others of the same name by their
+    generation: the time the ledger was told each was created (see
+    `InputLedger.created`). An output file which was deleted and written
+    afresh is of a new generation, so files merged into its predecessor
+    are no longer considered merged. Output files recreated by programs not
+    using the ledger are not noticed.
+
+        >>> from definitions.ledger import InputLedger
+        >>> ledger = InputLedger()
+        >>> ledger.lookup(header.fingerprint, target, nbytes)
+        {'d41d8cd98f00b204e9800998ecf8427e':
+            {u'/data/CFNT_stats30_2013-05-01.dat': u'2016-03-02T10:15:02'}}
+
+@author: Patrick O'Keeffe <pokeeffe@wsu.edu>
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+
+from datetime import datetime as dt
+
+from paths import INPUT_LEDGER
+from tables import definitions_version
+
+
+_schema = """\
+CREATE TABLE IF NOT EXISTS inputs (
+    md5 TEXT,               -- of raw file contents
+    fingerprint TEXT,       -- md5 of header fingerprint
+    definitions TEXT,       -- `definitions_version`
+    target TEXT,            -- output settings; see `output_target`
+    bytes INTEGER,
+    path TEXT,              -- raw file, as last processed
+    processed TEXT,         -- ISO format, local time
+    bales TEXT,             -- JSON of output file: generation
+    PRIMARY KEY (md5, fingerprint, definitions, target)
+);
+CREATE INDEX IF NOT EXISTS inputs_size ON inputs
+    (fingerprint, definitions, target, bytes);
+CREATE TABLE IF NOT EXISTS bales (
+    path TEXT PRIMARY KEY,  -- absolute path of output file
+    created TEXT            -- generation; ISO format, local time
+);
+"""
+
+
+def output_target(dest_path, baled):
+    """Return text identifying output settings; files processed with other
+    settings are not considered merged"""
+    return json.dumps([os.path.abspath(dest_path or os.curdir), bool(baled)])
+
+
+def _digest(fingerprint):
+    return hashlib.md5(json.dumps(fingerprint)).hexdigest()
+
+
+class InputLedger(object):
+    """Record of raw files merged into output files, backed by SQLite
+
+    Parameters
+    ----------
+    dbfile : str
+        path to database file, created if necessary. Default: `INPUT_LEDGER`
+    definitions : str
+        version of alias & table definitions which entries are looked up and
+        recorded under. Default: `definitions_version`
+    """
+    def __init__(self, dbfile=INPUT_LEDGER, definitions=definitions_version):
+        if definitions is None:
+            raise ValueError('Version of definitions is unknown')
+        der = os.path.dirname(dbfile)
+        if der and not os.path.isdir(der):
+            try:
+                os.makedirs(der)
+            except OSError:
+                if not os.path.isdir(der):
+                    raise
+        self.definitions = definitions
+        self.conn = sqlite3.connect(dbfile, timeout=60)
+        self.conn.executescript(_schema)
+
+    def close(self):
+        self.conn.close()
+
+    def lookup(self, fingerprint, target, nbytes):
+        """Return dict of md5: dict of output file: generation, of files
+        recorded with header fingerprint, output settings (see
+        `output_target`) and size in bytes under current definitions;
+        checking size first means files not seen before need not be read to
+        find their checksum"""
+        rows = self.conn.execute(
+            'SELECT md5, bales FROM inputs WHERE fingerprint = ? AND '
+            'definitions = ? AND target = ? AND bytes = ?',
+            (_digest(fingerprint), self.definitions, target, nbytes))
+        return dict((md5, json.loads(bales)) for md5, bales in rows)
+
+    def record(self, path, md5, fingerprint, target, nbytes, bales):
+        """Record raw file as merged into list of output files, as of their
+        current generations; committed at once, so record survives an
+        interrupted run"""
+        gens = self.generations(bales)
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO inputs VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (md5, _digest(fingerprint), self.definitions, target, nbytes,
+                 os.path.abspath(path), dt.now().isoformat(),
+                 json.dumps(gens, sort_keys=True)))
+
+    def created(self, bales):
+        """Start new generation of each output file in list, which were
+        just written where no file existed"""
+        now = dt.now().isoformat()
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO bales VALUES (?, ?)',
+                                  [(os.path.abspath(b), now) for b in bales])
+
+    def generations(self, bales):
+        """Return dict of output file (absolute path): generation or None if
+        creation is unknown, of output files in list"""
+        gens = {}
+        for bale in bales:
+            bale = os.path.abspath(bale)
+            row = self.conn.execute('SELECT created FROM bales WHERE path = ?',
+                                    (bale,)).fetchone()
+            gens[bale] = row[0] if row else None
+        return gens
+
+    def current(self, bales):
+        """Return True if output files of dict (as from `lookup`) all exist
+        and are of the same generation"""
+        return (all(os.path.isfile(b) for b in bales) and
+                self.generations(bales) == bales)
+
+    def forget(self, path):
+        """Remove records of raw file by path; return number removed"""
+        with self.conn:
+            cur = self.conn.execute('DELETE FROM inputs WHERE path = ?',
+                                    (os.path.abspath(path),))
+        return cur.rowcount
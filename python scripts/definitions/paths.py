@@ -49,3 +49,11 @@ TIMELAPSE_VIDEOS = osp.join(TOWERDATA, 'videos_timelapse') # produced videos
 LOGDIR = osp.join(HOME, r'scripts\logs')
 TELEMETRY_LOG = osp.join(LOGDIR, 'process_new_telemetry_data.log')
 
+# Local (per-machine) caches & indexes; kept off the network share
+LOCAL_CACHE = osp.join(osp.expanduser('~'), r'.reacch_cache')
+CATALOG = osp.join(LOCAL_CACHE, 'archive_catalog.sqlite') # see catalog.py
+HASH_CACHE = osp.join(LOCAL_CACHE, 'md5_cache.sqlite') # see checksums.py
+BENCHMARK_BASELINE = osp.join(LOCAL_CACHE, 'benchmark_baseline.json')
+RUN_HISTORY = osp.join(LOCAL_CACHE, 'run_history.sqlite') # see runs.py
+INPUT_LEDGER = osp.join(LOCAL_CACHE, 'input_ledger.sqlite') # see ledger.py
+
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""Opt-in timing and memory use of stages of processing a file
+
+    Each stage (reading, standardizing, writing, ...) is timed by wrapping
+    it in `StageProfiler.stage`; stages of one input file are grouped by
+    `StageProfiler.file`. A record is appended to a log of JSON lines as
+    each stage and each file finishes:
+
+        {"file": "CFNT_tsdata.dat", "stage": "read", "wall": 1.52,
+         "cpu": 1.49, "peak": 52428800, "maxrss": 301244, "pid": 4242, ...}
+
+    `wall` and `cpu` are seconds; `peak` is the most memory (bytes)
+    allocated during the stage, as traced by `tracemalloc` where available
+    (Python 3.4+ or the pytracemalloc backport; tracing slows processing
+    considerably) and otherwise null; `maxrss` is the high-water mark of the
+    process's resident memory (kB; bytes on Mac OS X) so far, where the
+    `resource` module is available (not Windows). Stage records may carry
+    other fields, e.g. "bale" (output file) and "rows". File records have
+    the totals of each stage in "stages".
+
+    Optionally, the slowest `top` files of each process are also profiled
+    with `cProfile`, and statistics dumped to '<file name>.<pid>.<n>.prof'
+    beside the log, for viewing with `pstats`; `n` counts files profiled by
+    the process, since files of different directories may share a name.
+
+        >>> prof = StageProfiler('profile.jsonl', top=5)
+        >>> with prof.file('CFNT_tsdata.dat'):
+        ...     with prof.stage('read'):
+        ...         df = read_it()
+
+@author: Patrick O'Keeffe <pokeeffe@wsu.edu>
+"""
+
+import cProfile
+import heapq
+import json
+import os
+import time
+
+from contextlib import contextmanager
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+
+class _NullStage(object):
+    """Stand-in for `StageProfiler.stage` when profiling is disabled"""
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc_info):
+        return False
+
+null_stage = _NullStage()
+
+
+def _cpu():
+    """Return CPU time (user + system) of this process, in seconds"""
+    t = os.times()
+    return t[0] + t[1]
+
+
+def _maxrss():
+    """Return resident memory high-water mark of process or None"""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class StageProfiler(object):
+    """Record wall time, CPU time and peak memory of stages of work
+
+    Parameters
+    ----------
+    logfile : str
+        file to which JSON lines are appended; several processes may share
+        one log since each record is written with a single call
+    top : int
+        number of slowest files (per process) to keep `cProfile` statistics
+        for; 0 (default) to not use `cProfile`
+    profile_dir : str
+        directory for statistics files. Default: that of `logfile`
+    """
+    def __init__(self, logfile, top=0, profile_dir=None):
+        self.logfile = logfile
+        self.top = top
+        self.profile_dir = profile_dir or os.path.dirname(logfile)
+        self._out = None
+        self._pid = None
+        self._fname = None # file being processed, if any
+        self._totals = None # by stage, of file being processed
+        self._slowest = [] # heap of (wall time, statistics file)
+        self._nstats = 0 # statistics files written, for unique names
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @property
+    def settings(self):
+        """arguments to create alike profiler, e.g. in another process"""
+        return (self.logfile, self.top, self.profile_dir)
+
+    def emit(self, record):
+        """Append record (dict) to log as line of JSON"""
+        if self._pid != os.getpid(): # don't share handle across fork
+            self._out = open(self.logfile, mode='a')
+            self._pid = os.getpid()
+        record.update(pid=self._pid, time=round(time.time(), 3))
+        self._out.write(json.dumps(record, sort_keys=True) + '\n')
+        self._out.flush()
+
+    @contextmanager
+    def stage(self, name, **fields):
+        """Time stage of work within `with` block; `fields` are added to
+        its record"""
+        if tracemalloc is not None:
+            _reset_peak()
+        base = tracemalloc.get_traced_memory()[0] if tracemalloc else 0
+        wall, cpu = time.time(), _cpu()
+        try:
+            yield
+        finally:
+            wall, cpu = time.time() - wall, _cpu() - cpu
+            peak = (tracemalloc.get_traced_memory()[1] - base
+                    if tracemalloc else None)
+            if self._totals is not None:
+                total = self._totals.setdefault(name, dict(wall=0., cpu=0.,
+                                                           peak=peak))
+                total['wall'] += wall
+                total['cpu'] += cpu
+                if peak is not None:
+                    total['peak'] = max(total['peak'], peak)
+            fields.update(file=self._fname, stage=name, wall=wall, cpu=cpu,
+                          peak=peak, maxrss=_maxrss())
+            self.emit(fields)
+
+    @contextmanager
+    def file(self, fname):
+        """Group stages of work on input file within `with` block; its
+        record has totals of each stage and peak of all stages"""
+        self._fname, self._totals = fname, {}
+        prof = cProfile.Profile() if self.top else None
+        wall, cpu = time.time(), _cpu()
+        if prof is not None:
+            prof.enable()
+        try:
+            yield
+        finally:
+            if prof is not None:
+                prof.disable()
+            wall, cpu = time.time() - wall, _cpu() - cpu
+            peaks = [t['peak'] for t in self._totals.values()
+                     if t['peak'] is not None]
+            self.emit(dict(file=fname, stage='file', wall=wall, cpu=cpu,
+                           peak=max(peaks) if peaks else None,
+                           maxrss=_maxrss(), stages=self._totals))
+            self._fname, self._totals = None, None
+            if prof is not None:
+                self._keep_stats(prof, fname, wall)
+
+    def _keep_stats(self, prof, fname, wall):
+        """Dump profile statistics if among slowest `top` files so far,
+        removing statistics of any file it displaces"""
+        if len(self._slowest) >= self.top:
+            if wall <= self._slowest[0][0]:
+                return
+            old = heapq.heappop(self._slowest)[1]
+            if os.path.isfile(old):
+                os.remove(old)
+        self._nstats += 1
+        statsfile = os.path.join(self.profile_dir, '%s.%d.%d.prof' % (
+            os.path.basename(fname), os.getpid(), self._nstats))
+        prof.dump_stats(statsfile)
+        heapq.heappush(self._slowest, (wall, statsfile))
+
+
+def _reset_peak():
+    """Make peak of traced memory start from current usage"""
+    if hasattr(tracemalloc, 'reset_peak'): # Python 3.9+
+        tracemalloc.reset_peak()
+    else: # resets current usage too; measure peak from zero
+        tracemalloc.clear_traces()
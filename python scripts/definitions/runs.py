@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""Manifests of processing runs and a local history of them
+
+    A `RunManifest` records what one run of `standardize_toa5` (or of the
+    scripts built on it) did: each input file with its size and rows read,
+    each output bale with rows written and whether it was created, merged
+    with an existing file or appended to, files skipped and why, and the
+    overall throughput. Finished manifests are kept in a `RunHistory`, an
+    SQLite database in the local cache, from which throughput trends and
+    regressions can be shown (see `run_history.py`):
+
+        >>> from definitions.runs import RunHistory
+        >>> hist = RunHistory()
+        >>> for run in hist.runs(program='standardize_toa5', limit=10):
+        ...     print run['started'], run['mb_per_s']
+
+@author: Patrick O'Keeffe <pokeeffe@wsu.edu>
+"""
+
+import json
+import os
+import platform
+import sqlite3
+import time
+
+from datetime import datetime as dt
+
+from paths import RUN_HISTORY
+
+
+CREATED = 'created' # actions on output bales; see `RunManifest.wrote`
+MERGED = 'merged'
+APPENDED = 'appended'
+
+
+class RunManifest(object):
+    """Record of inputs, outputs and throughput of a processing run
+
+    Parameters
+    ----------
+    program : str
+        name of program making the run
+    args : dict
+        its settings, e.g. ``vars()`` of parsed arguments; must be
+        serializable as JSON
+    """
+    def __init__(self, program, args=None):
+        self.program = program
+        self.args = args or {}
+        self.started = time.time()
+        self.finished = None
+        self.inputs = {} # file name: dict of bytes, rows, table, tidied
+        self.outputs = {} # file name: dict of table, rows & count of actions
+        self.skipped = [] # (file name, reason)
+
+    def read(self, fname, nbytes=0, rows=0, table=None, tidied=None):
+        """Record input file read: size in bytes, rows of data kept, table
+        name and rows dropped by `fileio.tidy_toa5`, if known"""
+        rec = self.inputs.setdefault(fname, dict(bytes=0, rows=0, table=table,
+                                                 tidied={}))
+        rec['bytes'] += nbytes
+        rec['rows'] += rows
+        for key, num in (tidied or {}).iteritems():
+            rec['tidied'][key] = rec['tidied'].get(key, 0) + num
+
+    def wrote(self, fname, table, rows, action):
+        """Record rows written to output file by action `CREATED`, `MERGED`
+        or `APPENDED`; one file may be written more than once"""
+        rec = self.outputs.setdefault(fname, dict(table=table, rows=0))
+        rec['rows'] += rows
+        rec[action] = rec.get(action, 0) + 1
+
+    def skip(self, fname, reason):
+        """Record input or output file skipped and why"""
+        self.skipped.append((fname, reason))
+
+    def merge(self, other):
+        """Add records of another manifest (e.g. from a worker process)"""
+        for fname, rec in other.inputs.iteritems():
+            self.read(fname, rec['bytes'], rec['rows'], rec['table'],
+                      rec['tidied'])
+        for fname, rec in other.outputs.iteritems():
+            mine = self.outputs.setdefault(fname, dict(table=rec['table'],
+                                                       rows=0))
+            for key, num in rec.iteritems():
+                if key != 'table':
+                    mine[key] = mine.get(key, 0) + num
+        self.skipped.extend(other.skipped)
+
+    def drain(self):
+        """Return manifest of records so far and clear them from this one"""
+        part = RunManifest(self.program, self.args)
+        part.inputs, part.outputs, part.skipped = (self.inputs, self.outputs,
+                                                   self.skipped)
+        self.inputs, self.outputs, self.skipped = {}, {}, []
+        return part
+
+    def finish(self):
+        """Mark run as finished; return self"""
+        self.finished = time.time()
+        return self
+
+    def totals(self):
+        """Return dict of summary figures of run"""
+        secs = (self.finished or time.time()) - self.started
+        nbytes = sum(rec['bytes'] for rec in self.inputs.itervalues())
+        totals = dict(
+            secs=secs,
+            files=len(self.inputs),
+            bytes=nbytes,
+            rows_read=sum(rec['rows'] for rec in self.inputs.itervalues()),
+            rows_written=sum(rec['rows'] for rec in self.outputs.itervalues()),
+            skipped=len(self.skipped),
+            mb_per_s=nbytes/1024./1024./secs if secs else 0.)
+        totals['rows_per_s'] = totals['rows_read']/secs if secs else 0.
+        for action in [CREATED, MERGED, APPENDED]:
+            totals['bales_' + action] = sum(rec.get(action, 0) for rec in
+                                            self.outputs.itervalues())
+        return totals
+
+    def as_dict(self):
+        """Return manifest as dict, serializable as JSON"""
+        def stamp(t):
+            return dt.fromtimestamp(t).isoformat() if t else None
+        return dict(
+            program=self.program,
+            args=self.args,
+            host=platform.node(),
+            pid=os.getpid(),
+            started=stamp(self.started),
+            finished=stamp(self.finished),
+            totals=self.totals(),
+            inputs=[dict(file=f, **rec) for f, rec in
+                    sorted(self.inputs.iteritems())],
+            outputs=[dict(file=f, **rec) for f, rec in
+                     sorted(self.outputs.iteritems())],
+            skipped=[dict(file=f, reason=r) for f, r in self.skipped])
+
+    def save(self, fname):
+        """Write manifest to file as JSON"""
+        with open(fname, mode='w') as f:
+            json.dump(self.as_dict(), f, indent=1, sort_keys=True)
+
+
+_schema = """\
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    program TEXT,
+    started TEXT,           -- ISO format, local time
+    secs REAL,
+    files INTEGER,
+    bytes INTEGER,
+    rows_read INTEGER,
+    rows_written INTEGER,
+    skipped INTEGER,
+    mb_per_s REAL,
+    manifest TEXT           -- JSON of `RunManifest.as_dict`
+);
+CREATE INDEX IF NOT EXISTS runs_program ON runs (program, started);
+"""
+
+_columns = ['program', 'started', 'secs', 'files', 'bytes', 'rows_read',
+            'rows_written', 'skipped', 'mb_per_s']
+
+
+class RunHistory(object):
+    """History of run manifests, backed by SQLite database
+
+    Parameters
+    ----------
+    dbfile : str
+        path to database file, created if necessary. Default: `RUN_HISTORY`
+    """
+    def __init__(self, dbfile=RUN_HISTORY):
+        der = os.path.dirname(dbfile)
+        if der and not os.path.isdir(der):
+            try:
+                os.makedirs(der)
+            except OSError:
+                if not os.path.isdir(der):
+                    raise
+        self.conn = sqlite3.connect(dbfile, timeout=60)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(_schema)
+
+    def close(self):
+        self.conn.close()
+
+    def add(self, manifest):
+        """Store finished `RunManifest`; return ID of run"""
+        d = manifest.as_dict()
+        row = dict(d['totals'], program=d['program'], started=d['started'])
+        with self.conn:
+            cur = self.conn.execute(
+                'INSERT INTO runs (%s, manifest) VALUES (%s, ?)'
+                % (', '.join(_columns), ', '.join('?'*len(_columns))),
+                [row[c] for c in _columns] + [json.dumps(d, sort_keys=True)])
+        return cur.lastrowid
+
+    def runs(self, program=None, limit=None):
+        """Return list of runs (rows of summary figures, without manifest),
+        oldest first; `limit` gives most recent runs only"""
+        sql = 'SELECT id, %s FROM runs' % ', '.join(_columns)
+        params = []
+        if program:
+            sql += ' WHERE program = ?'
+            params.append(program)
+        sql += ' ORDER BY started DESC, id DESC'
+        if limit:
+            sql += ' LIMIT %d' % limit
+        return list(reversed(self.conn.execute(sql, params).fetchall()))
+
+    def manifest(self, run_id):
+        """Return manifest (dict) of run or None if unknown"""
+        row = self.conn.execute('SELECT manifest FROM runs WHERE id = ?',
+                                (run_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+def flag_regressions(runs, window=10, threshold=0.25, min_bytes=0):
+    """Compare throughput of each run with rolling median of those before
+
+    Parameters
+    ----------
+    runs : list
+        runs of one program, oldest first, as from `RunHistory.runs`
+    window : int
+        number of preceding runs of which to take median
+    threshold : float
+        fraction by which throughput must fall below median to be flagged
+    min_bytes : int
+        runs reading less than this are not compared nor used for medians,
+        since their throughput is dominated by start-up costs
+
+    Returns
+    -------
+    list of (run, median MB/s of preceding runs or None, truth of whether
+    run regressed), one per run
+    """
+    results = []
+    recent = []
+    for run in runs:
+        if run['bytes'] < min_bytes or not run['files']:
+            results.append((run, None, False))
+            continue
+        median = None
+        if recent:
+            ordered = sorted(recent)
+            mid = len(ordered) // 2
+            median = (ordered[mid] if len(ordered) % 2 else
+                      (ordered[mid-1] + ordered[mid]) / 2.)
+        slow = median is not None and run['mb_per_s'] < median*(1-threshold)
+        results.append((run, median, slow))
+        recent = (recent + [run['mb_per_s']])[-window:]
+    return results
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""Synthetic TOA5 data files for exercising the standardization scripts
+
+    Files look like those produced by the dataloggers: the four-line TOA5
+    header, quoted timestamps, "NAN" for missing values and text columns
+    (CompileResults, CardStatus) of free text. The usual blemishes
+    of real data can be injected: gaps, duplicate records from overlapping
+    downloads and blocks of records out of order.
+
+    Write one file:
+
+        >>> from definitions.synthetic import write_toa5
+        >>> write_toa5('CFNT_stats30.dat', 'stats30', '2013-05-15 22:00',
+        ...            periods=1000, gaps=2, duplicates=0.01, shuffled=1)
+
+    or a file for each current and historical table name (see `corpus`):
+
+        >>> from definitions.synthetic import write_corpus
+        >>> flist = write_corpus('/tmp/corpus', scale=0.1)
+
+@author: Patrick O'Keeffe <pokeeffe@wsu.edu>
+"""
+
+import os
+
+from collections import Counter
+from csv import QUOTE_NONNUMERIC
+
+import numpy as np
+
+from pandas import DataFrame, DatetimeIndex, Timedelta, Timestamp
+from pandas.tseries.frequencies import to_offset
+
+from sites import site_list
+from tables import (table_definitions, table_baleinfo, col_alias,
+                    historical_table_names, resolved_names)
+
+
+CORPUS_START = '2013-05-15 22:00' # files cross daily & monthly bale edges
+TEXT_COLUMNS = ['CompileResults', 'CardStatus']
+NAN_FRACTION = 0.01 # of values written as "NAN"
+
+# days of data in a file of table recorded at freq (None: irregular)
+CORPUS_DAYS = {'100L' : 1, '5T' : 31, '30T' : 31, 'D' : 90, None : 31}
+
+
+def table_columns(table):
+    """Return column names of current or historical table, in file order
+
+    Current tables are in order of `table_definitions`; the order of columns
+    of historical tables is not recorded, so they are in order of name after
+    TIMESTAMP and RECORD."""
+    if table in table_definitions:
+        return list(table_definitions[table])
+    if table not in historical_table_names:
+        raise ValueError('Unknown table: %s' % table)
+    cols = sorted(c for (t, c) in col_alias if t == table
+                  and c not in ['TIMESTAMP', 'RECORD'])
+    return ['TIMESTAMP', 'RECORD'] + cols
+
+
+def table_freq(table):
+    """Return recording interval of current or historical table (as in
+    `table_baleinfo`; None if irregular), from the table most of its
+    columns now belong to"""
+    if table in table_baleinfo:
+        return table_baleinfo[table][3]
+    targets = Counter(resolved_names.get((table, c), (None, None))[0]
+                      for c in table_columns(table)[2:])
+    for tbl, num in targets.most_common():
+        if tbl in table_baleinfo:
+            return table_baleinfo[tbl][3]
+    return '30T'
+
+
+def write_toa5(fname, table, start, periods=None, end=None, freq=None,
+               site='CFNT', gaps=0, duplicates=0, shuffled=0, seed=None):
+    """Write synthetic TOA5 data file
+
+    Parameters
+    ----------
+    fname : str
+        output file name
+    table : str
+        current or historical table name; sets columns and, unless `freq`
+        is given, recording interval (see `table_columns`, `table_freq`)
+    start : str or datetime-like
+        first timestamp, rounded up to the recording interval
+    periods, end :
+        number of records or last timestamp; one is required
+    freq : str
+        recording interval, if other than that of table. Irregular tables
+        (freq of None) get records 1 to 12 hours apart
+    site : str
+        4-char site code, from which the logger serial number is taken
+    gaps : int
+        number of runs of missing records, each about 1% of the file
+    duplicates : float
+        fraction of records written twice, as one block repeated later in
+        file as by an overlapping download
+    shuffled : int
+        number of pairs of adjacent blocks (about 0.5% of file each) written
+        in reverse order
+    seed : int
+        seed of random number generator, for repeatable output
+
+    Returns
+    -------
+    number of data lines written
+    """
+    rng = np.random.RandomState(seed)
+    columns = table_columns(table)
+    freq = freq or table_freq(table)
+    tstamps = _timestamps(rng, start, periods, end, freq)
+    nrows = len(tstamps)
+
+    rows = np.arange(nrows)
+    for i in range(gaps):
+        width = max(1, nrows // 100)
+        at = rng.randint(0, max(1, nrows - width))
+        rows = rows[(rows < at) | (rows >= at + width)]
+    for i in range(shuffled):
+        width = max(1, len(rows) // 200)
+        at = rng.randint(0, max(1, len(rows) - 2*width))
+        rows = np.concatenate([rows[:at], rows[at+width:at+2*width],
+                               rows[at:at+width], rows[at+2*width:]])
+    ndup = int(len(rows) * duplicates)
+    if ndup:
+        at = rng.randint(0, len(rows) - ndup + 1)
+        later = rng.randint(at + ndup, len(rows) + 1)
+        rows = np.concatenate([rows[:later], rows[at:at+ndup], rows[later:]])
+
+    data = DataFrame(index=_format_stamps(tstamps[rows]))
+    data['RECORD'] = rows
+    for col in columns[2:]:
+        if col in TEXT_COLUMNS:
+            values = np.array(['Card OK. %d bytes free' % n for n in
+                               rng.randint(10**6, 10**9, size=5)],
+                              dtype=object)[rng.randint(0, 5, size=len(rows))]
+        else:
+            values = np.round(rng.normal(rng.uniform(-50, 500),
+                                         rng.uniform(0.1, 20),
+                                         size=len(rows)), 4)
+            values[rng.random_sample(len(rows)) < NAN_FRACTION] = np.nan
+        data[col] = values
+
+    serial = [s.serial_num for s in site_list if s.code == site][0]
+    der = os.path.dirname(fname)
+    if der and not os.path.isdir(der):
+        os.makedirs(der)
+    with open(fname, mode='wb') as f:
+        f.write('"TOA5","%s","CR3000","%s","CR3000.Std.11","CPU:%s.CR3",'
+                '"12345","%s"\r\n' % (site, serial, site.lower(), table))
+        for line in [columns,
+                     ['TS', 'RN'] + ['' for c in columns[2:]],
+                     ['', ''] + ['Smp' for c in columns[2:]]]:
+            f.write(','.join('"%s"' % c for c in line) + '\r\n')
+        data.to_csv(f, header=False, na_rep='NAN', quoting=QUOTE_NONNUMERIC,
+                    line_terminator='\r\n')
+    return len(rows)
+
+
+def _timestamps(rng, start, periods, end, freq):
+    """Return DatetimeIndex of records, regular unless freq is None"""
+    if periods is None and end is None:
+        raise ValueError('One of periods or end is required')
+    if freq is not None:
+        step = to_offset(freq).nanos
+        first = -(-Timestamp(start).value // step) * step # round up
+        if periods is None:
+            periods = (Timestamp(end).value - first) // step + 1
+        return DatetimeIndex(first + np.arange(periods, dtype=np.int64)*step)
+    hours = Timedelta(hours=1).value
+    if periods is None:
+        periods = int((Timestamp(end) - Timestamp(start)).value // hours)
+    steps = rng.randint(1, 13, size=periods).astype(np.int64) * hours
+    steps[0] = 0
+    tstamps = Timestamp(start).value + np.cumsum(steps)
+    if end is not None:
+        tstamps = tstamps[tstamps <= Timestamp(end).value]
+    return DatetimeIndex(tstamps)
+
+
+def _format_stamps(tstamps):
+    """Return timestamps as formatted by the dataloggers: whole seconds,
+    or tenths where not zero"""
+    stamps = np.datetime_as_string(tstamps.values.astype('M8[ms]'))
+    stamps = np.char.replace(stamps.astype('S21'), 'T', ' ')
+    whole = np.char.endswith(stamps, '.0')
+    stamps[whole] = stamps[whole].astype('S19')
+    return stamps.astype(object)
+
+
+def corpus(scale=1.0):
+    """Return list of (table, freq, number of records) of a corpus with a
+    file for every table in `table_definitions` and every historical table
+    name in `col_alias`, each holding `scale` times the data in `CORPUS_DAYS`
+    (e.g. a day of 10 Hz tsdata, a month of stats5 & stats30)"""
+    tables = []
+    for table in sorted(set(table_definitions) | historical_table_names):
+        freq = table_freq(table)
+        span = Timedelta(days=CORPUS_DAYS.get(freq, 31)) * scale
+        if freq is None:
+            periods = int(span / Timedelta(hours=6.5)) # mean interval
+        else:
+            periods = int(span / Timedelta(to_offset(freq).nanos))
+        tables.append((table, freq, max(periods, 3)))
+    return tables
+
+
+def write_corpus(dest, scale=1.0, site='CFNT', start=CORPUS_START, seed=0):
+    """Write corpus of synthetic TOA5 files into directory (see `corpus`)
+
+    Each file has gaps, duplicate records and records out of order. Files
+    are named as by LoggerNet, '<site>_<table>.dat'.
+
+    Returns
+    -------
+    list of (file name, table, number of data lines)
+    """
+    written = []
+    for num, (table, freq, periods) in enumerate(corpus(scale)):
+        fname = os.path.join(dest, '%s_%s.dat' % (site, table))
+        nlines = write_toa5(fname, table, start, periods=periods, site=site,
+                            gaps=2, duplicates=0.01, shuffled=1,
+                            seed=seed + num)
+        written.append((fname, table, nlines))
+    return written
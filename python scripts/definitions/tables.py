@@ -7,9 +7,17 @@
 @author: Patrick O'Keeffe <pokeeffe@wsu.edu>
 """
 
+import os
+import cPickle as pickle
+
 from copy import copy
+from hashlib import md5
+from warnings import warn
+
 from pandas.tseries.offsets import Day, MonthBegin
 
+from paths import LOCAL_CACHE
+
 
 class ColumnNotFoundError(Exception): pass
 """Raised when look up of nonexistant column is attempted"""
@@ -82,25 +90,18 @@ def current_names(table, column):
     column name of a given column is. So long as the dictionary is correct,
     things are gravy, and despite being long, the dictionary is simple.
     Additionally, there are internal functions for checking the validity of
-    the dictionary -- run (double-click) the source file to use them, they
-    take too long to be suitable for running upon import.
+    the dictionary -- run (double-click) the source file to use them.
+
+    Rather than walk the dictionary on every call, all keys are resolved
+    once by `compile_col_alias` (see `resolved_names`) so each look-up is a
+    single dictionary access.
     """
     try:
-        tbl, col = col_alias[(table, column)]
+        return resolved_names[(table, column)]
     except KeyError:
         #print ('>>>> Unable to find historical names for column "%s" of table "%s"'
         #        % (column, table))
         raise ColumnNotFoundError
-    if (tbl, col) == (None, None):
-        return (None, None)
-    elif (tbl, col) == ('', ''):
-        return (table, column)
-    elif tbl == '':
-        return current_names(table, col)
-    elif col == '':
-        return current_names(tbl, column)
-    else:
-        return current_names(tbl, col)
 
 
 
@@ -1241,24 +1242,128 @@ For example:
 historical_table_names = set([ k[0] for (k,v) in col_alias.iteritems()])
 
 
+def compile_col_alias(aliases):
+    """Resolve every key of column alias dict to current (table, column)
+
+    Follows the links of the alias dictionary (see `col_alias`) from each
+    key to its current names, memoizing as it goes so every entry is
+    visited once regardless of how long the chains are.
+
+    Parameters
+    ----------
+    aliases : dict
+        mapping of (table, column) to superceding (table, column) pairs,
+        structured like `col_alias`
+
+    Returns
+    -------
+    2-tuple of: dict mapping each resolvable key to the current (table,
+    column) names or ``(None, None)`` if dropped; and a list of (key,
+    message) tuples describing keys which could not be resolved because
+    their chain leads to a missing key (dangling link) or back to itself
+    (cycle)
+    """
+    resolved = {}
+    errors = []
+    failed = {}
+    for key in aliases:
+        path = []
+        onpath = set()
+        node = key
+        while True:
+            if node in resolved:
+                result, err = resolved[node], None
+                break
+            if node in failed:
+                result, err = None, failed[node]
+                break
+            if node in onpath:
+                result, err = None, 'cycle through "%s:%s"' % node
+                break
+            try:
+                tbl, col = aliases[node]
+            except KeyError:
+                result, err = None, 'dangling link to "%s:%s"' % node
+                break
+            if (tbl, col) == (None, None):
+                result, err = (None, None), None
+                resolved[node] = result
+                break
+            elif (tbl, col) == ('', ''):
+                result, err = node, None
+                resolved[node] = result
+                break
+            path.append(node)
+            onpath.add(node)
+            node = (tbl or node[0], col or node[1])
+        for each in path:
+            if err is None:
+                resolved[each] = result
+            else:
+                failed[each] = err
+        if err is not None:
+            errors.append((key, err))
+    return resolved, sorted(errors)
+
+
+def _source_digest():
+    """Return md5 hex digest of this module's source or None if unavailable"""
+    try:
+        with open(os.path.splitext(__file__)[0]+'.py', mode='rb') as f:
+            return md5(f.read()).hexdigest()
+    except IOError:
+        return None
 
 
-def _verify_col_alias():
+definitions_version = _source_digest()
+"""Hash of table & column definitions; changes whenever this file does"""
+
+
+def _load_compiled_col_alias():
+    """Return result of `compile_col_alias`, cached on disk between runs
+
+    Cache file is kept in `LOCAL_CACHE` and named using `definitions_version`
+    so changes to the alias dictionary are always picked up."""
+    if definitions_version is None:
+        return compile_col_alias(col_alias)
+    cachefile = os.path.join(LOCAL_CACHE,
+                             'col_alias_%s.pkl' % definitions_version)
+    try:
+        with open(cachefile, mode='rb') as f:
+            return pickle.load(f)
+    except Exception:
+        pass
+    compiled = compile_col_alias(col_alias)
+    tempname = '%s~%d' % (cachefile, os.getpid())
+    try:
+        if not os.path.isdir(LOCAL_CACHE):
+            os.makedirs(LOCAL_CACHE)
+        with open(tempname, mode='wb') as f:
+            pickle.dump(compiled, f, pickle.HIGHEST_PROTOCOL)
+        if os.path.isfile(cachefile):
+            os.remove(cachefile)
+        os.rename(tempname, cachefile)
+    except (IOError, OSError):
+        pass
+    return compiled
+
+
+resolved_names, col_alias_errors = _load_compiled_col_alias()
+"""Current (table, column) names for every resolvable key in `col_alias`
+and list of (key, message) tuples for those which are not"""
+
+
+def _verify_col_alias(quiet=False):
     """Follow all past column names to current name to verify lookup table
 
     Return truth of whether column lookup table is free of missing data
     """
-    # TODO make output shown only for errors
-    errs = ''
+    errs = ''.join(['- unable to complete lookup for table:column "%s:%s" '
+                    '(%s)\n' % (st, sc, msg)
+                    for ((st, sc), msg) in col_alias_errors])
+    if quiet:
+        return not errs
     print ('Verifying column alias dictionary...\n')
-    for (st, sc) in sorted(col_alias):
-        try:
-            dt, dc = current_names(st, sc)
-        except KeyError:
-            errs = errs + ('- unable to complete lookup for table:column '
-                '"%s:%s"\n' % (st, sc))
-            continue
-        #print (('%s:%s' % (st, sc)).ljust(39) + ('%s:%s\n' % (dt,dc)))
     if errs:
         print ('\nWARNINGS:\n'+errs+'\n')
         return False
@@ -1267,26 +1372,26 @@ def _verify_col_alias():
         return True
 
 
-def _verify_table_definitions():
+def _verify_table_definitions(quiet=False):
     """Attempt to look up each column in header definition
 
     Return truth of whether all defined headers are current based on col_alias
     """
-    # TODO make output shown only for errors
     errmsg = ''
-    print ('Verifying column order defintions...\n')
     for tbl in table_definitions:
         for col in table_definitions[tbl]:
             try:
                 t, c = current_names(tbl, col)
-            except KeyError:
+            except ColumnNotFoundError:
                 errmsg = errmsg + ('- header definition "%s:%s" not found in '
                     'lookup table\n' % (tbl, col))
                 continue
-            #print (('%s:%s' % (tbl, col)).ljust(39) + ('%s:%s\n' % (t,c)))
             if (t != tbl) or (c != col):
                 errmsg = errmsg + ('- header definition "%s:%s" does not '
                     'match lookup table "%s:%s"\n' % (tbl, col, t, c))
+    if quiet:
+        return not errmsg
+    print ('Verifying column order defintions...\n')
     if errmsg:
         print ('WARNINGS:\n'+errmsg+'\n')
         return False
@@ -1295,6 +1400,15 @@ def _verify_table_definitions():
         return True
 
 
+# checks are cheap now that aliases are pre-resolved, so always run them
+if not _verify_col_alias(quiet=True):
+    warn('Column alias dictionary (col_alias) has unresolvable entries; '
+         'run definitions/tables.py for details')
+if not _verify_table_definitions(quiet=True):
+    warn('Table definitions (table_definitions) do not match column alias '
+         'dictionary; run definitions/tables.py for details')
+
+
 if __name__ == '__main__':
     ans = raw_input('This module is not designed for standalone operation. '
                     'Proceed with self-test routine? [Y]es else no:')
@@ -2,23 +2,53 @@
 """
 Simple script for creating an md5sum file
 
-Created 2014-07-09 
+Created 2014-07-09
 Updated 2014-08-25 to not prompt user
 
 Patrick O'Keeffe <pokeeffe@wsu.edu>
 
+Files are hashed several at a time (see `definitions.checksums`) and
+checksums of files unchanged since last hashed on this machine are taken
+from a local cache instead of re-reading them; use --nocache to force.
+
+Verify files against existing md5sums file(s) with --verify; mismatched,
+missing and new (unlisted) files are reported. Verification always reads
+every file.
+
+Bookkeeping files are never hashed nor reported, in any directory: the
+per-directory `md5sums` manifests kept by standardize_toa5.py, row index
+sidecars (`*.idx`), lock files (`*.lock`) and temporary files (`*~0`); see
+`IGNORE`.
+
+Alongside `md5sums`, a file `md5sums.dirs` of per-directory digests (see
+`definitions.checksums.dir_digests`) is written. Two copies of a tree, e.g.
+the archive and its backup, can be compared from these with --compare,
+which descends only into directories whose digests differ.
+
 TODO:
-- skip files if no longer exist when trying to hash
-- support CLI parameters: block size, output file name, explicit base 
-    directory
-- ability to verify against existing md5sums files
-- make output of md5sums files optional & add ability to write output to 
+- support CLI parameters: output file name, explicit base directory
+- make output of md5sums files optional & add ability to write output to
     stdout without prompts for batch processing
 """
 
 import os, os.path as osp
-import sys, hashlib
-from time import sleep
+import sys
+from argparse import ArgumentParser
+from fnmatch import fnmatch
+from time import sleep, time
+
+from definitions.checksums import (hash_files, read_md5sums, HashCache,
+                                   dir_digests, write_dir_digests,
+                                   read_dir_digests, compare_trees,
+                                   BLOCKSIZE, DEFAULT_JOBS)
+
+# bookkeeping files, skipped at every level: md5sums files (and backups),
+# row indexes, locks (also those being broken) and temporary output files
+IGNORE = ['md5sums*', '*.idx', '*.lock', '*.lock~*', '*~0']
+
+def ignored(fname):
+    return any(fnmatch(osp.basename(fname), pat) for pat in IGNORE)
+
 
 def sort_by_directory(filelist):
     dirs = {}
@@ -32,27 +62,30 @@ def sort_by_directory(filelist):
     return sort
 
 
-if __name__ == '__main__':
-    here = osp.abspath(osp.dirname(sys.argv[0])) + osp.sep
+def _rate(nbytes, elapsed):
+    return '%.1f MB in %.1f s (%.1f MB/s)' % (nbytes/1e6, elapsed,
+                                              nbytes/1e6/max(elapsed, 1e-6))
+
+
+def generate(paths, jobs=DEFAULT_JOBS, blocksize=BLOCKSIZE, use_cache=True):
+    """Write md5sums file in common parent folder of files in `paths`"""
     dirs_to_search = set()
     files_to_hash = set()
-
-    args = sys.argv[1:]
-    if not args: 
-        dirs_to_search.add(here)
-    for arg in args:
+    for arg in paths:
         if os.path.isdir(arg): dirs_to_search.add(arg)
         if os.path.isfile(arg): files_to_hash.add(arg)
 
     for dir in dirs_to_search:
         for path, dirs, files in os.walk(dir):
-            files_to_hash.update([osp.join(path, f) for f in files])
+            files_to_hash.update([osp.join(path, f) for f in files
+                                  if not ignored(f)])
 
     basedir = osp.dirname(osp.commonprefix(files_to_hash))+os.sep
     md5file = osp.join(basedir, 'md5sums')
 
     files_to_hash.discard(osp.abspath(sys.argv[0]))
-    files_to_hash.discard(md5file)
+    for each in [md5file, md5file+'.bak', md5file+'.dirs']:
+        files_to_hash.discard(each)
     filelist = sort_by_directory(files_to_hash)
 
     print 'Preparing to generate md5 checksums...'
@@ -62,7 +95,7 @@ if __name__ == '__main__':
         print ' ', each.replace(basedir, '')
     print 'Output file name:', md5file
 
-    if osp.isfile(md5file): 
+    if osp.isfile(md5file):
         print '  * Detected file `md5sums` already exists, renaming to `md5sums.bak`'
         try:
             os.rename(md5file, md5file+".bak")
@@ -74,29 +107,144 @@ if __name__ == '__main__':
             except OSError as e:
                 print '  ! Could not replace existing backup'
 
-    blocksize = 2**20
+    cache = HashCache() if use_cache else None
+    hashes = {}
+    nbytes, ncached, started = 0, 0, time()
+    for each, hash, size, cached, err in hash_files(filelist, jobs=jobs,
+                                                    cache=cache,
+                                                    blocksize=blocksize):
+        if err:
+            print 'Encountered IO error, skipping %s' % each
+            continue
+        hashes[each] = hash
+        nbytes += size
+        ncached += cached
+        print hash+'  '+each.replace(basedir, '')
+    if cache is not None:
+        cache.close()
+
+    # written in directory order regardless of order hashed
+    entries = [(hashes[each], each.replace(basedir, ''))
+               for each in filelist if each in hashes]
+    with open(md5file, mode='w') as md5sums:
+        for hash, name in entries:
+            md5sums.write(hash+'  '+name+'\n')
+    write_dir_digests(md5file+'.dirs', dir_digests(entries))
+    print '\nHashed %d files (%d from cache): %s' % (len(hashes), ncached,
+                                                    _rate(nbytes, time()-started))
+
+
+def verify(md5file, jobs=DEFAULT_JOBS, blocksize=BLOCKSIZE):
+    """Check files against md5sums file; return number of problems found"""
+    basedir = osp.dirname(osp.abspath(md5file))
+    print 'Verifying files listed in', md5file
+    expected = {}
+    for hash, name in read_md5sums(md5file):
+        name = name.replace('\\', os.sep).replace('/', os.sep)
+        if not ignored(name):
+            expected[osp.join(basedir, name)] = hash
+
+    ignore = set([osp.abspath(md5file), osp.abspath(md5file)+'.bak',
+                  osp.abspath(md5file)+'.dirs', osp.abspath(sys.argv[0])])
+    new = []
+    for path, dirs, files in os.walk(basedir):
+        for f in files:
+            each = osp.join(path, f)
+            if (each not in expected and each not in ignore and
+                    not ignored(f)):
+                new.append(each)
+
+    mismatched, missing = [], []
+    nbytes, started = 0, time()
+    for each, hash, size, cached, err in hash_files(
+            sort_by_directory(expected), jobs=jobs, blocksize=blocksize):
+        nbytes += size
+        if err:
+            missing.append(each)
+        elif hash != expected[each]:
+            mismatched.append(each)
+    elapsed = time()-started
+
+    for label, flist in [('MISMATCHED', mismatched), ('MISSING', missing),
+                         ('NEW', new)]:
+        for each in sort_by_directory(flist):
+            print '  %-10s %s' % (label, each.replace(basedir+os.sep, ''))
+    print ('%d files OK, %d mismatched, %d missing, %d new: %s'
+           % (len(expected)-len(mismatched)-len(missing), len(mismatched),
+              len(missing), len(new), _rate(nbytes, elapsed)))
+    return len(mismatched) + len(missing) + len(new)
+
+
+def compare(md5file_a, md5file_b):
+    """Compare two copies of a tree by their md5sums (and md5sums.dirs)
+    files; return number of files which differ"""
+    trees = []
+    for md5file in [md5file_a, md5file_b]:
+        digests = None
+        if (osp.isfile(md5file+'.dirs') and # not if md5sums rewritten since
+                osp.getmtime(md5file+'.dirs') >= osp.getmtime(md5file)):
+            digests = read_dir_digests(md5file+'.dirs')
+        trees.append((read_md5sums(md5file), digests))
+    print 'A:', md5file_a
+    print 'B:', md5file_b
+    found = compare_trees(trees[0][0], trees[1][0], trees[0][1], trees[1][1])
+    for status, name in found:
+        print '  %-10s %s' % (status.upper(), name)
+    print '%d files differ' % len(found)
+    return len(found)
+
+
+if __name__ == '__main__':
+    here = osp.abspath(osp.dirname(sys.argv[0])) + osp.sep
+
+    p = ArgumentParser(description='Create or verify md5sums file')
+    p.add_argument('paths', nargs='*',
+                   help=('files/directories to hash; with --verify, md5sums '
+                         'files or directories holding them. Default: '
+                         'directory of this script'))
+    p.add_argument('--verify', action='store_true',
+                   help='check files against existing md5sums file(s)')
+    p.add_argument('--compare', metavar='OTHER',
+                   help=('compare tree against copy with md5sums file OTHER '
+                         '(or directory holding it), using stored digests'))
+    p.add_argument('-j', '--jobs', type=int, default=DEFAULT_JOBS,
+                   help='files to hash at once (default: %d)' % DEFAULT_JOBS)
+    p.add_argument('-b', '--blocksize', type=int, default=BLOCKSIZE,
+                   help='bytes to read at a time (default: %d)' % BLOCKSIZE)
+    p.add_argument('--nocache', action='store_true',
+                   help='re-read all files instead of using cached checksums')
+    p.add_argument('--nowait', action='store_true',
+                   help='exit immediately when done')
+    args = p.parse_args()
+    paths = args.paths or [here]
+
+    if args.compare:
+        md5files = []
+        for arg in [paths[0], args.compare]:
+            if osp.isdir(arg):
+                arg = osp.join(arg, 'md5sums')
+            md5files.append(arg)
+        sys.exit(1 if compare(*md5files) else 0)
+
+    if args.verify:
+        problems = 0
+        for arg in paths:
+            if osp.isdir(arg):
+                arg = osp.join(arg, 'md5sums')
+            problems += verify(arg, jobs=args.jobs, blocksize=args.blocksize)
+        sys.exit(1 if problems else 0)
+
     try:
-        with open(md5file, mode='w') as md5sums:
-            for each in filelist:
-                md5 = hashlib.md5()
-                hashname = each.replace(basedir, '')
-                try:
-                    with open(each, mode='rb') as srcfile:
-                        block = srcfile.read(blocksize)
-                        while len(block) > 0:
-                            md5.update(block)
-                            block = srcfile.read(blocksize)
-                except IOError:
-                    print 'Encountered IO error, skipping %s' % each
-                    continue
-                hash = md5.hexdigest()
-                line = hash+'  '+hashname+'\n'
-                print line,
-                md5sums.write(line)
+        generate(paths, jobs=args.jobs, blocksize=args.blocksize,
+                 use_cache=not args.nocache)
     except Exception as e:
-        raw_input('\nAn unrecoverable exception occurred:\n' + str(e) + 
+        if args.nowait:
+            raise
+        raw_input('\nAn unrecoverable exception occurred:\n' + str(e) +
                   '\n\nPress enter to exit.')
         exit()
 
-print '\nFinished successfully. Exiting in 3 seconds...'
-sleep(3)
+    if args.nowait:
+        sys.exit(0)
+    print '\nFinished successfully. Exiting in 3 seconds...'
+    sleep(3)
@@ -10,6 +10,9 @@ Processes most recent data downloaded from remote monitoring sites:
         data hard drive
     3)  Remove existing files from download location
 
+Run with --watch to instead keep running and process each new file within
+seconds of LoggerNet finishing writing it (see `watch`).
+
 Created on Mon Nov 04 17:13:20 2013
 
 @author: pokeeffe
@@ -20,48 +23,296 @@ from __future__ import print_function
 import logging
 import os
 import os.path as osp
+import signal
+import time
 
+from argparse import ArgumentParser
+from fnmatch import fnmatch
 from glob import glob
+from multiprocessing import Pool
+from Queue import Queue, Empty
 from time import sleep
 from sys import stdout, exit
 
-from definitions.fileio import get_site_code
+try:
+    # Homepage: https://github.com/gorakhargosh/watchdog
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None # fall back to polling
+
+from definitions.fileio import get_site_code, get_toa5_header
 from definitions.paths import TELEMETRY_SRC, TELEMETRY, TELEMETRY_LOG
-from standardize_toa5 import standardize_toa5
+from standardize_toa5 import (standardize_combined, start_manifest,
+                              finish_manifest, _catalog_record)
 from version import version as __version__
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+SOURCE_PATTERN = 'REMOTE_*.dat'
+WATCH_JOBS = 2 # files processed at once in watch mode
+SETTLE_SECONDS = 10 # file must not change for this long before processing
+POLL_SECONDS = 5 # interval between directory scans if not notified of changes
+
 
 def process_new_telemetry_data():
-    new_files = glob(osp.join(TELEMETRY_SRC, 'REMOTE_*.dat'))
+    new_files = glob(osp.join(TELEMETRY_SRC, SOURCE_PATTERN))
     total = len(new_files)
     logger.info('Preparing to process new telemetry data in %s [%i files]' %
             (TELEMETRY_SRC, total))
-    to_remove = []
     for fname in new_files:
         fsize = os.path.getsize(fname) / 1024
         logger.info('Processing %s (%iKB) ... ' % (fname, fsize))
-        site = get_site_code(fname)
-        dest = TELEMETRY % {'site' : site}
-        try:
-            standardize_toa5(fname, dest_path=dest, baled=False)
+    to_remove = []
+    for fname, err, secs in _process_files(new_files):
+        if err is None:
             to_remove.append(fname)
-        except Exception as e:
+        else:
             logger.error('Exception occurred processing %s - skipping (%s)' %
-                         (osp.basename(fname), e))
+                         (osp.basename(fname), err))
     logger.debug('Preparing to delete source files')
     for fname in to_remove:
-        logger.info('Deleting %s ... ' % fname)
+        _remove_source(fname)
+
+
+def _group_files(flist):
+    """Return dict of lists of files by site code from their TOA5 headers
+    (None if unreadable), each in order of modification time (download
+    order) regardless of table"""
+    groups = {}
+    for fname in flist:
+        try:
+            hdr = get_toa5_header(fname)
+            mtime = osp.getmtime(fname)
+        except OSError: # vanished; error is reported when processed
+            hdr, mtime = None, 0
+        key = hdr.site_code if hdr else None
+        groups.setdefault(key, []).append((mtime, fname))
+    return dict((key, [fname for _, fname in sorted(group)])
+                for key, group in groups.items())
+
+
+def _process_files(flist):
+    """Standardize telemetry files into their sites' directories
+
+    Files of the same site update the same output files, whatever their
+    raw table name (e.g. historical and current names of a table feed one
+    output file), so all files of a site are combined in memory, in
+    download order, and each output file is merged and written once per
+    run (see `standardize_combined`) rather than once per file; catching up
+    on a backlog thus takes time proportional to its size.
+    Each call is one run in the local run history (see
+    `standardize_toa5.start_manifest`).
+
+    Returns list of (file name, error message or None, seconds) tuples
+    """
+    manifest = start_manifest('process_new_telemetry_data',
+                              dict(files=len(flist)))
+    results = []
+    for site, group in sorted(_group_files(flist).items()):
+        start = time.time()
+        try:
+            dest = TELEMETRY % {'site' : site}
+            for res in standardize_combined(group, dest_path=dest,
+                                            baled=False):
+                results.append((res[1], res[4], res[3]))
+        except Exception as e: # e.g. writing output file failed
+            err = str(e) or type(e).__name__
+            secs = (time.time()-start) / len(group)
+            results.extend([(fname, err, secs) for fname in group])
+            for fname in group:
+                manifest.skip(fname, err)
+    totals = finish_manifest().totals()
+    logger.info('Read %d files (%.1f KB, %d rows) at %.2f MB/s; %d skipped'
+                % (totals['files'], totals['bytes']/1024., totals['rows_read'],
+                   totals['mb_per_s'], totals['skipped']))
+    return results
+
+
+def _remove_source(fname):
+    """Delete processed source file and its catalog record; return truth of
+    whether file was deleted. Catalog errors are logged, not raised (see
+    `standardize_toa5._catalog_record`)"""
+    logger.info('Deleting %s ... ' % fname)
+    try:
+        os.remove(fname)
+    except OSError:
+        logger.error('Exception occurred deleting %s - skipping' %
+                     osp.basename(fname))
+        return False
+    _catalog_record('remove', fname)
+    return True
+
+
+def _init_watch_worker():
+    """Leave Ctrl+C to the main process, which lets running tasks finish"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def watch(jobs=WATCH_JOBS, settle=SETTLE_SECONDS, poll=POLL_SECONDS):
+    """Process new telemetry files continuously as they arrive
+
+    Source directory is watched for changes (using the `watchdog` package,
+    if installed: inotify on Linux, ReadDirectoryChangesW on Windows) and
+    also re-scanned every `poll` seconds, or every minute if notifications
+    are available, in case any are missed. Each file is processed once its
+    size and modification time have not changed for `settle` seconds, i.e.
+    LoggerNet has finished writing it, then deleted as in batch mode.
+
+    Settled files are processed in batches per site (see `_process_files`)
+    by a pool of up to `jobs` processes, but never two batches of the same
+    site at once, since they would update the same output files. Files which
+    fail are retried only after they change.
+
+    Runs until interrupted (Ctrl+C or SIGTERM); files already being
+    processed are finished before returning.
+    """
+    events = Queue()
+    observer = None
+    if Observer is not None:
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                events.put(getattr(event, 'dest_path', event.src_path))
+        observer = Observer()
+        observer.schedule(Handler(), TELEMETRY_SRC, recursive=False)
+        observer.start()
+        poll = max(poll, 60)
+    logger.info('Watching %s for new telemetry data (%s)' %
+                (TELEMETRY_SRC, 'notified' if observer else 'polling'))
+
+    stopping = []
+    def stop(signum, frame):
+        stopping.append(signum)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    pool = Pool(processes=jobs, initializer=_init_watch_worker)
+    done = Queue()
+    seen = {} # file name: (size, mtime, time first seen so)
+    failed = {} # file name: (size, mtime) when it failed
+    running = {} # file name: site
+    next_scan = 0
+    try:
+        while not stopping:
+            now = time.time()
+            if now >= next_scan:
+                for fname in glob(osp.join(TELEMETRY_SRC, SOURCE_PATTERN)):
+                    seen.setdefault(fname, None)
+                next_scan = now + poll
+            try:
+                while True:
+                    fname = events.get_nowait()
+                    if fnmatch(osp.basename(fname), SOURCE_PATTERN):
+                        seen.setdefault(fname, None)
+            except Empty:
+                pass
+
+            ready = {} # site: [file name, ...]
+            for fname in sorted(seen):
+                if fname in running:
+                    continue
+                try:
+                    st = os.stat(fname)
+                except OSError:
+                    del seen[fname]
+                    failed.pop(fname, None)
+                    continue
+                state = (st.st_size, st.st_mtime)
+                if failed.get(fname) == state:
+                    continue
+                if seen[fname] is None or seen[fname][:2] != state:
+                    seen[fname] = state + (now,)
+                    continue
+                if now - seen[fname][2] < settle:
+                    continue
+                try:
+                    site = get_site_code(fname)
+                except Exception:
+                    site = None
+                ready.setdefault(site, []).append(fname)
+            for site in sorted(ready):
+                busy = set(running.values())
+                if site in busy or len(busy) >= jobs:
+                    continue
+                batch = []
+                for fname in ready[site]:
+                    try:
+                        fsize = os.path.getsize(fname) / 1024
+                    except OSError: # vanished since checked
+                        seen.pop(fname, None)
+                        continue
+                    logger.info('Processing %s (%iKB) ... ' % (fname, fsize))
+                    running[fname] = site
+                    batch.append(fname)
+                if batch:
+                    pool.apply_async(_watch_task, (batch,),
+                                     callback=done.put)
+
+            _finish_watched(done, seen, failed, running)
+            sleep(1)
+    finally:
+        logger.info('Stopping; waiting for %d file(s) in progress' %
+                    len(running))
+        if observer is not None:
+            observer.stop()
+        pool.close()
+        pool.join()
+        _finish_watched(done, seen, failed, running)
+
+
+def _watch_task(flist):
+    """Process files as `_process_files` does, in watch-mode pool worker
+
+    Any error is returned as the result of every file, since the pool
+    calls back only on success and files would otherwise be left running
+    (and their site never scheduled again)."""
+    try:
+        return _process_files(flist)
+    except Exception as e:
+        err = str(e) or type(e).__name__
+        return [(fname, err, 0.0) for fname in flist]
+
+
+def _finish_watched(done, seen, failed, running):
+    """Handle results of completed watch-mode tasks"""
+    while True:
         try:
-            os.remove(fname)
-        except OSError:
-            logger.error('Exception occurred deleting %s - skipping' %
-                         osp.basename(fname))
+            results = done.get_nowait()
+        except Empty:
+            return
+        for fname, err, secs in results:
+            running.pop(fname, None)
+            state = seen.pop(fname, None)
+            if err is None:
+                logger.info('Finished %s in %.1f s' %
+                            (osp.basename(fname), secs))
+                if _remove_source(fname):
+                    continue
+            else:
+                logger.error('Exception occurred processing %s - skipping '
+                             '(%s)' % (osp.basename(fname), err))
+            if state is not None: # not again unless it changes
+                failed[fname] = state[:2]
 
 
 if __name__ == '__main__':
+    p = ArgumentParser(description=('Standardize new telemetry data files '
+                                    'and delete them from download location'))
+    p.add_argument('--version', action='version', version=__version__)
+    p.add_argument('--watch', action='store_true',
+                   help='keep running, processing files as they arrive')
+    p.add_argument('-j', '--jobs', type=int, default=WATCH_JOBS,
+                   help=('files to process at once in watch mode (default: '
+                         '%d)' % WATCH_JOBS))
+    p.add_argument('--settle', type=float, default=SETTLE_SECONDS,
+                   help=('seconds a file must be unchanged before processing '
+                         'in watch mode (default: %d)' % SETTLE_SECONDS))
+    p.add_argument('--poll', type=float, default=POLL_SECONDS,
+                   help=('seconds between directory scans in watch mode '
+                         '(default: %d)' % POLL_SECONDS))
+    args = p.parse_args()
+
     console = logging.StreamHandler(stream=stdout)
     console.setLevel(logging.DEBUG)
     console.setFormatter(logging.Formatter('%(message)s'))
@@ -100,6 +351,10 @@ if __name__ == '__main__':
         print(n, end=' ')
         sleep(1)
     print()
+    if args.watch:
+        watch(jobs=args.jobs, settle=args.settle, poll=args.poll)
+        logger.info('Done.\n')
+        exit(0)
     process_new_telemetry_data()
     logger.info('Done. Exiting in 10 seconds...\n')
     sleep(10)
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""Extract time range of selected columns from standardized data archive
+
+    Finds the output files of `standardize_toa5` which overlap the requested
+    period -- using the same file naming and baling rules used to write them,
+    so no directory listing is needed -- and reads just the requested columns
+    in blocks, so memory use is bounded even for multi-year pulls of tsdata.
+
+    From Python, iterate over DataFrame blocks:
+
+        >>> from query_archive import query
+        >>> for df in query('LIND', 'stats30', '2012-05-01', '2013-09-30',
+        ...                 columns=['Fc_wpl', 'LE_wpl']):
+        ...     do_something(df)
+
+    or stream to a CSV file in standard format:
+
+        >>> from query_archive import query_to_csv
+        >>> query_to_csv('out.csv', 'LIND', 'stats30', '2012-05-01',
+        ...              '2013-09-30', columns=['Fc_wpl', 'LE_wpl'])
+
+    From the command line:
+
+        python query_archive.py LIND stats30 2012-05-01 2013-09-30 \\
+            -c Fc_wpl LE_wpl -o out.csv
+
+    Dates without a time include the whole day, i.e. an `end` of
+    '2013-09-30' includes data through 23:59:59.999 on that day.
+
+@author: Patrick O'Keeffe <pokeeffe@wsu.edu>
+"""
+
+import os
+import sys
+
+from argparse import ArgumentParser
+from csv import QUOTE_NONE
+
+from pandas import read_csv, to_datetime, DataFrame, DatetimeIndex, Timestamp
+from pandas.tseries.offsets import Day
+
+from definitions.fileio import RowIndex, RangeReader
+from definitions.paths import RAW_STDFMT
+from definitions.tables import table_definitions, table_baleinfo
+from standardize_toa5 import _make_out_fname
+from version import version as __version__
+
+
+DEFAULT_DEST = os.path.join(RAW_STDFMT, '%(table)s') # as CFTransferUtility
+DEFAULT_CHUNK_ROWS = 100000
+
+
+def bale_files(site, table, start, end, dest_path=DEFAULT_DEST, baled=True):
+    """Return list of existing output files which may hold data in period
+
+    File names are generated from the table's baling info (see
+    `table_baleinfo`) and the naming rules of `standardize_toa5`; for
+    cumulative (unbaled) files, the list has just the one file.
+
+    Parameters
+    ----------
+    site : str
+        4-char site code
+    table : str
+        current table name
+    start, end : str or datetime-like
+        period of interest (inclusive)
+    dest_path : str
+        output path of `standardize_toa5` (may include "%(site)s",
+        "%(table)s" and "%(date)s" substitutions). Default: `DEFAULT_DEST`
+    baled : bool
+        whether files were written baled (see `standardize_toa5`)
+    """
+    start, end = _period(start, end)
+    grpbykeys, start_func, offset, freq = table_baleinfo[table]
+    if not baled or grpbykeys is None:
+        starts = [start]
+    else:
+        starts = []
+        bale = start_func(DataFrame(index=DatetimeIndex([start])))
+        while bale <= end:
+            starts.append(bale)
+            bale = bale + offset
+    flist = []
+    for bale in starts:
+        fname = _make_out_fname(DataFrame(index=DatetimeIndex([bale])), site,
+                                dest_path, table, baled)
+        if os.path.isfile(fname):
+            flist.append(fname)
+    return flist
+
+
+def query(site, table, start, end, columns=None, dest_path=DEFAULT_DEST,
+          baled=True, chunksize=DEFAULT_CHUNK_ROWS, dtype=None):
+    """Generate DataFrames of data from standardized files within period
+
+    Parameters
+    ----------
+    site, table, start, end, dest_path, baled :
+        see `bale_files`
+    columns : list of str
+        column names to return, in order; default: all in table definition
+    chunksize : int
+        maximum rows per DataFrame (and rows read from file at once)
+    dtype : type or None
+        data type of values, passed to `pandas.read_csv`; default: inferred.
+        Use `str` to get values exactly as written in the files
+
+    Yields
+    ------
+    DataFrames with DatetimeIndex named 'TIMESTAMP' and the requested
+    columns. Columns missing from a file (older table definitions) are NAN.
+    Files absent from the archive are silently skipped.
+    """
+    start, end = _period(start, end)
+    columns = _check_columns(table, columns)
+    for fname in bale_files(site, table, start, end, dest_path, baled):
+        for df in _read_period(fname, columns, start, end, chunksize, dtype):
+            yield df
+
+
+def query_to_csv(out, site, table, start, end, columns=None,
+                 dest_path=DEFAULT_DEST, baled=True,
+                 chunksize=DEFAULT_CHUNK_ROWS):
+    """Write data from standardized files within period to CSV file
+
+    Output is in the same format as the standardized files themselves;
+    values and timestamps are copied as written, without conversion.
+
+    Parameters
+    ----------
+    out : str or file-like
+        output file name or open file (e.g. sys.stdout)
+    others :
+        see `query`
+
+    Returns
+    -------
+    number of rows written
+    """
+    if isinstance(out, basestring):
+        with open(out, mode='w') as f:
+            return query_to_csv(f, site, table, start, end, columns,
+                                dest_path, baled, chunksize)
+    start, end = _period(start, end)
+    columns = _check_columns(table, columns)
+    nrows = 0
+    for fname in bale_files(site, table, start, end, dest_path, baled):
+        for df in _read_period(fname, columns, start, end, chunksize, str,
+                               parse=False):
+            df.to_csv(out,
+                      header=(nrows == 0),
+                      na_rep='NAN',
+                      quoting=QUOTE_NONE, # see standardize_toa5._safe_write_csv
+                      quotechar="'",
+                      index_label='TIMESTAMP')
+            nrows += len(df)
+    if not nrows:
+        out.write(','.join(['TIMESTAMP'] + columns) + '\n')
+    return nrows
+
+
+def _period(start, end):
+    """Return (start, end) as Timestamps; date-only end includes whole day"""
+    if isinstance(end, basestring) and len(end.strip()) <= 10:
+        end = Timestamp(end) + Day() - Timestamp.resolution
+    return Timestamp(start), Timestamp(end)
+
+
+def _check_columns(table, columns):
+    """Return list of columns to read, raising ValueError for unknown ones"""
+    try:
+        known = table_definitions[table]
+    except KeyError:
+        raise ValueError('Unknown table: {t}'.format(t=table))
+    if columns is None:
+        return [c for c in known if c != 'TIMESTAMP']
+    unknown = [c for c in columns if c not in known]
+    if unknown:
+        raise ValueError('Not column(s) of table {t}: {c}'.format(
+            t=table, c=', '.join(unknown)))
+    return list(columns)
+
+
+def _read_period(fname, columns, start, end, chunksize, dtype, parse=True):
+    """Generate DataFrames of selected columns of file within period
+
+    If `parse` is False, index is left as timestamp strings, as written.
+    If the file has a row index (see `RowIndex`), only lines near the period
+    are read; otherwise, since files are written in chronological order,
+    reading stops at first block past `end`."""
+    src = open(fname, mode='rb')
+    header = src.readline().rstrip('\r\n').split(',')
+    index = RowIndex.load(fname)
+    if index is not None:
+        src = RangeReader(src, *index.span(start, end))
+    usecols = ['TIMESTAMP'] + [c for c in columns if c in header]
+    with src:
+        reader = read_csv(src,
+                          header=None,
+                          names=header,
+                          usecols=usecols,
+                          index_col=0,
+                          dtype=dtype,
+                          na_values=['NAN'],
+                          keep_default_na=False,
+                          quoting=QUOTE_NONE,
+                          chunksize=chunksize)
+        for df in reader:
+            tstamps = to_datetime(df.index)
+            keep = (tstamps >= start) & (tstamps <= end)
+            if keep.any():
+                # file order & any columns missing from older files
+                df = df[keep].reindex(columns=columns)
+                if parse:
+                    df.index = tstamps[keep]
+                    df.index.name = 'TIMESTAMP'
+                yield df
+            if len(tstamps) and tstamps[-1] > end:
+                break
+
+
+if __name__ == '__main__':
+    p = ArgumentParser(description=('Extract period of selected columns from '
+                                    'standardized data archive'))
+    p.add_argument('--version', action='version', version=__version__)
+    p.add_argument('site', help='4-char site code')
+    p.add_argument('table', help='current table name')
+    p.add_argument('start', help='YYYY-MM-DD[ HH:MM:SS]')
+    p.add_argument('end', help='YYYY-MM-DD[ HH:MM:SS] (inclusive)')
+    p.add_argument('-c', '--columns', nargs='+',
+                   help='columns to extract; default: all')
+    p.add_argument('-o', '--out',
+                   help='output file; default: write to standard output')
+    p.add_argument('-d', '--dest', default=DEFAULT_DEST,
+                   help=('path of standardized files, as given to '
+                         'standardize_toa5; default: %s' %
+                         DEFAULT_DEST.replace('%', '%%')))
+    p.add_argument('--nobale', action='store_true',
+                   help='standardized files are cumulative, not baled')
+    p.add_argument('--chunksize', type=int, default=DEFAULT_CHUNK_ROWS,
+                   help=('rows to read at once (default: %d)'
+                         % DEFAULT_CHUNK_ROWS))
+    args = p.parse_args()
+
+    try:
+        nrows = query_to_csv(args.out or sys.stdout, args.site, args.table,
+                             args.start, args.end, columns=args.columns,
+                             dest_path=args.dest, baled=not args.nobale,
+                             chunksize=args.chunksize)
+    except ValueError as err:
+        sys.exit(str(err))
+    sys.stderr.write('%d rows\n' % nrows)
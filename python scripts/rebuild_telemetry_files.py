@@ -2,19 +2,114 @@
 """
 Created on Fri Jan 31 18:09:21 2014
 
+Raw files of all sites are standardized in a single pool of worker
+processes (see `standardize_toa5.standardize_files`) rather than one site
+after another; output is the same as processing each site's files in turn.
+Files unchanged since they were merged into the telemetry files are skipped,
+per the ledger of merged files, so an interrupted rebuild can be resumed.
+
 @author: pokeeffe
 """
 
 from __future__ import print_function
 
-import subprocess
-import sys
+import os.path as osp
+
+from argparse import ArgumentParser
+from glob import glob
+from multiprocessing import cpu_count
+from time import time
 
 from definitions.sites import site_list
 from definitions.paths import RAW_ASCII, TELEMETRY
+from standardize_toa5 import (standardize_files, start_manifest,
+                              finish_manifest, enable_ledger)
+from version import version as __version__
+
+
+EXCLUDE = ['tsdata', 'ts_data'] # not kept in telemetry files
+
+
+def rebuild_filelist(telemetry=TELEMETRY, raw=RAW_ASCII):
+    """Return list of (raw file, output path) pairs for all sites, as given
+    to `standardize_files`; files of each site in directory order. `raw`
+    and `telemetry` are paths of each site's raw & telemetry files, with
+    "%(site)s" for the site code"""
+    flist = []
+    for site in site_list:
+        look_in = raw % {'site' : site.code}
+        send_to = telemetry % {'site' : site.code}
+        for fname in glob(osp.join(look_in, '*.dat')):
+            if not osp.isfile(fname):
+                continue
+            if any([ex in fname for ex in EXCLUDE]):
+                continue
+            flist.append((fname, send_to))
+    return flist
+
+
+def rebuild(telemetry=TELEMETRY, jobs=None, force=False, raw=RAW_ASCII):
+    """Rebuild telemetry files of all sites from raw files, using `jobs`
+    processes (default: one per CPU); print progress and summary. Files
+    recorded in the ledger of merged files as unchanged are skipped unless
+    `force` is true. See `rebuild_filelist` for `raw`."""
+    jobs = jobs or cpu_count()
+    enable_ledger(skip=not force)
+    flist = rebuild_filelist(telemetry, raw)
+    site_of = dict((telemetry % {'site' : site.code}, site.code)
+                   for site in site_list)
+    total = len(flist)
+    print('Standardizing %d files using %d processes\n' % (total, jobs))
+
+    done = []
+    def progress(res):
+        pid, fname, nbytes, secs, err = res
+        done.append(res)
+        status = 'failed ({e})'.format(e=err) if err else 'done'
+        print('[{x}/{of}] {n} ... {s} ({t:.1f}s, worker {p})'.format(
+              x=len(done), of=total, n=osp.basename(fname), s=status, t=secs,
+              p=pid))
+    start = time()
+    start_manifest('rebuild_telemetry_files', dict(telemetry=telemetry,
+                                                   jobs=jobs, force=force))
+    results = standardize_files(flist, baled=False, jobs=jobs,
+                                callback=progress)
+    elapsed = time() - start
+    finish_manifest()
+    dest_of = dict(flist)
+
+    print('\nSummary\n-------')
+    bysite = {}
+    for pid, fname, nbytes, secs, err in results:
+        d = bysite.setdefault(site_of[dest_of[fname]], [0, 0, 0.0, 0])
+        d[0] += 1
+        d[1] += nbytes
+        d[2] += secs
+        d[3] += err is not None
+    for site, (nfiles, nbytes, secs, nfail) in sorted(bysite.items()):
+        print('  {d}: {n} files ({f} failed), {mb:.1f} MB, {s:.1f}s '
+              'of work'.format(d=site, n=nfiles, f=nfail,
+                               mb=nbytes/1024./1024., s=secs))
+    mb = sum([r[2] for r in results])/1024./1024.
+    print('  total: {n} files, {mb:.1f} MB in {s:.1f}s ({r:.2f} MB/s)'.format(
+          n=len(results), mb=mb, s=elapsed, r=(mb/elapsed if elapsed else 0)))
 
 
 if __name__ == '__main__':
+    p = ArgumentParser(description=('Rebuild telemetry data files of all '
+                                    'sites from raw data files'))
+    p.add_argument('--version', action='version', version=__version__)
+    p.add_argument('-j', '--jobs', type=int, default=cpu_count(),
+                   help=('number of files to process in parallel (default: '
+                         'number of CPUs, %d)' % cpu_count()))
+    p.add_argument('--force', action='store_true',
+                   help=('standardize all raw files, even those unchanged '
+                         'since they were merged into the telemetry files'))
+    p.add_argument('--raw', default=RAW_ASCII,
+                   help=('raw files of each site, using "%%(site)s" for site '
+                         'code (default: %(default)s)'))
+    args = p.parse_args()
+
     print('==== Rebuild telemetry files :: REACCH Obj2 ====\n\n'
         'This program will reconstruct data files in the "telemetry data" '
         'folder of all monitoring sites. Any existing files will be '
@@ -24,7 +119,7 @@ if __name__ == '__main__':
         'telemetry data has not been used to patch gaps in "standard format" '
         'data files.\n')
 
-    print('Looking for raw TOA5 files in', RAW_ASCII)
+    print('Looking for raw TOA5 files in', args.raw)
     print('Writing rebuild files into', TELEMETRY)
     ans = raw_input('Would you like to rebuild into special directories? ')
     if ans and ans[0] in ['Y', 'y']:
@@ -35,14 +130,4 @@ if __name__ == '__main__':
 
     raw_input('\nPress <enter> to begin or <ctrl>+C to abort.\n')
 
-    for site in site_list:
-        print('='*78)
-        print('Rebuilding', site.name, '('+site.code+') \n')
-        look_in = RAW_ASCII % {'site' : site.code}
-        send_to = TELEMETRY % {'site' : site.code}
-
-        call = ('python standardize_toa5.py --infilt *.dat --exfilt tsdata '
-                'ts_data -d "%s" -o "%s" -v --nobale') % (look_in, send_to)
-        subprocess.call(call, shell=True, stdout=sys.stdout)
-        print()
-
+    rebuild(TELEMETRY, jobs=args.jobs, force=args.force, raw=args.raw)
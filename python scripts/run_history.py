@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""Show throughput of past processing runs and flag those which regressed
+
+    Every run of `standardize_toa5`, `process_new_telemetry_data` and
+    `rebuild_telemetry_files` stores a manifest in the local run history
+    (see `definitions.runs`). This lists recent runs of each program with
+    their throughput and the median throughput of the runs before them,
+    flagging any which were slower than that median by more than the
+    threshold:
+
+        python run_history.py --program standardize_toa5 -n 30
+        python run_history.py --show 42   # full manifest of run 42
+        python run_history.py --check     # exit status 1 if latest regressed
+
+@author: Patrick O'Keeffe <pokeeffe@wsu.edu>
+"""
+
+import json
+import sys
+
+from argparse import ArgumentParser
+
+from definitions.paths import RUN_HISTORY
+from definitions.runs import RunHistory, flag_regressions
+from version import version as __version__
+
+
+DEFAULT_LAST = 20
+DEFAULT_WINDOW = 10 # runs of rolling median
+DEFAULT_THRESHOLD = 0.25 # fractional slowdown flagged
+
+
+def show_trends(history, program=None, last=DEFAULT_LAST,
+                window=DEFAULT_WINDOW, threshold=DEFAULT_THRESHOLD,
+                min_mb=0.):
+    """Print recent runs of each program with throughput & rolling median;
+    return list of programs whose most recent run regressed"""
+    programs = sorted(set(run['program'] for run in history.runs(program)))
+    regressed = []
+    for prog in programs:
+        flagged = flag_regressions(history.runs(prog), window=window,
+                                   threshold=threshold,
+                                   min_bytes=min_mb*1024*1024)
+        print prog
+        print '  %6s  %-19s %6s %9s %9s %8s %8s' % ('id', 'started', 'files',
+                                                   'MB', 'secs', 'MB/s',
+                                                   'median')
+        for run, median, slow in flagged[-last:]:
+            print '  %6d  %-19s %6d %9.1f %9.1f %8.2f %8s%s' % (
+                run['id'], run['started'][:19], run['files'],
+                run['bytes']/1024./1024., run['secs'], run['mb_per_s'],
+                '%.2f' % median if median is not None else '-',
+                '  SLOWER' if slow else '')
+        if flagged and flagged[-1][2]:
+            regressed.append(prog)
+        print
+    return regressed
+
+
+if __name__ == '__main__':
+    p = ArgumentParser(description=('Show throughput trends of processing '
+                                    'runs and flag regressions'))
+    p.add_argument('--version', action='version', version=__version__)
+    p.add_argument('--program',
+                   help='show runs of this program only (default: all)')
+    p.add_argument('-n', '--last', type=int, default=DEFAULT_LAST,
+                   help='runs to show per program (default: %d)'
+                   % DEFAULT_LAST)
+    p.add_argument('--window', type=int, default=DEFAULT_WINDOW,
+                   help=('preceding runs of which median is taken (default: '
+                         '%d)' % DEFAULT_WINDOW))
+    p.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                   help=('flag runs slower than median by more than this '
+                         'fraction (default: %g)' % DEFAULT_THRESHOLD))
+    p.add_argument('--min-mb', type=float, default=0.,
+                   help=('ignore runs reading less than this many MB, whose '
+                         'throughput is mostly start-up cost (default: 0)'))
+    p.add_argument('--show', metavar='ID', type=int,
+                   help='print manifest of run as JSON')
+    p.add_argument('--check', action='store_true',
+                   help='exit with status 1 if latest run regressed')
+    p.add_argument('--history', default=RUN_HISTORY,
+                   help='run history database (default: %s)' % RUN_HISTORY)
+    args = p.parse_args()
+
+    history = RunHistory(args.history)
+    if args.show is not None:
+        manifest = history.manifest(args.show)
+        if manifest is None:
+            sys.exit('No run with ID %d' % args.show)
+        print json.dumps(manifest, indent=1, sort_keys=True)
+        sys.exit(0)
+
+    regressed = show_trends(history, args.program, args.last, args.window,
+                            args.threshold, args.min_mb)
+    if regressed:
+        print 'Latest run regressed:', ', '.join(regressed)
+    sys.exit(1 if args.check and regressed else 0)
@@ -4,13 +4,21 @@
 @author Patrick O'Keeffe <pokeeffe@wsu.edu>
 """
 
+import hashlib
+import logging
+import mmap
 import os
 import sys
 
+import numpy as np
+
+from definitions.catalog import Catalog, RAW
+from definitions.fileio import get_toa5_header
 from version import version as __version__
 
 DEFAULT_HDR_LINES = 4
 DEFAULT_MAX_LINES = 1000000
+WRITE_BLOCK = 2**20 # bytes of part written (and hashed) at a time
 
 if __name__ == '_foo_':
     from argparse import ArgumentParser
@@ -63,14 +71,57 @@ def _log(msg):
     sys.stdout.write(msg)
 
 
+_catalogs = {} # by process ID, as in `standardize_toa5`
+
+
+def _catalog():
+    """Return archive `Catalog` for this process or None if unavailable"""
+    pid = os.getpid()
+    if pid not in _catalogs:
+        try:
+            _catalogs[pid] = Catalog()
+        except Exception as err:
+            logging.warning('Archive catalog is unavailable (%s)' % err)
+            _catalogs[pid] = None
+    return _catalogs[pid]
+
+
+def _catalog_part(fname, header, data, nrows, md5):
+    """Record part file in archive catalog, given parsed `TOA5Header` and
+    checksum; span is taken from data written, so file is not re-read"""
+    cat = _catalog()
+    if header is None or not nrows or cat is None:
+        return
+    first = str(data[:2**16]).split('\n', 1)[0]
+    last = str(data[-2**16:]).rstrip('\r\n').rsplit('\n', 1)[-1]
+    try:
+        cat.record(fname, RAW, site=header.site_code,
+                         raw_table=header.table_name,
+                         first_ts=first.split(',', 1)[0].strip('"'),
+                         last_ts=last.split(',', 1)[0].strip('"'),
+                         nrows=nrows, md5=md5)
+    except Exception as err:
+        logging.warning('Could not update archive catalog (%s)' % err)
+
+
+# bytes of '"YYYY-MM-DD HH:MM:SS",...' lines compared to find calendar periods
+_BOUNDARY_KEYS = {'day' : slice(1, 11), 'month' : slice(1, 8)}
+
+
 def split_toa5(source_file,
                max_lines=DEFAULT_MAX_LINES,
                hdr_lines=DEFAULT_HDR_LINES,
-               delete_source=False):
+               delete_source=False,
+               max_bytes=None,
+               boundary=None):
     """Split text file up into several smaller files
 
-    Reads specific number of rows from input file and writes them to output
-    file. Number of rows written per output file controlled by ``max_lines``.
+    Starts a new output file whenever adding the next line would exceed
+    ``max_lines`` data lines or ``max_bytes`` bytes (header included), and,
+    if ``boundary`` is given, whenever the date of a line's timestamp falls
+    in a different calendar day or month than that of the previous line.
+    Cutting on day or month boundaries keeps the data of each output file
+    within a single daily or monthly bale of standardized output.
 
     Output file names are generated from input file name plus an underscore
     '_' and an incremented digit in two fields, starting from 1 (ie, '_01',
@@ -80,80 +131,189 @@ def split_toa5(source_file,
     file. Headers are assumed to start on line 0 always. The number of lines
     in the header is set through ``hdr_lines``.
 
+    The source file is memory-mapped and scanned for line breaks in large
+    blocks; each output file is written in one go, directly from the map.
+    See `iter_parts` to process the parts without writing them to disk.
 
     Parameters
     ----------
-    source_file : file-like
-        Any object which supports the readline method
+    source_file : str
+        Path to file to split
     max_lines : int
         Number of non-header lines to output in each file (maximum; last
-        file will typically have less) default: ``DEFAULT_MAX_LINES``
+        file will typically have less) default: ``DEFAULT_MAX_LINES``. Use
+        None for no limit
     hdr_lines : int
         Number of lines to use for header in output files. Use 0 to disable
         Header always starts on line 0. default: ``DEFAULT_HDR_LINES``
     delete_source: bool
         If True, attempts to delete source file. Default: False
+    max_bytes : int
+        Maximum size of output files, e.g. ``fileio.MAX_RAW_FILE_SIZE``;
+        a single line longer than this is written to a file by itself.
+        Default: None (no limit)
+    boundary : str
+        'day' or 'month' to also split at changes of calendar day or month
+        of the timestamp in the first field of the (TOA5) data lines.
+        Default: None
 
     Returns
     -------
     list : of file names generated
     """
-    tfile = open(source_file)
-    basename, ext = os.path.splitext(tfile.name)
-    partno = 1
-    outname = '%s_%02d%s' % (basename, partno, ext)
-    towrite = []
     results = []
-
-    _log('Reading header... ')
-    lineno = 0
-    hdr = []
-    for i in range(hdr_lines):
-        hdr.append(tfile.readline())
-        lineno += 1
-    _log('Done.\n')
-
-    _log('Reading data...\n')
-    for line in tfile:
-        lineno += 1
-        towrite.append(line)
-        if lineno % 160000 == 0:
-            _log('.\n')
-        if lineno % 2000 == 0:
-            _log('.')
-        if lineno > max_lines:
-            _log('\nWriting chunk to file (%s)... ' % outname)
-            outfile = open(outname, mode='w')
-            outfile.writelines(hdr)
-            outfile.writelines(towrite)
-            outfile.close()
-            _log('Done.\n')
-            towrite = []
-            lineno = 0
-            partno += 1
-            outname = '%s_%02d%s' % (basename, partno, ext)
-            results.append(outname)
-            #outname = ''.join([basename, '_PART', str(partno), ext])
-
-    if len(towrite) > 0:
-        _log('\nWriting chunk to file (%s)... ' % outname)
-        outfile = open(outname, mode='w')
-        outfile.writelines(hdr)
-        outfile.writelines(towrite)
-        outfile.close()
+    _log('Reading file (%s)...\n' % source_file)
+    header = get_toa5_header(source_file)
+    for outname, hdr, data, nrows in iter_parts(source_file, max_lines,
+                                                hdr_lines, max_bytes, boundary):
+        _log('Writing %d lines to file (%s)... ' % (nrows, outname))
+        write_part(outname, hdr, data, nrows, header=header)
+        results.append(outname)
         _log('Done.\n')
 
-
-    tfile.close()
     if delete_source:
         try:
             os.remove(source_file)
         except WindowsError as err:
             _log('Could not remove source file: %s' % err)
-    _log('Finished splitting file (%s)\n' % tfile.name)
+        else:
+            try:
+                if _catalog() is not None:
+                    _catalog().remove(source_file)
+            except Exception as err:
+                logging.warning('Could not update archive catalog (%s)' % err)
+    _log('Finished splitting file (%s)\n' % source_file)
     return results
 
 
+def iter_parts(source_file,
+               max_lines=DEFAULT_MAX_LINES,
+               hdr_lines=DEFAULT_HDR_LINES,
+               max_bytes=None,
+               boundary=None):
+    """Generate parts of file as split by `split_toa5`, without writing them
+
+    Yields a 4-tuple for each part: output file name, header, data and number
+    of data lines. To avoid copying, `data` is a read-only buffer into the
+    memory-mapped source file which is valid only until the next part is
+    generated. Use `write_part` to write a part to disk or pass the header
+    and data to a `fileio.ChainReader` to parse them directly.
+
+    See `split_toa5` for parameters.
+    """
+    if boundary is not None and boundary not in _BOUNDARY_KEYS:
+        raise ValueError('Unknown boundary: %s' % boundary)
+    basename, ext = os.path.splitext(source_file)
+    with open(source_file, mode='rb') as tfile:
+        size = os.fstat(tfile.fileno()).st_size
+        if not size:
+            return
+        mm = mmap.mmap(tfile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            hdr = mm[:_header_end(mm, size, hdr_lines)]
+            cuts = _find_cuts(mm, size, len(hdr), max_lines, max_bytes,
+                              boundary)
+            for num, (start, stop, nrows) in enumerate(cuts, 1):
+                outname = '%s_%02d%s' % (basename, num, ext)
+                yield outname, hdr, buffer(mm, start, stop-start), nrows
+        finally:
+            mm.close()
+
+
+def write_part(outname, hdr, data, nrows, catalog=True, header=None):
+    """Write part of split file (see `iter_parts`) and, unless `catalog` is
+    false, record it in the archive catalog
+
+    Data is hashed as it is written, a block at a time. `header` is the
+    parsed `TOA5Header` of the source file, which parts share; if not
+    given, it is read from the part written."""
+    md5 = hashlib.md5(hdr) if catalog else None
+    with open(outname, mode='wb') as outfile:
+        outfile.write(hdr)
+        for pos in xrange(0, len(data), WRITE_BLOCK):
+            block = buffer(data, pos, WRITE_BLOCK)
+            outfile.write(block)
+            if md5 is not None:
+                md5.update(block)
+    if catalog:
+        if header is None:
+            header = get_toa5_header(outname)
+        _catalog_part(outname, header, data, nrows, md5.hexdigest())
+
+
+def _header_end(buf, size, hdr_lines):
+    """Return byte offset of end of header lines"""
+    hdr_end = 0
+    for i in range(hdr_lines):
+        nl = buf.find('\n', hdr_end) if hdr_end < size else -1
+        hdr_end = size if nl < 0 else nl + 1
+    return hdr_end
+
+
+def _find_cuts(buf, size, hdr_size, max_lines, max_bytes, boundary,
+               blocksize=2**24):
+    """Generate (start, stop, lines) byte ranges of data for output files
+
+    Line breaks are located in blocks of `blocksize` bytes using numpy; the
+    position of each cut within a block is found by array search, so no
+    Python code runs per line. See `split_toa5` for other parameters."""
+    arr = np.frombuffer(buf, dtype=np.uint8) if size else np.zeros(0, np.uint8)
+
+    keycols = None
+    if boundary is not None:
+        sl = _BOUNDARY_KEYS[boundary]
+        keycols = np.arange(sl.start, sl.stop)
+    last_key = None
+
+    part_start, nrows = hdr_size, 0
+    pos = line_start = hdr_size
+    while pos < size:
+        stop = min(pos + blocksize, size)
+        ends = np.flatnonzero(arr[pos:stop] == 10) + pos
+        pos = stop
+        if stop == size and line_start < size and (
+                not len(ends) or ends[-1] != size-1):
+            ends = np.append(ends, size-1) # last line lacks line break
+        if not len(ends):
+            continue # line spans entire block
+        starts = np.concatenate([[line_start], ends[:-1]+1])
+        line_start = int(ends[-1]) + 1
+        if keycols is not None:
+            idx = np.minimum(starts[:, None] + keycols, size-1)
+            keys = arr[idx]
+            if last_key is None:
+                last_key = keys[0]
+            change = np.concatenate([[np.any(keys[0] != last_key)],
+                                     np.any(keys[1:] != keys[:-1], axis=1)])
+            last_key = keys[-1]
+
+        n, i = len(ends), 0
+        while i < n:
+            # index of first line which must begin a new file
+            cut = n
+            if max_lines:
+                cut = min(cut, i + max_lines - nrows)
+            if max_bytes:
+                limit = part_start + max_bytes - hdr_size - 1
+                j = max(int(np.searchsorted(ends, limit, side='right')), i)
+                if j == i and nrows == 0:
+                    j = i + 1 # oversized line goes in file by itself
+                cut = min(cut, j)
+            if keycols is not None:
+                first = i if nrows else i + 1
+                hits = np.flatnonzero(change[first:cut])
+                if len(hits):
+                    cut = first + int(hits[0])
+            if cut >= n:
+                nrows += n - i
+                break
+            nrows += cut - i
+            yield part_start, int(starts[cut]), nrows
+            part_start, nrows, i = int(starts[cut]), 0, cut
+    if nrows:
+        yield part_start, size, nrows
+
+
 if __name__ == '__main__':
     print 'Hello, user. I can split large text files into smaller pieces. Just'
     print 'provide an absolute or relative path to a source file and I will'
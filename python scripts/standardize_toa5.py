@@ -17,27 +17,57 @@ Created on Wed Mar 06 08:47:59 2013
 
 import os
 import sys
+import time
 import logging as log
+import cPickle as pickle
 
 from csv import QUOTE_NONE
 from datetime import datetime as dt
+from functools import wraps
 from glob import glob
 from argparse import ArgumentParser
+from multiprocessing import Pool
+from Queue import Queue
+from shutil import rmtree
+from tempfile import mkdtemp
 
-from pandas import read_csv, Series, DataFrame, DatetimeIndex, infer_freq
+import numpy as np
+
+from pandas import (read_csv, read_pickle, concat, DataFrame, Index,
+                    DatetimeIndex, Timestamp, date_range, infer_freq)
 from pandas.tseries.offsets import Second, Day
 from pandas.tseries.frequencies import to_offset
 
 from definitions.sites import site_list
-from definitions.fileio import (get_table_name, get_site_code,
-                                HeaderMismatchError)
+from definitions.catalog import Catalog, RAW, STANDARD, count_valid
+from definitions.checksums import HashCache, update_manifest, md5_file
+from definitions.ledger import InputLedger, output_target
+from definitions.paths import INPUT_LEDGER, LOCAL_CACHE
+from definitions.profiling import StageProfiler, null_stage
+from definitions.runs import (RunManifest, RunHistory, CREATED, MERGED,
+                              APPENDED)
+from definitions.fileio import (get_toa5_header, HeaderMismatchError,
+                                FileLock, HashingReader, HashingWriter,
+                                ChainReader, RowIndex, move_row_index,
+                                tidy_toa5, get_toa5_span, MAX_RAW_FILE_SIZE,
+                                STUDY_START, STUDY_END)
 from definitions.tables import (current_names, table_definitions,
                                 table_baleinfo, historical_table_names,
-                                ColumnNotFoundError)
+                                definitions_version, ColumnNotFoundError)
+from split_toa5 import iter_parts, write_part
 from version import version as __version__
 
 
-def standardize_toa5(fname, dest_path=None, baled=True):
+DEFAULT_CHUNK_ROWS = 250000 # rows per block when reading files in chunks
+
+_in_worker = False # True within `standardize_files` pool worker processes
+_profiler = None # see `enable_profiling`
+_manifest = None # see `start_manifest`
+_ledger = None # see `enable_ledger`
+_ledger_skip = True
+
+
+def standardize_toa5(fname, dest_path=None, baled=True, chunksize=None):
     """Re-write TOA5 file in standard format
 
     Opens eddy covariance tower data files from REACCH (2011-2016) project
@@ -57,10 +87,16 @@ def standardize_toa5(fname, dest_path=None, baled=True):
         If true, output files will be broken up into files of consistent
         length of time; otherwise, output files will be be cumulative.
         Defaults to True
+    chunksize : int or None, optional
+        If provided, the source file is processed in blocks of this many
+        rows so memory use does not grow with the size of the source file
+        (see `DEFAULT_CHUNK_ROWS` for a reasonable value). Defaults to None,
+        reading the whole file at once
 
     Returns
     -------
-    Nothing is returned.
+    True if the file was standardized in full, False if it was skipped
+    (in part or whole)
 
     Details
     -------
@@ -91,7 +127,9 @@ def standardize_toa5(fname, dest_path=None, baled=True):
         the existing file is loaded and the output file is appended to it.
         If the existing file has a different header then the output file will
         be skipped (not written). Non-NAN values in the existing file will
-        take precedence over values in the appended file.**
+        take precedence over values in the appended file. If the new data
+        all comes after the end of the existing file, it is simply added to
+        the end of the file without re-writing it.**
 
     Output files are written to a temporary file first, then renamed to help
     prevent existing data files from being corrupted by aborted routines.
@@ -116,47 +154,853 @@ def standardize_toa5(fname, dest_path=None, baled=True):
     Files are further segregated into folders named after the relevant
     monitoring site and subfolders named after the file's data table name.
 
+    When reading in blocks (`chunksize` is not None), rows are held until
+    the file moves past the bale they fall in, so duplicate and out-of-order
+    records within a bale are resolved as when reading the whole file at
+    once and each bale is merged into its output file once. The output is
+    the same unless records are re-sent after data of a later bale: those
+    are merged with the bale already written, whose values take precedence.
+
+    If the ledger of merged files is enabled (see `enable_ledger`), a file
+    is skipped if it is unchanged since it was last merged into the output
+    files with the same definitions & settings, and is recorded once all its
+    output files are written.
+    """
+    def process(writer):
+        return _homogenize(fname, dest_path=dest_path, baled=baled,
+                           chunksize=chunksize, writer=writer)
+    return _recorded(fname, dest_path, baled, process)
+
+
+def standardize_split(fname, dest_path=None, baled=True, chunksize=None,
+                      max_lines=None, max_bytes=MAX_RAW_FILE_SIZE,
+                      boundary='day', keep_parts=False):
+    """Split oversized TOA5 file and standardize the parts straight from
+    memory, without writing them to disk and reading them back
+
+    The file is split as by `split_toa5.split_toa5` (on calendar days and at
+    most `MAX_RAW_FILE_SIZE` bytes per part, by default) and each part is
+    standardized in turn, so at most one part is held in memory at a time.
+    The source file itself is left in place.
+
+    Parameters
+    ----------
+    fname, dest_path, baled, chunksize :
+        See `standardize_toa5`
+    max_lines, max_bytes, boundary :
+        See `split_toa5.split_toa5`
+    keep_parts : bool, optional
+        If True, part files are also written alongside the source file, as
+        `split_toa5` would write them (e.g. for archiving). Default: False
+
+    Returns
+    -------
+    List of part files written (empty unless `keep_parts`)
+    """
+    header = get_toa5_header(fname)
+    written = []
+    def process(writer):
+        complete = True
+        parts = iter_parts(fname, max_lines=max_lines, max_bytes=max_bytes,
+                           boundary=boundary)
+        for partname, hdr, data, nrows in parts:
+            if keep_parts:
+                write_part(partname, hdr, data, nrows, header=header)
+                written.append(partname)
+            __msg('   Standardizing part {n} ({r} lines)\n'.format(
+                n=os.path.basename(partname), r=nrows))
+            complete &= bool(_homogenize(
+                partname, dest_path=dest_path, baled=baled,
+                chunksize=chunksize, header=header, writer=writer,
+                source=ChainReader(hdr, data, name=partname)))
+        return complete
+    _recorded(fname, dest_path, baled, process)
+    return written
+
+
+def standardize_files(flist, dest_path=None, baled=True, chunksize=None,
+                      jobs=1, callback=None):
+    """Standardize several TOA5 files, optionally using a pool of processes
+
+    Parameters
+    ----------
+    flist : list of str or (str, str) tuples
+        Paths to data files, or (path, dest_path) pairs to give files
+        different output paths (e.g. files of several sites)
+    dest_path, baled, chunksize :
+        See `standardize_toa5`
+    jobs : int, optional
+        Number of worker processes to use; if greater than 1, files are
+        distributed across a process pool. Defaults to 1 (no pool)
+    callback : callable, optional
+        Called with each result tuple (see Returns) as files finish
+
+    Files found unchanged in the ledger of merged files, if enabled (see
+    `enable_ledger`), are skipped; others are recorded in it once all their
+    output files are written.
+
+    Returns
+    -------
+    List of 5-tuples, one per file in order of completion, containing:
+    worker process ID, file name, file size (bytes), processing time
+    (seconds) and error message or None if successful.
+
+    Details
+    -------
+    With a pool, source files are read, standardized and baled in parallel;
+    instead of being merged into the output files directly, each bale is set
+    aside in a scratch directory beside the output files (on the same
+    volume). As soon as all source files before a given one in `flist` are
+    done, its set-aside bales are merged into their output files, in order:
+    a worker merges all ready bales of one output file and writes it, and
+    no two workers ever update the same output file at once. Precedence
+    among overlapping source files is thus the same as when they are
+    processed one at a time, so the output is identical to the serial
+    result. At most twice `jobs` source files are in progress at a time, so
+    scratch space holds the bales of only a few files, not of the whole
+    run. Writes are done under a `FileLock` regardless, to guard against
+    other programs updating the same files.
+    """
+    flist = [f if isinstance(f, tuple) else (f, dest_path) for f in flist]
+    results = []
+    if jobs is None or jobs < 2:
+        for fname, dest in flist:
+            res = _homogenize_task((fname, dest, baled, chunksize, None))
+            results.append(res[:5])
+            if callback:
+                callback(res[:5])
+        return results
+
+    pending = []
+    for fname, dest in flist:
+        if _skip_merged(fname, dest, baled):
+            res = (os.getpid(), fname, 0, 0.0, None)
+            results.append(res)
+            if callback:
+                callback(res)
+            continue
+        try:
+            st = os.stat(fname) # for ledger; see `_record_merged`
+        except OSError:
+            st = None
+        pending.append((fname, dest, st))
+    scratch = mkdtemp(prefix='standardize_toa5-',
+                      dir=_scratch_root(pending[0][1] if pending else None))
+    tasks = [(f, dest, baled, chunksize, (scratch, i))
+             for i, (f, dest, st) in enumerate(pending)]
+    pool = Pool(processes=jobs, initializer=_init_worker,
+                initargs=(_profiler.settings if _profiler else None,
+                          _manifest is not None))
+    done = Queue() # (kind of task, tag, result), from pool callbacks
+    def run(kind, tag, func, task):
+        pool.apply_async(func, (task,), callback=lambda res: done.put(
+            (kind, tag, res)))
+    try:
+        before = dict((f, (dest, st)) for f, dest, st in pending)
+        complete = [] # (file name, dest_path, stat, output files) for ledger
+        finished = set() # numbers of source files done
+        frontier = 0 # number of first source file not yet done
+        waiting = {} # (output file, table name): [(source file number,
+                     #   pickled bale), ...] not yet merged
+        merging = set() # (output file, table name) being merged
+        existed = {} # output file: truth of whether it existed before run
+        written = {} # output file: name written to or None if skipped
+        running = submitted = 0
+        while True:
+            while submitted < len(tasks) and running < 2*jobs:
+                run('file', submitted, _homogenize_task, tasks[submitted])
+                submitted += 1
+                running += 1
+            while frontier in finished:
+                frontier += 1
+            for key in sorted(waiting):
+                if key in merging:
+                    continue
+                # in order of source file, not of completion
+                ready = sorted(f for f in waiting[key] if f[0] < frontier)
+                if not ready:
+                    continue
+                waiting[key] = [f for f in waiting[key] if f[0] >= frontier]
+                ready = [frag for num, frag in ready]
+                merging.add(key)
+                run('merge', key, _merge_fragments_task, key + (ready,))
+            if not (running or merging):
+                break
+            kind, tag, res = done.get()
+            if kind == 'merge':
+                outpath, wrote, part, err = res
+                merging.discard(tag)
+                if err is not None:
+                    log.warning('Could not write %s (%s)' % (outpath, err))
+                    _note('skip', outpath, err)
+                if written.get(outpath, '') is not None: # None sticks
+                    written[outpath] = wrote
+                if part is not None:
+                    _manifest.merge(part)
+                continue
+            running -= 1
+            finished.add(tag)
+            for outpath, tbl_name, frag in res[5]:
+                if outpath not in existed:
+                    existed[outpath] = os.path.isfile(outpath)
+                waiting.setdefault((outpath, tbl_name), []).append((tag, frag))
+            if res[6] is not None:
+                _manifest.merge(res[6])
+            if res[7] and res[4] is None:
+                dest, st = before[res[1]]
+                complete.append((res[1], dest, st,
+                                 set(outpath for outpath, t, f in res[5])))
+            results.append(res[:5])
+            if callback:
+                callback(res[:5])
+        pool.close()
+        _bales_created([written[outpath] for outpath in sorted(existed)
+                        if not existed[outpath] and written[outpath]])
+        for fname, dest, st, outpaths in complete:
+            wrote = [written[outpath] for outpath in outpaths]
+            if None not in wrote:
+                _record_merged(fname, dest, baled, wrote, st)
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        rmtree(scratch, ignore_errors=True)
+    return results
+
+
+def _scratch_root(dest_path):
+    """Return existing directory nearest output path, which may hold
+    substitutions (see `standardize_toa5`), so scratch files are kept on
+    the same volume as output files rather than the system temp drive"""
+    der = os.path.abspath((dest_path or os.curdir).split('%(')[0])
+    while not os.path.isdir(der):
+        parent = os.path.dirname(der)
+        if parent == der:
+            return None
+        der = parent
+    return der
+
+
+def standardize_combined(flist, dest_path=None, baled=True, chunksize=None,
+                         callback=None):
+    """Standardize several TOA5 files, merging into each output file once
+
+    Bales from all files are collected in memory and combined in order of
+    `flist`, then each output file is merged with its combined bale and
+    written once, instead of once per source file. Suits batches of small
+    files which update the same output files (e.g. telemetry); memory use
+    grows with the size of the batch. Precedence among overlapping files is
+    the same as when they are processed one at a time. A file which fails
+    contributes nothing to the output files.
+
+    Parameters
+    ----------
+    flist, dest_path, baled, chunksize, callback :
+        See `standardize_files`
+
+    Returns
+    -------
+    List of 5-tuples as `standardize_files`, one per file in order
+    """
+    combined = {} # (output file, table name): table
+    order = []
+    results = []
+    for fname in flist:
+        bales = []
+        def writer(table, outpath, tbl_name):
+            bales.append((outpath, tbl_name, table))
+        err = None
+        start = time.time()
+        try:
+            _homogenize(fname, dest_path=dest_path, baled=baled,
+                        chunksize=chunksize, writer=writer)
+        except Exception as ex:
+            err = '{t}: {e}'.format(t=type(ex).__name__, e=ex)
+            _note('skip', fname, err)
+            del bales[:]
+        for outpath, tbl_name, table in bales:
+            key = (outpath, tbl_name)
+            if key not in combined:
+                combined[key] = table
+                order.append(key)
+                continue
+            try: # as in `_merge_fragments_task`
+                combined[key] = _merge_with_existing(table, combined[key],
+                                                     tbl_name)
+            except HeaderMismatchError:
+                pass
+        try:
+            nbytes = os.path.getsize(fname)
+        except OSError:
+            nbytes = 0
+        res = (os.getpid(), fname, nbytes, time.time()-start, err)
+        results.append(res)
+        if callback:
+            callback(res)
+    for outpath, tbl_name in order:
+        _write_locked(combined[(outpath, tbl_name)], outpath, tbl_name)
+    return results
+
+
+def plan_files(flist, dest_path=None, baled=True):
+    """Predict which output files each TOA5 file will update, cheaply
+
+    Only the header and the first and last lines of each file are read (see
+    `fileio.get_toa5_span`), so planning a large batch takes seconds. Data
+    is assumed to lie between the first and last timestamps, clipped to the
+    study period, and is mapped to output files as `_homogenize` would,
+    using the column routing of the file's header and `table_baleinfo`.
+
+    Parameters
+    ----------
+    flist, dest_path, baled :
+        See `standardize_files`
+
+    Returns
+    -------
+    List of dicts, one per file in order, with keys 'file', 'dest_path',
+    'bytes', 'rows' (estimated from line length), 'first' and 'last'
+    timestamps, 'site', 'table' (raw table name), 'tables' (current tables
+    fed by its columns, known even if file is skipped for lack of data),
+    'skip' (reason file will be skipped, or None) and 'bales': list of
+    (output file, table name, action) where action is `CREATED`, `MERGED`
+    or `APPENDED`, as predicted given the existing output files and those
+    of earlier files in list.
+    """
+    start = Timestamp(STUDY_START)
+    end = Timestamp(STUDY_END) + Day() - Timestamp.resolution
+    ends = {} # output file: last timestamp (None if unknown), as planned
+    plans = []
+    for item in flist:
+        fname, dest = item if isinstance(item, tuple) else (item, dest_path)
+        plan = dict(file=fname, dest_path=dest, bytes=0, rows=0, first=None,
+                    last=None, site=None, table=None, tables=[], skip=None,
+                    bales=[])
+        plans.append(plan)
+        try:
+            plan['bytes'] = os.path.getsize(fname)
+            header = get_toa5_header(fname)
+        except (IOError, OSError) as err:
+            plan['skip'] = str(err)
+            continue
+        if header is None:
+            plan['skip'] = 'invalid file format'
+            continue
+        plan.update(site=header.site_code, table=header.table_name)
+        if header.table_name not in historical_table_names:
+            plan['skip'] = 'unrecognized table: %s' % header.table_name
+            continue
+        notes, routes = _routing_plan(header.table_name,
+                                      tuple(header.columns[1:]))
+        plan['tables'] = [tbl for tbl, positions in routes]
+        try:
+            first, last, linelen = get_toa5_span(fname, header)
+        except (IOError, OSError) as err:
+            plan['skip'] = str(err)
+            continue
+        if first is None or last is None:
+            plan['skip'] = 'no data'
+            continue
+        plan['rows'] = (plan['bytes'] - header.data_start) // linelen
+        first, last = max(first, start), min(last, end)
+        if first > last:
+            plan['skip'] = 'no data within study period'
+            continue
+        plan.update(first=first, last=last)
+        try:
+            for tbl, positions in routes:
+                plan['bales'].extend(_plan_bales(tbl, first, last, header,
+                                                 dest, baled, ends))
+        except Exception as err: # e.g. unknown site
+            plan['skip'] = str(err)
+            plan['bales'] = []
+    return plans
+
+
+def _plan_bales(tbl_name, first, last, header, dest_path, baled, ends):
+    """Return list of (output file, table name, predicted action) for data
+    of table between timestamps; `ends` is dict of last timestamp of output
+    files as planned so far, which is updated"""
+    try:
+        grpbykeys, start_func, offset, freq = table_baleinfo[tbl_name]
+    except KeyError:
+        return []
+    if baled and grpbykeys is not None:
+        starts = []
+        bale = start_func(DataFrame(index=DatetimeIndex([first])))
+        while bale <= last:
+            starts.append(bale)
+            bale = bale + offset
+    else:
+        starts = [first]
+    bales = []
+    for num, bale in enumerate(starts):
+        outpath = _make_out_fname(DataFrame(index=DatetimeIndex([bale])),
+                                  header.site_code, dest_path, tbl_name,
+                                  baled)
+        if outpath not in ends and not os.path.isfile(outpath):
+            action = CREATED
+        else:
+            if outpath not in ends:
+                try:
+                    tail = _read_ends(outpath)[2]
+                    ends[outpath] = Timestamp(tail[-1]) if tail else None
+                except (IOError, OSError, ValueError):
+                    ends[outpath] = None
+            prior = ends[outpath]
+            action = MERGED
+            if freq is not None and prior is not None and (
+                    max(first, bale) > prior):
+                action = APPENDED
+        bale_last = last if num == len(starts)-1 else starts[num+1]
+        ends[outpath] = max(ends.get(outpath) or bale_last, bale_last)
+        bales.append((outpath, tbl_name, action))
+    return bales
+
+
+def locality_order(plans):
+    """Return plans (see `plan_files`) reordered so that files updating
+    the same output files are processed one after another
+
+    Files which could write to the same output files, directly or through
+    other files, form a group and keep their relative order, so precedence
+    among overlapping data -- and thus the output -- is unchanged. Since
+    predicted spans come from the ends of each file only (records may be out
+    of order, see `fileio.get_toa5_span`), files are grouped by destination,
+    site and table -- both raw and current -- rather than by predicted
+    output file. Groups are ordered by name of their first output file, so
+    output directories are swept in order rather than revisited.
+    """
+    parent = range(len(plans))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    owner = {} # grouping key: first plan having it
+    for i, plan in enumerate(plans):
+        for key in _locality_keys(plan):
+            if key in owner:
+                parent[find(i)] = find(owner[key])
+            else:
+                owner[key] = i
+    groups = {}
+    for i in range(len(plans)):
+        groups.setdefault(find(i), []).append(i)
+    def key(members):
+        outs = [b[0] for i in members for b in plans[i]['bales']]
+        return (min(outs) if outs else '', members[0])
+    return [plans[i] for members in sorted(groups.values(), key=key)
+            for i in members]
+
+
+def _locality_keys(plan):
+    """Return keys by which `locality_order` groups a plan: one per current
+    table its columns feed and one for its raw table, each qualified by
+    destination and site"""
+    if plan['site'] is None:
+        return [] # header unreadable, so nothing is written
+    dest = os.path.abspath(plan['dest_path'] or os.curdir)
+    keys = [('raw', dest, plan['site'], plan['table'])]
+    for tbl_name in plan['tables']:
+        keys.append(('output', dest, plan['site'], tbl_name))
+    return keys
+
+
+def _init_worker(profiling=None, manifest=False):
+    """Silence progress messages in pool workers, since output would
+    interleave, and set up profiling (see `enable_profiling`) and run
+    manifest as in parent; manifest records are returned with task results
+    (see `_drain_manifest`)"""
+    global _in_worker, _manifest
+    _in_worker = True
+    if profiling:
+        enable_profiling(*profiling)
+    if manifest:
+        _manifest = RunManifest('worker')
+
+
+def start_manifest(program, args=None):
+    """Begin recording manifest of run (see `definitions.runs`) of files
+    processed, bales written and files skipped; return `RunManifest`"""
+    global _manifest
+    _manifest = RunManifest(program, args)
+    return _manifest
+
+
+def finish_manifest(fname=None):
+    """Finish manifest of run, store it in local run history and, if
+    `fname` is given, write it to that file as JSON; return `RunManifest`
+    or None if no manifest was being recorded. Failure to store the
+    manifest is logged but not fatal."""
+    global _manifest
+    manifest, _manifest = _manifest, None
+    if manifest is None:
+        return None
+    manifest.finish()
+    try:
+        history = RunHistory()
+        history.add(manifest)
+        history.close()
+    except Exception as err:
+        log.warning('Could not update run history (%s)' % err)
+    if fname:
+        manifest.save(fname)
+    return manifest
+
+
+def _note(method, *args):
+    """Call named method of run manifest, if one is being recorded"""
+    if _manifest is not None:
+        getattr(_manifest, method)(*args)
+
+
+def _drain_manifest():
+    """Return records of run manifest made by pool worker, or None"""
+    if _in_worker and _manifest is not None:
+        return _manifest.drain()
+    return None
+
+
+def enable_ledger(dbfile=INPUT_LEDGER, skip=True):
+    """Record files standardized in full in ledger of merged files (see
+    `definitions.ledger`) and, if `skip`, skip files found there unchanged,
+    whose output files still exist. Use a `dbfile` of None to disable again.
+    If the ledger is unavailable, a warning is logged and it is not used."""
+    global _ledger, _ledger_skip
+    _ledger, _ledger_skip = None, skip
+    if dbfile:
+        try:
+            _ledger = InputLedger(dbfile)
+        except Exception as err:
+            log.warning('Ledger of merged files is unavailable (%s)' % err)
+
+
+def _recorded(fname, dest_path, baled, process):
+    """Standardize file by calling process(writer), which returns truth of
+    whether file was read in full, unless file is unchanged since merged
+    per ledger; if read in full and all output files are written, record
+    file in ledger. `writer` is None if ledger is disabled. Returns result
+    of process, or False if skipped."""
+    if _ledger is None:
+        return process(None)
+    if _skip_merged(fname, dest_path, baled):
+        return False
+    try:
+        st = os.stat(fname)
+    except OSError:
+        st = None
+    wrote = []
+    def writer(table, outpath, tbl_name):
+        existed = os.path.isfile(outpath)
+        wrote.append(_write_locked(table, outpath, tbl_name))
+        if not existed and wrote[-1] is not None:
+            _bales_created([wrote[-1]])
+    complete = process(writer)
+    if complete and None not in wrote:
+        _record_merged(fname, dest_path, baled, wrote, st)
+    return complete
+
+
+def _ledger_key(fname, dest_path, baled):
+    """Return (header fingerprint, output target, size) of file for ledger
+    or None if file has no valid header"""
+    header = get_toa5_header(fname)
+    if header is None:
+        return None
+    return (header.fingerprint, output_target(dest_path, baled),
+            os.path.getsize(fname))
+
+
+def _file_md5(fname):
+    """Return md5 of file, from local hash cache if current"""
+    st = os.stat(fname)
+    try:
+        md5 = _hash_cache().get(fname, st)
+    except Exception:
+        md5 = None
+    if md5 is None:
+        md5 = md5_file(fname)[0]
+        _cache_checksum(fname, md5, st)
+    return md5
+
+
+def _skip_merged(fname, dest_path, baled):
+    """Return True (and note skip) if ledger shows file unchanged since its
+    data was merged into output files, all of which are still those merged
+    into (see `InputLedger.current`)"""
+    if _ledger is None or not _ledger_skip:
+        return False
+    try:
+        key = _ledger_key(fname, dest_path, baled)
+        known = _ledger.lookup(*key) if key else None
+        bales = known.get(_file_md5(fname)) if known else None
+        if bales is None or not _ledger.current(bales):
+            return False
+    except Exception as err:
+        log.warning('Could not check ledger for %s (%s)' % (fname, err))
+        return False
+    __msg('   Unchanged since merged into output files. Skipping file.\n')
+    _note('skip', fname, 'unchanged since merged into output files')
+    return True
+
+
+def _bales_created(bales):
+    """Tell ledger output files were written where none existed; failure
+    is logged"""
+    if _ledger is None:
+        return
+    try:
+        _ledger.created(bales)
+    except Exception as err:
+        log.warning('Could not update ledger (%s)' % err)
+
+
+def _record_merged(fname, dest_path, baled, bales, st):
+    """Record file in ledger as merged into output files, unless it has
+    changed since `st`, the result of `os.stat` before it was read; failure
+    is logged"""
+    if _ledger is None or st is None:
+        return
+    try:
+        now = os.stat(fname)
+        if (now.st_size, now.st_mtime) != (st.st_size, st.st_mtime):
+            return # contents read may not be those hashed
+        key = _ledger_key(fname, dest_path, baled)
+        if key:
+            fingerprint, target, nbytes = key
+            _ledger.record(fname, _file_md5(fname), fingerprint, target,
+                           nbytes, set(bales))
+    except Exception as err:
+        log.warning('Could not update ledger for %s (%s)' % (fname, err))
+
+
+def enable_profiling(logfile, top=0, profile_dir=None):
+    """Record time & memory use of each stage of processing each file
+
+    Records of stages (header check, read, standardize, prep, merge, write
+    and rename) and of whole files are appended to `logfile` as JSON lines;
+    see `definitions.profiling`. If `top` is given, `cProfile` statistics of
+    the slowest `top` files (per process) are kept in `profile_dir` (default:
+    directory of `logfile`). Use a `logfile` of None to disable again.
     """
-    _homogenize(fname, dest_path=dest_path, baled=baled)
+    global _profiler
+    _profiler = StageProfiler(logfile, top, profile_dir) if logfile else None
+
+
+def _profiled(func):
+    """Decorate func(fname, ...) to group stages of its work by file, if
+    profiling"""
+    @wraps(func)
+    def wrapper(fname, *args, **kwargs):
+        if _profiler is None:
+            return func(fname, *args, **kwargs)
+        with _profiler.file(fname):
+            return func(fname, *args, **kwargs)
+    return wrapper
+
+
+def _stage(name, **fields):
+    """Return context manager timing stage of work, if profiling"""
+    if _profiler is None:
+        return null_stage
+    return _profiler.stage(name, **fields)
+
+
+def _homogenize_task(task):
+    """Standardize file per (fname, dest_path, baled, chunksize, spill) task
+
+    If `spill` is a (scratch dir, file number) tuple, output bales are
+    pickled into the scratch directory rather than written to `dest_path`.
+    Returns 8-tuple: worker process ID, file name, file size, processing
+    time, error message (or None), list of (output file, table name,
+    pickled bale) tuples for any spilled bales, run manifest records
+    made in pool worker (see `_drain_manifest`) and truth of whether file
+    was read in full."""
+    fname, dest_path, baled, chunksize, spill = task
+    spilled = []
+    err = None
+    complete = False
+    start = time.time()
+    try:
+        if spill is None:
+            complete = standardize_toa5(fname, dest_path=dest_path,
+                                        baled=baled, chunksize=chunksize)
+        else:
+            scratch, num = spill
+            def writer(table, outpath, tbl_name):
+                frag = os.path.join(scratch, '%06d_%06d.pkl'
+                                    % (num, len(spilled)))
+                table.to_pickle(frag)
+                spilled.append((outpath, tbl_name, frag))
+            complete = _homogenize(fname, dest_path=dest_path, baled=baled,
+                                   chunksize=chunksize, writer=writer)
+    except Exception as ex:
+        err = '{t}: {e}'.format(t=type(ex).__name__, e=ex)
+        _note('skip', fname, err)
+    try:
+        nbytes = os.path.getsize(fname)
+    except OSError:
+        nbytes = 0
+    return (os.getpid(), fname, nbytes, time.time()-start, err, spilled,
+            _drain_manifest(), complete)
+
+
+def _merge_fragments_task(task):
+    """Merge pickled bales, in order, into output file per task tuple of
+    (output file, table name, list of pickled bales); returns 4-tuple of
+    output file, name written to or None if skipped (see `_write_output`),
+    run manifest records made in pool worker and error message or None.
+    Errors are returned rather than raised since the pool only calls back
+    on success (see `standardize_files`)."""
+    outpath, tbl_name, frags = task
+    table = None
+    try:
+        for frag in frags:
+            df = read_pickle(frag)
+            if table is None:
+                table = df
+            else:
+                try:
+                    table = _merge_with_existing(df, table, tbl_name)
+                except HeaderMismatchError:
+                    pass
+            os.remove(frag)
+        wrote = _write_locked(table, outpath, tbl_name)
+    except Exception as ex:
+        return (outpath, None, _drain_manifest(),
+                '{t}: {e}'.format(t=type(ex).__name__, e=ex))
+    return outpath, wrote, _drain_manifest(), None
 
 
-def _safe_open_toa5(fname):
+def _safe_open_toa5(fname, chunksize=None, stats=None, tables=None):
     """Opens CSI TOA5-formatted data files preserving data exactly
 
     Load data from TOA5-formatted data file into pandas.DataFrame object.
     Values are loaded as strings and preserved exactly for output.
     Timestamp column is used as the dataframe index (axis 0). Column names
-    become names along DF axis 1. Instances of "NAN" are set to `np.nan`."""
-    df = read_csv(fname,
-                  header=1,
-                  skiprows=[2,3],
-                  index_col=0,
-                  parse_dates=True,
-                  #na_values=['"NAN"'],
-                  na_values=['NAN', 7999, -7999, 65535, 2147483647, -2147483648],
-                  keep_default_na=False,
-                  dtype=str)
-
-    dups = len(df.index.get_duplicates())
-    if dups:
-        df = df.groupby(level=0).last()
-        log.warning('Removed %d duplicate indices (%s)' % (dups, fname))
-
-    if not df.index.is_monotonic:
-        df.sort_index(inplace=True)
+    become names along DF axis 1. Instances of "NAN" are set to `np.nan`.
+    Duplicates are removed, rows sorted and clipped to study duration by
+    `fileio.tidy_toa5`; if `stats` is a dict, numbers of rows affected are
+    added to it (keys 'duplicates', 'reordered' and 'trimmed').
+
+    If `chunksize` is given, an iterator is returned instead which yields
+    DataFrames read `chunksize` rows at a time and holding whole bales of
+    current `tables`; see `_iter_toa5_chunks`."""
+    if chunksize:
+        return _iter_toa5_chunks(fname, chunksize, stats, tables)
+
+    df = _read_toa5(fname)
+    df, tidied = tidy_toa5(df)
+    fname = getattr(fname, 'name', fname) # for messages
+    _add_stats(stats, tidied)
+
+    if tidied['duplicates']:
+        log.warning('Removed %d duplicate indices (%s)' %
+                    (tidied['duplicates'], fname))
+    if tidied['reordered']:
         log.warning('Sorted non-monotonic timestamps (%s)' % fname)
-
-    if len(df[:'20110818']) or len(df['20161231':]):
+    if tidied['trimmed']:
         # XXX should this be aware of TODAY's date too?
-        df = df['20110818':'20161231']
         log.warning(('Detected and removed data from outside duration of REACCH '
               'study duration (before Aug 18, 2011 or after Dec 31, 2016) '
               '(%s)') % fname)
-
-    df.index.name = 'TIMESTAMP'
     return df
 
 
+def _iter_toa5_chunks(fname, chunksize, stats=None, tables=None):
+    """Yield TOA5 file contents as series of time-ordered DataFrames
+
+    Reads `fname` in blocks of `chunksize` rows, each tidied like
+    `_safe_open_toa5` does for whole files (duplicates removed, sorted,
+    clipped to study duration). Rows are held back until a block starts
+    past the bale they fall in, for each of the current `tables` (see
+    `table_baleinfo`; calendar days if not given), so each bale is yielded
+    once and in full: duplicates and out-of-order records within a bale are
+    resolved as for whole files, the last copy written being kept. Memory
+    use is therefore bounded by the size of a bale rather than of the file.
+
+    Records older than a bale already yielded are yielded with a later
+    block and a warning is logged; when merged into the output files, the
+    copy yielded first takes precedence. If `stats` is a dict, numbers of
+    rows affected are added to it as by `_safe_open_toa5`."""
+    name = getattr(fname, 'name', fname) # for messages
+    tidied = dict(duplicates=0, reordered=0, trimmed=0)
+    late = 0
+    done = None # rows before this timestamp have been yielded
+    held = [] # tidied blocks, or what is left of them, not yet yielded
+    def join(blocks):
+        if len(blocks) == 1:
+            return blocks[0]
+        df, counts = tidy_toa5(concat(blocks))
+        _add_stats(tidied, counts)
+        return df
+    for chunk in _read_toa5(fname, chunksize=chunksize):
+        chunk, counts = tidy_toa5(chunk)
+        _add_stats(tidied, counts)
+        if not len(chunk):
+            continue
+        if done is not None:
+            late += (chunk.index < done).sum()
+        cutoff = _bale_start(tables, chunk.index[0])
+        if held and min(b.index[0] for b in held) < cutoff:
+            ready = [b[b.index < cutoff] for b in held]
+            held = [b[b.index >= cutoff] for b in held]
+            held = [b for b in held if len(b)]
+            done = cutoff if done is None else max(done, cutoff)
+            yield join([b for b in ready if len(b)])
+        held.append(chunk)
+    if held:
+        yield join(held)
+
+    _add_stats(stats, tidied)
+    if tidied['duplicates']:
+        log.warning('Removed %d duplicate indices (%s)' %
+                    (tidied['duplicates'], name))
+    if tidied['reordered']:
+        log.warning('Sorted non-monotonic timestamps (%s)' % name)
+    if late:
+        log.warning('Found %d records older than data already written; '
+                    'earlier copies of these take precedence (%s)'
+                    % (late, name))
+    if tidied['trimmed']:
+        log.warning(('Detected and removed data from outside duration of REACCH '
+              'study duration (before Aug 18, 2011 or after Dec 31, 2016) '
+              '(%s)') % name)
+
+
+def _bale_start(tables, when):
+    """Return start of earliest bale, of any of tables, holding timestamp;
+    start of calendar day if no table is baled (see `table_baleinfo`)"""
+    df = DataFrame(index=DatetimeIndex([when]))
+    starts = [table_baleinfo[tbl][1](df) for tbl in tables or []
+              if tbl in table_baleinfo]
+    return min(starts) if starts else df.index.normalize()[0]
+
+
+def _add_stats(total, stats):
+    """Add counts in dict `stats` to those in dict `total`, if not None"""
+    if total is None:
+        return
+    for key, num in stats.iteritems():
+        total[key] = total.get(key, 0) + num
+
+
+def _read_toa5(fname, chunksize=None):
+    """Return raw contents of TOA5 file, as text, or reader if `chunksize`"""
+    return read_csv(fname,
+                    header=1,
+                    skiprows=[2,3],
+                    index_col=0,
+                    parse_dates=True,
+                    #na_values=['"NAN"'],
+                    na_values=['NAN', 7999, -7999, 65535, 2147483647, -2147483648],
+                    keep_default_na=False,
+                    dtype=str,
+                    chunksize=chunksize)
+
+
 def _safe_read_csv(file_name):
     """Read DataFrame previously written to CSV file in standard format"""
     df = read_csv(file_name,
@@ -174,8 +1018,59 @@ def _safe_read_csv(file_name):
     return df
 
 
-def _safe_write_csv(df, file_name):
-    """Write DataFrame to CSV file in standard format"""
+def _read_ends(file_name, num=3, blocksize=4096):
+    """Return header and first & last timestamps of standard format file
+
+    Reads only the first and last few lines of the file, so the cost does
+    not depend on the size of the file.
+
+    Returns
+    -------
+    3-tuple of: list of column names; list of first `num` and list of last
+    `num` timestamp strings (fewer if file is shorter). Last list is empty
+    if file does not end with a complete line.
+    """
+    with open(file_name, mode='rb') as f:
+        header = f.readline().rstrip('\r\n').split(',')
+        data_start = f.tell()
+        head = []
+        for i in range(num):
+            line = f.readline()
+            if not line.endswith('\n'):
+                break
+            head.append(line.split(',', 1)[0])
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        tail = []
+        readsize = blocksize
+        while True:
+            pos = max(data_start, size-readsize)
+            f.seek(pos)
+            lines = f.read(size-pos).split('\n')
+            if lines[-1] != '': # last line incomplete
+                return header, head, []
+            lines = lines[:-1]
+            if pos > data_start:
+                lines = lines[1:] # first line likely partial
+            if len(lines) >= num or pos == data_start:
+                break
+            readsize *= 2
+    tail = [ln.split(',', 1)[0] for ln in lines[-num:]]
+    return header, head, tail
+
+
+def _safe_write_csv(df, file_name, freq=None, append=False):
+    """Write DataFrame to CSV file in standard format
+
+    Timestamp format (number of subsecond digits) is chosen based on the
+    frequency of the data: `freq` (see `table_baleinfo`) if given and the
+    index is regularly spaced at that frequency, else as inferred from the
+    index. If `append` is true, rows are added to end of existing file,
+    without a header row, and `freq` is used unconditionally.
+
+    Returns md5 checksum of the file, computed as it is written, or None
+    when appending to an existing file (whose contents are not read).
+    """
     der = os.path.dirname(file_name)
     if der:
         # this illogically logical try-except block brought to you by:
@@ -186,28 +1081,75 @@ def _safe_write_csv(df, file_name):
             if not os.path.isdir(der):
                 raise
 
+    index = RowIndex.load(file_name) if append else None
+
     # express timestamps as string to achieve consistent formatting
-    df_freq = to_offset(df.index.inferred_freq)
+    if freq is None or not (append or _is_regular(df.index, freq)):
+        freq = df.index.inferred_freq
+    df = df.copy(deep=False) # don't disturb caller's index
+    df.index = Index(_format_timestamps(df.index, freq), name='TIMESTAMP')
+    with HashingWriter(file_name, append=append) as out:
+        df.to_csv(out,
+                   header=not append,
+                   na_rep='NAN',
+                   quoting=QUOTE_NONE, # since treating all values as strings
+                                       # be explicit about no quoting
+                   quotechar="'", # specify alternate quote to avoid
+                                  # triggering QUOTE_NONE/escapechar errors
+                                  # when writing fields with double-quotes
+                                  # (CompileResults and CardStatus columns)
+                   index_label='TIMESTAMP')
+    _update_row_index(file_name, index)
+    return out.hexdigest()
+
+
+def _update_row_index(file_name, index=None):
+    """Extend given row index to cover lines just appended to file, or index
+    file from scratch (see `RowIndex`); small files are not indexed. An
+    index is an optional aid to readers, so failure is merely logged."""
+    try:
+        if index is None:
+            index = RowIndex.build(file_name)
+        else:
+            index.extend()
+        if index.nrows > index.step:
+            index.save()
+        elif os.path.isfile(RowIndex.sidecar(file_name)):
+            os.remove(RowIndex.sidecar(file_name))
+    except (IOError, OSError) as err:
+        log.warning('Could not write row index for %s (%s)' % (file_name, err))
+
+
+def _is_regular(index, freq):
+    """Return truth of whether index is evenly spaced at freq (>= 3 items)"""
+    if len(index) < 3:
+        return False # too short to infer frequency from
+    step = to_offset(freq).nanos
+    return bool((np.diff(index.asi8) == step).all())
+
+
+def _format_timestamps(index, freq):
+    """Return array of timestamp strings formatted per data frequency
+
+    Formatting is done on the whole array at once rather than calling
+    strftime per item but results are identical: if `freq` is None, as
+    '%Y-%m-%d %H:%M:%S.%f' truncated to 2 subsecond digits; if less than
+    one second, as the same truncated to 1 subsecond digit; otherwise as
+    '%Y-%m-%d %H:%M:%S'.
+    """
+    df_freq = to_offset(freq)
     if df_freq is None:    #include 2 decimal places of subseconds
-        str_fmt = lambda x: dt.strftime(x, '%Y-%m-%d %H:%M:%S.%f')[:22]
+        width = 22
     elif df_freq < Second():    #only 1 decimal place of subseconds
-        str_fmt = lambda x: dt.strftime(x, '%Y-%m-%d %H:%M:%S.%f')[:21]
+        width = 21
     else:
-        str_fmt = lambda x: dt.strftime(x, '%Y-%m-%d %H:%M:%S')
-
-    df.index.name = 'TIMESTAMP' # <-- BIG HAMMER SOLUTION
-    df = df.reset_index()
-    df['TIMESTAMP'] = df['TIMESTAMP'].apply(str_fmt)
-    df.set_index('TIMESTAMP', inplace=True)
-    df.to_csv(file_name,
-               na_rep='NAN',
-               quoting=QUOTE_NONE, # since treating all values as strings be
-                                   # explicit about no quoting
-               quotechar="'", # specify alternate quote to avoid triggering
-                              # QUOTE_NONE/escapechar errors when writing
-                              # fields with double-quotes (CompileResults and
-                              # CardStatus columns)
-               index_label='TIMESTAMP')
+        width = 19
+    # 'YYYY-MM-DDTHH:MM:SS.ffffff' -> fixed-width bytes, one row per stamp
+    stamps = np.datetime_as_string(index.values.astype('M8[us]'))
+    chars = stamps.astype('S26').view(np.uint8).reshape(len(stamps), 26)
+    chars = np.ascontiguousarray(chars[:, :width])
+    chars[:, 10] = ord(' ')
+    return chars.view('S%d' % width).ravel()
 
 
 def _standardize_df(rawdf, was_tblname):
@@ -225,44 +1167,146 @@ def _standardize_df(rawdf, was_tblname):
     Dict with current table names as key and pandas.DataFrame\ s, with
     current column names, as values.
     """
-    newdfs = {}
-    for was_colname in rawdf.columns:
+    notes, routes = _routing_plan(was_tblname, tuple(rawdf.columns))
+    for note in notes:
+        __msg(note)
+    outdfs = {}
+    for tbl, positions in routes:
+        colnames = table_definitions[tbl][1:] #omit TIMESTAMP b/c it's Index
+        present = [i for (i, pos) in enumerate(positions) if pos >= 0]
+        picks = [positions[i] for i in present]
+        if len(present) < len(colnames):
+            # back-fill w/ NAN as text (object), not float, so values merged
+            # into these columns later are kept as text
+            values = np.empty((len(rawdf), len(colnames)), dtype=object)
+            values.fill(np.nan)
+            if picks:
+                values[:, present] = rawdf.iloc[:, picks].values
+            outdf = DataFrame(values, index=rawdf.index, columns=colnames)
+        elif picks == range(picks[0], picks[0]+len(picks)):
+            outdf = rawdf.iloc[:, picks[0]:picks[0]+len(picks)] # view
+            outdf.columns = colnames
+        else:
+            outdf = rawdf.iloc[:, picks] # single take, not per column
+            outdf.columns = colnames
+        outdf.index.name = 'TIMESTAMP'
+
+        ##### 'site_info' table is single special case of having 2 text
+        ##### columns so preserve double-quotes around legitimate strings
+        if tbl == 'site_info':
+            outdf = outdf.copy()
+            quote = lambda x: '"{s}"'.format(s=x.strip())
+            outdf['CompileResults'] = outdf['CompileResults'].apply(quote)
+            outdf['CardStatus'] = outdf['CardStatus'].apply(quote)
+        #####
+
+        outdfs[tbl] = outdf
+    return outdfs
+
+
+_routing_plans = None # see `_routing_plan`
+
+
+def _routing_plan(was_tblname, header):
+    """Return plan for routing raw columns into current tables
+
+    Plans depend only on the table name and column header of a raw file, so
+    they are worked out once per distinct header and remembered, both for
+    the life of the process and across runs in a cache file kept in
+    `LOCAL_CACHE` (named for `definitions_version` so stale plans are never
+    used).
+
+    Parameters
+    ----------
+    was_tblname : str
+        name of data table as specified in file header
+    header : tuple of str
+        raw column names, excluding TIMESTAMP
+
+    Returns
+    -------
+    2-tuple of a list of messages describing columns or tables which were
+    dropped or unrecognized, and a list of (current table name, positions)
+    tuples. Positions are listed in `table_definitions` order (omitting
+    TIMESTAMP) and give the index of the raw column feeding that column or
+    -1 if it must be back-filled with NAN.
+    """
+    global _routing_plans
+    if _routing_plans is None:
+        _routing_plans = _load_routing_plans()
+    key = (was_tblname, header)
+    if key in _routing_plans:
+        return _routing_plans[key]
+
+    notes = []
+    sources = {}
+    for pos, was_colname in enumerate(header):
         try:
             is_tblname, is_colname = current_names(was_tblname, was_colname)
         except ColumnNotFoundError:
-            __msg(' * Cannot find alias for column "%s" of table "%s" \n'
+            notes.append(' * Cannot find alias for column "%s" of table "%s" \n'
                     % (was_colname, was_tblname))
             continue
         if is_colname is None:
-            __msg(' - Discarding dropped column: {col} ({tbl})\n'.format(
+            notes.append(' - Discarding dropped column: {col} ({tbl})\n'.format(
                 col=was_colname, tbl=was_tblname))
             continue
         if is_tblname is None:
-            __msg(' - Discarding dropped table: {t}\n'.format(t=was_tblname))
+            notes.append(' - Discarding dropped table: {t}\n'.format(t=was_tblname))
             continue
-        tbl = newdfs.setdefault(is_tblname, {})
-        tbl[is_colname] = Series(rawdf[was_colname])
-    outdfs = {}
-    for tbl in newdfs:
+        sources.setdefault(is_tblname, {})[is_colname] = pos # last one wins
+    routes = []
+    for tbl in sorted(sources):
         try:
-            colnames = table_definitions[tbl][1:] #omit TIMESTAMP b/c it's Index
+            colnames = table_definitions[tbl][1:]
         except KeyError:
             msg = ' * No table definition found for "{n}" ... skipping.\n'
-            __msg(msg.format(n=tbl))
+            notes.append(msg.format(n=tbl))
             continue
-        outdf = DataFrame(newdfs[tbl], columns=colnames)
-        outdf.index.name = 'TIMESTAMP'
+        positions = [sources[tbl].get(col, -1) for col in colnames]
+        routes.append((tbl, positions))
 
-        ##### 'site_info' table is single special case of having 2 text
-        ##### columns so preserve double-quotes around legitimate strings
-        if tbl == 'site_info':
-            quote = lambda x: '"{s}"'.format(s=x.strip())
-            outdf['CompileResults'] = outdf['CompileResults'].apply(quote)
-            outdf['CardStatus'] = outdf['CardStatus'].apply(quote)
-        #####
+    _routing_plans[key] = plan = (notes, routes)
+    _save_routing_plans(_routing_plans)
+    return plan
 
-        outdfs[tbl] = outdf
-    return outdfs
+
+def _routing_plan_cachefile():
+    """Return path to cache file of routing plans or None if not cacheable"""
+    if definitions_version is None:
+        return None
+    return os.path.join(LOCAL_CACHE,
+                        'routing_plans_%s.pkl' % definitions_version)
+
+
+def _load_routing_plans():
+    """Return dict of previously cached routing plans, possibly empty"""
+    cachefile = _routing_plan_cachefile()
+    if cachefile:
+        try:
+            with open(cachefile, mode='rb') as f:
+                return pickle.load(f)
+        except Exception:
+            pass
+    return {}
+
+
+def _save_routing_plans(plans):
+    """Write routing plans to cache file, if possible"""
+    cachefile = _routing_plan_cachefile()
+    if not cachefile:
+        return
+    tempname = '%s~%d' % (cachefile, os.getpid())
+    try:
+        if not os.path.isdir(LOCAL_CACHE):
+            os.makedirs(LOCAL_CACHE)
+        with open(tempname, mode='wb') as f:
+            pickle.dump(plans, f, pickle.HIGHEST_PROTOCOL)
+        if os.path.isfile(cachefile):
+            os.remove(cachefile)
+        os.rename(tempname, cachefile)
+    except (IOError, OSError):
+        pass
 
 
 def _prep_df(std_df, tbl_name, baled):
@@ -292,6 +1336,8 @@ def _prep_df(std_df, tbl_name, baled):
 
     if not baled or grpbykeys is None:
         dflist = [std_df]
+    elif freq is not None and len(std_df) and (np.diff(std_df.index.asi8) > 0).all():
+        dflist = _bale(std_df, start_func, offset, freq)
     else:
         groups = std_df.groupby(grpbykeys)
         for grp, df in groups:
@@ -302,6 +1348,51 @@ def _prep_df(std_df, tbl_name, baled):
     return dflist
 
 
+_grid_templates = {} # (freq, slots per bale): int64 offsets; see `_bale`
+
+
+def _bale(std_df, start_func, offset, freq):
+    """Return list of bales of time-ordered table, padded to regular grid
+
+    Same result as grouping rows by bale (see `table_baleinfo`) and
+    reindexing each group to a `DatetimeIndex` spanning its bale, but bale
+    boundaries are found by `searchsorted` on the int64 timestamps and rows
+    are placed in the grid by their slot number, without per-row Python
+    calls. Grid offsets are cached per (freq, bale length). Timestamps must
+    be unique and increasing; rows off the grid are dropped, as by reindex.
+    """
+    ts = std_df.index.asi8
+    edges = date_range(start=start_func(std_df), end=std_df.index[-1],
+                       freq=offset)
+    edges = np.append(edges.asi8, (edges[-1] + offset).value)
+    bounds = np.searchsorted(ts, edges)
+    step = to_offset(freq).nanos
+    # all-text tables (the norm) are filled directly; others by reindex
+    values = None
+    if (std_df.dtypes == object).all():
+        values = std_df.values
+    dflist = []
+    for i in range(len(edges) - 1):
+        lo, hi = bounds[i], bounds[i+1]
+        if lo == hi:
+            continue
+        start = edges[i]
+        key = (freq, (edges[i+1] - start) // step)
+        if key not in _grid_templates:
+            _grid_templates[key] = np.arange(key[1], dtype=np.int64) * step
+        grid = DatetimeIndex(_grid_templates[key] + start)
+        if values is None:
+            dflist.append(std_df.iloc[lo:hi].reindex(grid))
+            continue
+        rel = ts[lo:hi] - start
+        ongrid = (rel % step) == 0
+        out = np.empty((key[1], values.shape[1]), dtype=object)
+        out.fill(np.nan)
+        out[rel[ongrid] // step] = values[lo:hi][ongrid]
+        dflist.append(DataFrame(out, index=grid, columns=std_df.columns))
+    return dflist
+
+
 def _merge_with_existing(to_merge, existing, tbl_name):
     """Combine dataframe w/ existing data read from file, w/ error checking"""
     if not to_merge.columns.equals(existing.columns):
@@ -322,9 +1413,69 @@ def _merge_with_existing(to_merge, existing, tbl_name):
         combined = existing.combine_first(to_merge).asfreq(freq)
     else:
         combined = existing.combine_first(to_merge)
+    if not (combined.dtypes == object).all():
+        # combine_first makes columns all-NAN in both tables float, and text
+        # merged into them later would then be too ("7" -> "7.0")
+        combined = combined.astype(object)
     return combined
 
 
+def _append_to_existing(to_append, file_name, tbl_name):
+    """Append data to end of existing file if it won't overlap existing data
+
+    Fast path for `_merge_with_existing`: when all new data follows the
+    last record of the existing file, rows are appended in place (after
+    padding the gap with null rows) instead of reading, merging and
+    re-writing the entire file. Only the first and last few lines of the
+    existing file are read.
+
+    Returns the rows appended (including padding; possibly none), or None if
+    a full merge is needed:
+    the table has no fixed frequency, headers differ, data overlaps, or the
+    existing file is too short or irregular to be sure the result would be
+    the same as with a full merge.
+    """
+    try:
+        freq = table_baleinfo[tbl_name][3]
+    except KeyError:
+        return None
+    if freq is None:
+        return None
+    header, head, tail = _read_ends(file_name)
+    if header != ['TIMESTAMP'] + list(to_append.columns):
+        return None
+    if len(head) < 3 or len(tail) < 3:
+        return None
+    # must be formatted the way a full re-write would format it
+    stamplen = 21 if to_offset(freq) < Second() else 19
+    if any([len(ts) != stamplen for ts in head + tail]):
+        return None
+    try:
+        head, tail = DatetimeIndex(head), DatetimeIndex(tail)
+    except (ValueError, TypeError):
+        return None
+    if infer_freq(head) != freq or infer_freq(tail) != freq:
+        return None
+    last = tail[-1]
+    if not to_append.index[0] > last:
+        return None
+
+    tstamps = DatetimeIndex(start=last+to_offset(freq),
+                            end=to_append.index[-1], freq=freq)
+    padded = to_append.reindex(tstamps)
+    if not len(padded):
+        return padded
+    size = os.path.getsize(file_name)
+    try:
+        _safe_write_csv(padded, file_name, freq=freq, append=True)
+    except:
+        # don't leave partial record(s) on the end of the file
+        with open(file_name, mode='r+b') as f:
+            f.truncate(size)
+        raise
+    return padded
+
+
 def _make_out_fname(df, site_code, dest_path, tbl_name, baled):
     """Make file names for output files using standard formula"""
     if site_code not in [site.code for site in site_list]:
@@ -350,33 +1501,118 @@ def _make_out_fname(df, site_code, dest_path, tbl_name, baled):
     return fname % {'site':site_code, 'table':tbl_name, 'date':start}
 
 
-def _homogenize(fname, dest_path=None, baled=True):
-    """The actual legwork of standardizing a raw data file"""
+@_profiled
+def _homogenize(fname, dest_path=None, baled=True, chunksize=None,
+                writer=None, header=None, source=None):
+    """The actual legwork of standardizing a raw data file
+
+    If `chunksize` is given, the file is read in blocks of that many rows
+    and standardized, baled and merged into output files a bale at a time
+    (see `_iter_toa5_chunks`), so each bale is written once. If `writer` is
+    given, it is called with each (table, output file name, table name)
+    instead of writing to output files. If `source` is given, data (including
+    header lines) is read from that file-like object instead of file `fname`,
+    which then only names the data in messages, and `header` is the parsed
+    `TOA5Header`; such data is not recorded in the archive catalog.
+
+    Returns True if file was read in full, False if skipped in whole or
+    part."""
     __msg('   Checking file format ... ')
-    site_code = get_site_code(fname)
-    was_tblname = get_table_name(fname)
+    if source is None:
+        with _stage('header'):
+            header = get_toa5_header(fname)
+    site_code = header.site_code if header else None
+    was_tblname = header.table_name if header else None
     if not was_tblname:
         __msg('invalid file format. Skipping file.\n')
-        return
+        _note('skip', fname, 'invalid file format')
+        return False
     elif was_tblname not in historical_table_names:
         __msg('unrecognized table: {n}. Skipping file.\n'.format(n=was_tblname))
-        return
+        _note('skip', fname, 'unrecognized table: %s' % was_tblname)
+        return False
     else:
         __msg('table "{n}" from {s} site.\n'.format(n=was_tblname, s=site_code))
 
-    __msg('   Reading file ... ')
     try:
-        rawdf = _safe_open_toa5(fname)
-    except:
-        __msg('error occurred during read. Skipping file.')
-        return
-    __msg('read {n} rows\n'.format(n=len(rawdf)))
-
-    __msg('   Applying standard format ... \n')
-    stdfs = _standardize_df(rawdf, was_tblname)
-
+        st = os.stat(fname) if source is None else None
+        reader = HashingReader(source or open(fname, mode='rb'))
+    except (IOError, OSError):
+        __msg('unable to open file. Skipping file.\n')
+        _note('skip', fname, 'unable to open file')
+        return False
+    stats = dict(first_ts=None, last_ts=None, nrows=0, nvalid=0)
+    tidied = {} # see `_safe_open_toa5`
+    tables = set()
+    def process(rawdf):
+        __msg('read {n} rows\n'.format(n=len(rawdf)))
+        if len(rawdf):
+            lo, hi = rawdf.index[0], rawdf.index[-1]
+            if stats['first_ts'] is not None:
+                lo = min(lo, stats['first_ts'])
+                hi = max(hi, stats['last_ts'])
+            stats.update(first_ts=lo, last_ts=hi)
+            stats['nrows'] += len(rawdf)
+            stats['nvalid'] += count_valid(rawdf)
+        __msg('   Applying standard format ... \n')
+        with _stage('standardize', rows=len(rawdf)):
+            stdfs = _standardize_df(rawdf, was_tblname)
+        tables.update(stdfs.keys())
+        _write_tables(stdfs, site_code, dest_path, baled, writer)
+
+    with reader:
+        if not chunksize:
+            __msg('   Reading file ... ')
+            try:
+                with _stage('read'):
+                    rawdf = _safe_open_toa5(reader, stats=tidied)
+            except:
+                __msg('error occurred during read. Skipping file.')
+                _note('skip', fname, 'error occurred during read')
+                return False
+            process(rawdf)
+        else:
+            routes = _routing_plan(was_tblname, tuple(header.columns[1:]))[1]
+            chunks = _safe_open_toa5(reader, chunksize=chunksize,
+                                     stats=tidied,
+                                     tables=[tbl for tbl, pos in routes])
+            num = 0
+            while True:
+                num += 1
+                __msg('   Reading chunk {i} ... '.format(i=num))
+                try:
+                    with _stage('read', chunk=num):
+                        rawdf = next(chunks)
+                except StopIteration:
+                    __msg('end of file.\n')
+                    break
+                except:
+                    __msg('error occurred during read. Skipping rest of file.')
+                    _note('skip', fname, 'error occurred during read of '
+                          'chunk %d' % num)
+                    return False
+                process(rawdf)
+                del rawdf
+        if source is None: # parts of split files aren't recorded; see below
+            md5 = reader.hexdigest() # reads any unread remainder
+    if any(tidied.values()):
+        __msg(('   Tidied: {duplicates} duplicate, {reordered} out of order '
+               'and {trimmed} out of study period rows\n').format(**tidied))
+    _note('read', fname, reader.nbytes, stats['nrows'], was_tblname, tidied)
+    if source is not None:
+        return True
+    _cache_checksum(fname, md5, st)
+    _catalog_record('record', fname, RAW, site=site_code, raw_table=was_tblname,
+                    table_name=tables, md5=md5, **stats)
+    return True
+
+
+def _write_tables(stdfs, site_code, dest_path, baled, writer=None):
+    """Bale standardized tables and write (or merge) them into output files"""
+    writer = writer or _write_locked
     for newname, newtbl in stdfs.iteritems():
-        tables = _prep_df(newtbl, newname, baled)
+        with _stage('prep', table=newname, rows=len(newtbl)):
+            tables = _prep_df(newtbl, newname, baled)
         if not tables:
             __msg(' * no output for table "{n}"\n'.format(n=newname))
             continue
@@ -385,35 +1621,149 @@ def _homogenize(fname, dest_path=None, baled=True):
                 __msg(' * no data in "{n}" \n'.format(n=newname))
                 continue
             outpath = _make_out_fname(table, site_code, dest_path, newname, baled)
-            typ = 'Writing'
-            if os.path.isfile(outpath):
-                try:
-                    existing = _safe_read_csv(outpath)
-                    table = _merge_with_existing(table, existing, newname)
-                except HeaderMismatchError:
-                    __msg((' % existing file has different header - unable to'
-                           'merge! Skipping {f}\n').format(f=outpath))
-                    continue # TODO write output file to different name instead
-                typ = 'Appending'
-            __msg('   {a} to {f} \n'.format(a=typ, f=outpath))
-            tempname = outpath+"~0"
-            _safe_write_csv(table, tempname)
-            if os.path.isfile(outpath):
-                try:
-                    os.remove(outpath)
-                except WindowsError:
-                    __msg(' * unable to delete existing file (%s)\n' % outpath)
-                    outpath = outpath+'.new'
+            writer(table, outpath, newname)
+
+
+def _write_locked(table, outpath, tbl_name):
+    """Write table to output file while holding a `FileLock` on it; returns
+    as `_write_output`"""
+    # lock held through rename so concurrent processes writing to the
+    # same bale can't each merge with stale copy of existing file
+    with FileLock(outpath):
+        return _write_output(table, outpath, tbl_name)
+
+
+def _write_output(table, outpath, tbl_name):
+    """Write table to output file, merging with existing file if present;
+    returns name of file written (which may differ from `outpath` if the
+    existing file could not be replaced) or None if skipped"""
+    typ = 'Writing'
+    if os.path.isfile(outpath):
+        # catalog record must be checked before file changes
+        current = _catalog_record('is_current', outpath)
+        prior = _catalog_record('get', outpath) if current else None
+        with _stage('write', bale=outpath, rows=len(table), mode='append'):
+            appended = _append_to_existing(table, outpath, tbl_name)
+        if appended is not None:
+            __msg('   Appending to end of {f} \n'.format(f=outpath))
+            if len(appended):
+                _record_checksum(outpath, None) # see `_record_checksum`
+            _catalog_record('record_append', outpath, appended, prior)
+            _note('wrote', outpath, tbl_name, len(appended), APPENDED)
+            return outpath
+        try:
+            with _stage('merge', bale=outpath, rows=len(table)):
+                existing = _safe_read_csv(outpath)
+                table = _merge_with_existing(table, existing, tbl_name)
+        except HeaderMismatchError:
+            __msg((' % existing file has different header - unable to'
+                   'merge! Skipping {f}\n').format(f=outpath))
+            _note('skip', outpath, 'existing file has different header')
+            return None # TODO write output file to different name instead
+        typ = 'Appending'
+    __msg('   {a} to {f} \n'.format(a=typ, f=outpath))
+    tempname = outpath+"~0"
+    with _stage('write', bale=outpath, rows=len(table)):
+        md5 = _safe_write_csv(table, tempname,
+                              freq=table_baleinfo[tbl_name][3])
+    with _stage('rename', bale=outpath):
+        if os.path.isfile(outpath):
             try:
-                os.rename(tempname, outpath)
+                os.remove(outpath)
             except WindowsError:
-                __msg(' ! unable to rename to destination (%s)\n' % outpath)
+                __msg(' * unable to delete existing file (%s)\n' % outpath)
+                outpath = outpath+'.new'
+        try:
+            os.rename(tempname, outpath)
+        except WindowsError:
+            __msg(' ! unable to rename to destination (%s)\n' % outpath)
+            _note('skip', outpath, 'unable to rename to destination')
+            return None
+        try:
+            move_row_index(tempname, outpath)
+        except OSError as err:
+            log.warning('Could not move row index for %s (%s)'
+                        % (outpath, err))
+    _record_checksum(outpath, md5)
+    _catalog_record('record_df', outpath, STANDARD, table, table_name=tbl_name,
+                    md5=md5)
+    _note('wrote', outpath, tbl_name, len(table),
+          MERGED if typ == 'Appending' else CREATED)
+    return outpath
+
+
+_hash_caches = {} # by process ID, as `_catalogs`
+
+
+def _record_checksum(fname, md5):
+    """Record checksum of file just written in md5sums manifest of its
+    directory (see `update_manifest`) and local hash cache, so neither it
+    nor `generate_md5sums` need read the file again; failure is logged
+
+    A `md5` of None, for files appended to, removes the file's manifest
+    entry; the checksum is left unknown rather than found by reading the
+    whole file, and the hash cache entry, keyed by size & modification time,
+    is already stale. `generate_md5sums` hashes the file when next run."""
+    try:
+        update_manifest(fname, md5)
+    except Exception as err:
+        log.warning('Could not update md5sums manifest for %s (%s)'
+                    % (fname, err))
+    if md5 is not None:
+        _cache_checksum(fname, md5)
+
+
+def _hash_cache():
+    """Return `HashCache` for this process"""
+    pid = os.getpid()
+    if pid not in _hash_caches:
+        _hash_caches[pid] = HashCache()
+    return _hash_caches[pid]
+
+
+def _cache_checksum(fname, md5, st=None):
+    """Remember checksum of file in local hash cache; `st` is as for
+    `HashCache.put`. Failure is logged"""
+    try:
+        cache = _hash_cache()
+        cache.put(fname, md5, st)
+        cache.commit()
+    except Exception as err:
+        log.warning('Could not update hash cache (%s)' % err)
+
+
+_catalogs = {} # by process ID; database connections mustn't cross a fork
+
+
+def _catalog():
+    """Return archive `Catalog` for this process or None if unavailable"""
+    pid = os.getpid()
+    if pid not in _catalogs:
+        try:
+            _catalogs[pid] = Catalog()
+        except Exception as err:
+            log.warning('Archive catalog is unavailable (%s)' % err)
+            _catalogs[pid] = None
+    return _catalogs[pid]
+
+
+def _catalog_record(method, *args, **kwargs):
+    """Call named method of archive catalog, if available, and return result;
+    failure is logged but not fatal since the catalog can be rebuilt"""
+    cat = _catalog()
+    if cat is None:
+        return None
+    try:
+        return getattr(cat, method)(*args, **kwargs)
+    except Exception as err:
+        log.warning('Could not update archive catalog (%s)' % err)
+        return None
 
 
 def __msg(msg):
     """handles verbosity; semi-magic because it touches argparser results"""
     # TODO replace this with logging
-    if __name__ == '__main__': # don't use in modules
+    if __name__ == '__main__' and not _in_worker: # don't use in modules
         if args.verbose:
             sys.stdout.write(str(msg))
 
@@ -461,6 +1811,18 @@ def __show_settings():
         print 'Time-based baling: disabled'
     else:
         print 'Time-based baling: enabled'
+    if args.chunksize:
+        print 'Chunked reading: {n} rows per block'.format(n=args.chunksize)
+    else:
+        print 'Chunked reading: disabled'
+    print 'Parallel jobs: {j}'.format(j=args.jobs)
+    if args.split:
+        print 'Split oversized files: by {b}{k}'.format(b=args.split,
+                k=(', keeping parts' if args.keep_parts else ''))
+    else:
+        print 'Split oversized files: disabled'
+    if args.profile:
+        print 'Profiling: to {f}'.format(f=args.profile)
 
 
 def __show_filelist(listall=''):
@@ -487,6 +1849,38 @@ def __show_filelist(listall=''):
         print '<File processing list is empty>'
 
 
+def __show_plan(plans):
+    """print output files each file is predicted to update, and totals"""
+    actions = {CREATED: 0, MERGED: 0, APPENDED: 0}
+    nbytes, nrows, reread, skipped = 0, 0, 0, 0
+    seen = set()
+    for plan in plans:
+        print os.path.basename(plan['file'])
+        if plan['skip']:
+            print '    skip: {r}'.format(r=plan['skip'])
+            skipped += 1
+            continue
+        nbytes += plan['bytes']
+        nrows += plan['rows']
+        print '    {a} to {b}, ~{n} rows, {mb:.1f} MB'.format(
+            a=plan['first'], b=plan['last'], n=plan['rows'],
+            mb=plan['bytes']/1024./1024.)
+        for outpath, tbl, action in plan['bales']:
+            print '    {x:<8s} {f}'.format(x=action, f=outpath)
+            actions[action] += 1
+            if (action == MERGED and outpath not in seen
+                    and os.path.isfile(outpath)):
+                reread += os.path.getsize(outpath)
+            seen.add(outpath)
+    print
+    print ('Plan: {f} files ({mb:.1f} MB, ~{r} rows), {s} to skip; {o} output '
+           'files: {c} created, {m} merged, {a} appended; {rr:.1f} MB of '
+           'existing files to re-read for merging').format(
+                f=len(plans)-skipped, mb=nbytes/1024./1024., r=nrows,
+                s=skipped, o=len(seen), c=actions[CREATED], m=actions[MERGED],
+                a=actions[APPENDED], rr=reread/1024./1024.)
+
+
 _splashscreen = """\
 ----------------------------------------------------------------------------
 |  EC tower raw data file homogenizer [interactive mode]                   |
@@ -555,6 +1949,46 @@ if __name__ == '__main__':
     p.add_argument('--nobale', action='store_true',
                    help=('output all files cumulatively instead of breaking '
                          'larger files up into monthly or daily blocks'))
+    p.add_argument('--chunksize', nargs='?', type=int, const=DEFAULT_CHUNK_ROWS,
+                   help=('read source files in blocks of this many rows, '
+                         'holding at most a bale of data at a time (default '
+                         'block size: %d rows); records re-sent after data '
+                         'of a later bale do not replace those written'
+                         % DEFAULT_CHUNK_ROWS))
+    p.add_argument('-j', '--jobs', type=int, default=1,
+                   help=('number of files to process in parallel using '
+                         'separate processes (default: 1)'))
+    p.add_argument('--split', nargs='?', const='day',
+                   choices=['day', 'month', 'size'],
+                   help=('split source files larger than %d MB in memory '
+                         'while standardizing, at day (default) or month '
+                         'boundaries or by size only; not with --jobs'
+                         % (MAX_RAW_FILE_SIZE/1024/1024)))
+    p.add_argument('--keep-parts', action='store_true',
+                   help='with --split, also write the parts to disk')
+    p.add_argument('--profile', metavar='FILE',
+                   help=('append time & memory use of each stage of '
+                         'processing each file to FILE, as JSON lines'))
+    p.add_argument('--profile-top', metavar='N', type=int, default=0,
+                   help=('with --profile, also keep cProfile statistics of '
+                         'the N slowest files, beside FILE'))
+    p.add_argument('--manifest', metavar='FILE',
+                   help=('also write manifest of run (files read, bales '
+                         'written, files skipped) to FILE as JSON; manifests '
+                         'are always kept in local run history'))
+    p.add_argument('--force', action='store_true',
+                   help=('standardize files even if unchanged since their '
+                         'data was merged into the output files, per the '
+                         'ledger kept in %s' % INPUT_LEDGER))
+    p.add_argument('--plan', action='store_true',
+                   help=('print output files each file is predicted to '
+                         'create, merge with or append to, from its header '
+                         'and last line only, then exit without processing'))
+    p.add_argument('--locality', action='store_true',
+                   help=('process files for the same site and table one '
+                         'after another; relative order of files which may '
+                         'update the same output files, and so the output, '
+                         'is unchanged'))
     p.add_argument('--infilt', nargs='?',
                    help='restrict to files matching this inclusion filter')
     p.add_argument('--exfilt', nargs='*',
@@ -562,6 +1996,11 @@ if __name__ == '__main__':
                          'this argument must not be last or it will consume '
                          'any provided file names'))
     args = p.parse_args()
+    if args.split and args.jobs > 1:
+        p.error('--split cannot be used with --jobs')
+    if args.profile:
+        enable_profiling(args.profile, top=args.profile_top)
+    enable_ledger(skip=not args.force)
 
     flist = __get_filelist()
 
@@ -782,22 +2221,72 @@ if __name__ == '__main__':
 
         ## end of interactive mode
 
+    if args.plan or args.locality:
+        plans = plan_files(flist, dest_path=args.out, baled=not args.nobale)
+        if args.plan:
+            __show_plan(plans)
+            sys.exit(0)
+        flist = [plan['file'] for plan in locality_order(plans)]
+
     start = dt.now()
     total = len(flist)
-    for num, fname in enumerate(flist):
-        # XXX hack: pull message out of function in order to provide status
-        #   update: e.g. [1/921]
-        # possibly fix this cruft using logging
-        __msg('\nStandardizing {n} ... [{x}/{of}]\n'.format(n=fname,
-                                                            x=(num+1),
-                                                            of=total))
-        if args.nobale:
-            _homogenize(fname, dest_path=args.out, baled=False)
-        else:
-            _homogenize(fname, dest_path=args.out)
+    start_manifest('standardize_toa5', vars(args))
+    if args.jobs > 1:
+        done = []
+        def __progress(res):
+            pid, fname, nbytes, secs, err = res
+            done.append(res)
+            status = 'failed ({e})'.format(e=err) if err else 'done'
+            print ('[{x}/{of}] {n} ... {s} ({t:.1f}s, worker {p})'.format(
+                    x=len(done), of=total, n=os.path.basename(fname),
+                    s=status, t=secs, p=pid))
+        results = standardize_files(flist, dest_path=args.out,
+                                    baled=not args.nobale,
+                                    chunksize=args.chunksize,
+                                    jobs=args.jobs, callback=__progress)
+        print '\nWorker throughput\n-----------------'
+        byworker = {}
+        for pid, fname, nbytes, secs, err in results:
+            w = byworker.setdefault(pid, [0, 0, 0.0])
+            w[0] += 1
+            w[1] += nbytes
+            w[2] += secs
+        for pid, (nfiles, nbytes, secs) in sorted(byworker.items()):
+            mb = nbytes/1024./1024.
+            print ('  worker {p}: {n} files, {mb:.1f} MB in {s:.1f}s '
+                   '({r:.2f} MB/s)').format(p=pid, n=nfiles, mb=mb, s=secs,
+                                            r=(mb/secs if secs else 0))
+    else:
+        for num, fname in enumerate(flist):
+            # XXX hack: pull message out of function in order to provide status
+            #   update: e.g. [1/921]
+            # possibly fix this cruft using logging
+            __msg('\nStandardizing {n} ... [{x}/{of}]\n'.format(n=fname,
+                                                                x=(num+1),
+                                                                of=total))
+            if args.split and os.path.getsize(fname) > MAX_RAW_FILE_SIZE:
+                standardize_split(fname, dest_path=args.out,
+                                  baled=not args.nobale,
+                                  chunksize=args.chunksize,
+                                  boundary=(None if args.split == 'size'
+                                            else args.split),
+                                  keep_parts=args.keep_parts)
+            else:
+                standardize_toa5(fname, dest_path=args.out,
+                                 baled=not args.nobale,
+                                 chunksize=args.chunksize)
     duration = dt.now() - start
     print ('\nStarted at %s \nFinished at %s (duration %s)' %
             (str(start)[:-7], str(dt.now())[:-7], str(duration)))
+    totals = finish_manifest(args.manifest).totals()
+    print ('Read {f} files ({mb:.1f} MB, {r} rows) at {rate:.2f} MB/s; wrote '
+           '{w} rows: {c} bales created, {m} merged, {a} appended; {s} '
+           'skipped').format(f=totals['files'], mb=totals['bytes']/1024./1024.,
+                             r=totals['rows_read'], rate=totals['mb_per_s'],
+                             w=totals['rows_written'],
+                             c=totals['bales_created'],
+                             m=totals['bales_merged'],
+                             a=totals['bales_appended'], s=totals['skipped'])
 
 
 